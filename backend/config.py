@@ -4,7 +4,7 @@
 import os
 import logging
 import sys
-from typing import List
+from typing import Dict, List
 from pydantic_settings import BaseSettings
 from pydantic import Field, computed_field
 from dotenv import load_dotenv
@@ -49,19 +49,163 @@ class Settings(BaseSettings):
     proxy_api_base_url: str = "https://api.proxyapi.ru/openai/v1"
     openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
     openai_vision_model: str = os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini")
+
+    # Пул соединений к ProxyAPI (общий для всех запросов)
+    openai_timeout: float = 60.0
+    openai_connect_timeout: float = 10.0
+    openai_max_connections: int = 20
+    openai_max_keepalive_connections: int = 10
+    openai_keepalive_expiry: float = 30.0
+    openai_http2: bool = True
+    openai_warmup_connections: int = 2
+    # Строгая JSON Schema в response_format (иначе — просто json_object)
+    openai_structured_outputs: bool = True
+
+    # Кэш результатов анализа
+    cache_enabled: bool = True
+    cache_dir: str = ".cache"
+    cache_ttl_seconds: int = 7 * 24 * 3600
+    cache_memory_items: int = 256
+    cache_disk_max_mb: int = 200
+    image_cache_hamming_threshold: int = 5
+    image_cache_max_items: int = 2000
+
+    # Лимиты запросов к ProxyAPI (раздельно для текстовой и vision модели)
+    text_rpm: int = 500
+    text_tpm: int = 200000
+    vision_rpm: int = 100
+    vision_tpm: int = 100000
+    upstream_concurrency_initial: int = 8
+    upstream_concurrency_min: int = 1
+    upstream_concurrency_max: int = 32
+    upstream_max_retries: int = 4
+    upstream_backoff_base: float = 0.5
+    upstream_backoff_max: float = 20.0
+
+    # Предобработка изображений перед Vision API
+    image_preprocess_enabled: bool = True
+    image_max_edge: int = 1280
+    image_format: str = "JPEG"
+    image_quality: int = 80
+    image_low_detail_max_edge: int = 512
+
+    # Пакетный анализ текста
+    batch_max_items: int = 500
+    batch_max_concurrency: int = 8
     
+    # Обход всех конкурентов (POST /competitors/crawl)
+    crawl_browser_concurrency: int = 0      # 0 — по размеру пула браузеров
+    crawl_upstream_concurrency: int = 8
+    crawl_domain_concurrency: int = 1
+    crawl_domain_delay: float = 1.0
+
+    # Определение изменений страниц: повторный анализ только при заметных изменениях
+    change_detection_enabled: bool = True
+    change_text_threshold: float = 0.05     # доля изменившегося текста
+    change_visual_threshold: int = 6        # расстояние Хэмминга dHash скриншотов
+    change_detection_ttl: int = 30 * 24 * 3600
+
+    # Планировщик периодических проверок
+    scheduler_enabled: bool = True
+    scheduler_file: str = "schedules.json"
+    scheduler_workers: int = 1
+    scheduler_min_interval: int = 60
+    scheduler_default_jitter: int = 60
+    scheduler_startup_spread: float = 300.0
+    scheduler_tick_max: float = 30.0
+    # Интервал для автоматических расписаний COMPETITOR_URLS (0 — не создавать)
+    scheduler_seed_interval: int = 0
+
+    # Асинхронные задания на парсинг и анализ (POST /jobs)
+    jobs_enabled: bool = True
+    jobs_db_file: str = "jobs.db"
+    jobs_workers: int = 2
+    # Успешное задание с теми же параметрами отдаётся повторно в течение окна, сек
+    jobs_dedupe_window: int = 600
+    # Сколько раз задание может быть прервано перезапуском сервера
+    jobs_max_attempts: int = 3
+    jobs_retention_hours: int = 72
+    # Максимальное ожидание в long-poll и интервал keepalive в SSE, сек
+    jobs_poll_timeout: float = 30.0
+
+    # Журнал использования API (токены, задержки, повторы)
+    usage_ledger_enabled: bool = True
+    usage_db_file: str = "usage.db"
+    usage_retention_days: int = 30
+    # Бюджеты токенов в час по эндпоинтам (через env: ENDPOINT_TOKEN_BUDGETS=/analyze_text=100000,/parse_demo=300000)
+    endpoint_token_budgets_str: str = Field(default="", validation_alias="ENDPOINT_TOKEN_BUDGETS")
+
     # API
     api_host: str = "0.0.0.0"
     api_port: int = 8000
-    
-    # История
+    # Отмена парсинга и вызовов API, если клиент закрыл соединение
+    cancel_on_disconnect: bool = True
+    # Бюджет времени /parse_demo, сек (заголовок X-Request-Timeout или поле deadline)
+    request_deadline: float = 60.0
+    request_deadline_max: float = 300.0
+    # Ожидаемая длительность анализа, пока нет статистики: по ней выбирается vision или текст
+    vision_latency_estimate: float = 20.0
+    text_latency_estimate: float = 8.0
+
+    # История (SQLite; history_file — старый JSON, переносится в базу при первом запуске)
+    history_db_file: str = "history.db"
     history_file: str = "history.json"
-    max_history_items: int = 10
+    max_history_items: int = 10             # сколько записей отдаёт GET /history по умолчанию
+    history_retention_rows: int = 10000
+    history_retention_days: int = 90        # 0 — без ограничения по времени
     
     # Парсер
     parser_timeout: int = 10
     parser_user_agent: str = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+    # Скриншот по умолчанию (нужен для vision анализа; без него страница может загрузиться по HTTP)
+    parser_screenshot: bool = True
+    
+    # Быстрая загрузка по HTTP без браузера
+    http_fetch_enabled: bool = True
+    http_fetch_max_connections: int = 20
+    http_min_text_length: int = 200
+    parser_engine_memory_ttl: int = 7 * 24 * 3600
+
+    # Кэш результатов парсинга (повторный парсинг URL без браузера)
+    parse_cache_enabled: bool = True
+    parse_cache_ttl: int = 600              # сек; запрос может сузить окно параметром max_age
+    parse_cache_memory_mb: int = 64         # LRU в памяти, вместе со скриншотами
+    parse_cache_disk_mb: int = 64
+    screenshot_store_max_mb: int = 1024     # скриншоты на диске (по SHA-256 содержимого)
     
+    # Ожидание готовности страницы вместо фиксированной паузы
+    readiness_signals: str = "ready_state,content,dom_quiet,network_idle"
+    readiness_max_wait: float = 8.0
+    readiness_quiet_ms: int = 500
+    readiness_network_idle_ms: int = 500
+    readiness_poll_interval: float = 0.1
+    readiness_min_samples: int = 3
+    readiness_reprobe_rate: float = 0.1    # доля загрузок, где отброшенные сигналы проверяются снова
+    
+    # Пул браузеров Chrome
+    browser_pool_size: int = 2
+    browser_pool_prelaunch: bool = True
+    browser_max_pages: int = 50
+    browser_max_rss_mb: int = 1024
+    browser_acquire_timeout: float = 30.0
+
+    # Процессы-исполнители с браузерами (по одному на браузер пула)
+    browser_job_timeout: float = 60.0       # дольше — исполнитель убивается вместе с Chrome (tabs — закрывается вкладка)
+    browser_worker_max_rss_mb: int = 1536   # память исполнителя с браузером, после — перезапуск
+    browser_reaper_interval: int = 60       # сек между поисками осиротевших chrome/chromedriver
+    browser_worker_start_timeout: float = 60.0
+    # Режим: pool — Chrome на каждое задание, tabs — вкладки в отдельных контекстах одного Chrome
+    browser_mode: str = "pool"
+    browser_tabs_per_worker: int = 8        # одновременных вкладок в одном Chrome (режим tabs)
+    browser_tabs_max_rss_mb: int = 4096     # память исполнителя с Chrome и всеми вкладками
+    browser_shutdown_timeout: float = 10.0
+
+    # Блокировка ресурсов в браузере (категории: trackers, media, images, fonts)
+    browser_block_enabled: bool = True
+    browser_block_text_profile: str = "trackers,media,images,fonts"
+    browser_block_visual_profile: str = "trackers,media"
+    browser_block_extra_patterns: str = ""
+
     # URL сайтов конкурентов (через env: COMPETITOR_URLS=url1,url2,url3)
     # Строка — pydantic не парсит как JSON; список — computed_field
     competitor_urls_str: str = Field(default="", validation_alias="COMPETITOR_URLS")
@@ -72,6 +216,16 @@ class Settings(BaseSettings):
         raw = self.competitor_urls_str or ""
         return [u.strip() for u in raw.split(",") if u and u.strip()]
     
+    @computed_field
+    @property
+    def endpoint_token_budgets(self) -> Dict[str, int]:
+        budgets = {}
+        for item in (self.endpoint_token_budgets_str or "").split(","):
+            endpoint, _, limit = item.strip().rpartition("=")
+            if endpoint and limit.strip().isdigit():
+                budgets[endpoint.strip()] = int(limit)
+        return budgets
+    
     class Config:
         env_file = ".env"
         extra = "ignore"
@@ -2,19 +2,29 @@
 Главный модуль FastAPI приложения
 Мониторинг конкурентов - MVP ассистент
 """
-import base64
+import asyncio
+import hashlib
+import json
 import time
 import logging
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from contextlib import nullcontext
+from typing import AsyncIterator, Dict, List, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 import uvicorn
 
 from backend.config import settings
 from backend.models.schemas import (
     TextAnalysisRequest,
     TextAnalysisResponse,
+    TextBatchRequest,
+    CrawlRequest,
+    ScheduleCreate,
+    ScheduleInfo,
+    JobInfo,
+    CompetitorAnalysis,
     ImageAnalysisResponse,
     ParseDemoRequest,
     ParseDemoResponse,
@@ -23,7 +33,21 @@ from backend.models.schemas import (
 )
 from backend.services.openai_service import openai_service
 from backend.services.parser_service import parser_service
+from backend.services.browser_supervisor import browser_supervisor
+from backend.services.http_fetcher import http_fetcher
+from backend.services.parse_cache import parse_cache
 from backend.services.history_service import history_service
+from backend.services.pipeline_service import pipeline_service, ParseError
+from backend.services.crawl_service import crawl_service
+from backend.services.change_detector import change_detector
+from backend.services.scheduler_service import scheduler_service
+from backend.services.job_service import job_service, job_info
+from backend.services.cancellation import cancellation, ClientDisconnected
+from backend.services.deadline import DeadlineExceeded, deadline_scope, resolve_budget
+from backend.services.singleflight import singleflight
+from backend.services.rate_limiter import upstream_governor
+from backend.services.image_service import image_service
+from backend.services.usage_ledger import usage_ledger, usage_scope, GROUPINGS
 
 # Логгер для API
 logger = logging.getLogger("competitor_monitor.api")
@@ -65,8 +89,9 @@ async def log_requests(request: Request, call_next):
     if request.query_params:
         logger.debug(f"    Query params: {dict(request.query_params)}")
     
-    # Выполняем запрос
-    response = await call_next(request)
+    # Выполняем запрос (вызовы API внутри учитываются по эндпоинту)
+    with usage_scope(endpoint=request.url.path):
+        response = await call_next(request)
     
     # Логируем ответ
     elapsed = time.time() - start_time
@@ -76,6 +101,12 @@ async def log_requests(request: Request, call_next):
     return response
 
 
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    """Клиент уже ушёл — ответ никто не прочитает (499 — как у nginx)"""
+    return Response(status_code=499)
+
+
 # === События жизненного цикла ===
 
 @app.on_event("startup")
@@ -88,6 +119,11 @@ async def startup_event():
     logger.info(f"  Модель текста: {settings.openai_model}")
     logger.info(f"  Модель vision: {settings.openai_vision_model}")
     logger.info("=" * 60)
+    await openai_service.warmup()
+    # Браузеры запускаются в фоне, сервер принимает запросы сразу
+    app.state.browser_warmup = asyncio.create_task(parser_service.warmup())
+    scheduler_service.start()
+    job_service.start()
 
 
 @app.on_event("shutdown")
@@ -95,12 +131,82 @@ async def shutdown_event():
     """Закрытие ресурсов при остановке сервера"""
     logger.info("=" * 60)
     logger.info("🔴 ОСТАНОВКА СЕРВЕРА")
+    logger.info("  Остановка планировщика...")
+    await scheduler_service.stop()
+    logger.info("  Остановка очереди заданий...")
+    await job_service.stop()
     logger.info("  Закрытие Parser сервиса...")
     await parser_service.close()
+    logger.info("  Закрытие OpenAI сервиса...")
+    await openai_service.close()
+    logger.info("  Закрытие журнала использования...")
+    await usage_ledger.close()
     logger.info("  ✓ Все ресурсы освобождены")
     logger.info("=" * 60)
 
 
+# === Потоковые ответы ===
+
+def ndjson_response(events: AsyncIterator[dict], request: Optional[Request] = None) -> StreamingResponse:
+    """
+    Отдать события построчно в формате NDJSON (один JSON объект на строку)
+
+    С request генерация событий отменяется, как только клиент отключится,
+    а не при следующей попытке записи в закрытое соединение.
+    """
+    async def body():
+        try:
+            async with cancellation.guard(request) if request is not None else nullcontext():
+                async for event in events:
+                    yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        except ClientDisconnected:
+            return
+    
+    return StreamingResponse(
+        body(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def sse_response(events: AsyncIterator[dict]) -> StreamingResponse:
+    """Отдать события в формате Server-Sent Events (тип события — поле type)"""
+    async def body():
+        async for event in events:
+            if event["type"] == "ping":
+                yield ": ping\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+    
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def analyze_text_coalesced(text: str, use_cache: bool) -> CompetitorAnalysis:
+    """Анализ текста; одновременные запросы с тем же текстом ждут один вызов API"""
+    return await singleflight.do(
+        "text",
+        f"{openai_service.text_cache_key(text)}|cache={use_cache}",
+        lambda: openai_service.analyze_text(text, use_cache=use_cache)
+    )
+
+
+def text_summary(text: str) -> str:
+    """Краткое описание текстового запроса для истории"""
+    return text[:100] + "..." if len(text) > 100 else text
+
+
+def request_budget(request: ParseDemoRequest, http_request: Request) -> float:
+    """Бюджет времени запроса: поле deadline, заголовок X-Request-Timeout или REQUEST_DEADLINE"""
+    try:
+        return resolve_budget(request.deadline, http_request.headers.get("X-Request-Timeout"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 # === Эндпоинты ===
 
 @app.get("/")
@@ -111,7 +217,7 @@ async def root():
 
 
 @app.post("/analyze_text", response_model=TextAnalysisResponse)
-async def analyze_text(request: TextAnalysisRequest):
+async def analyze_text(request: TextAnalysisRequest, http_request: Request):
     """
     Анализ текста конкурента
     """
@@ -123,16 +229,17 @@ async def analyze_text(request: TextAnalysisRequest):
     try:
         start_time = time.time()
         
-        analysis = await openai_service.analyze_text(request.text)
+        async with cancellation.guard(http_request):
+            analysis = await analyze_text_coalesced(request.text, use_cache=not request.no_cache)
         
         elapsed = time.time() - start_time
         logger.info(f"  ✓ Анализ завершён за {elapsed:.2f} сек")
         
         # Сохраняем в историю
         logger.info("  💾 Сохранение в историю...")
-        history_service.add_entry(
+        await history_service.add_entry(
             request_type="text",
-            request_summary=request.text[:100] + "..." if len(request.text) > 100 else request.text,
+            request_summary=text_summary(request.text),
             response_summary=analysis.summary
         )
         
@@ -143,6 +250,8 @@ async def analyze_text(request: TextAnalysisRequest):
             success=True,
             analysis=analysis
         )
+    except ClientDisconnected:
+        raise
     except Exception as e:
         logger.error(f"  ❌ ОШИБКА: {e}")
         logger.error("=" * 50)
@@ -152,8 +261,108 @@ async def analyze_text(request: TextAnalysisRequest):
         )
 
 
+@app.post("/analyze_text/batch")
+async def analyze_text_batch(request: TextBatchRequest, http_request: Request):
+    """
+    Пакетный анализ текстов: результаты приходят по мере готовности (NDJSON)
+    """
+    logger.info("=" * 50)
+    logger.info("📚 API: ПАКЕТНЫЙ АНАЛИЗ ТЕКСТОВ")
+    
+    if len(request.texts) > settings.batch_max_items:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком много текстов в пакете: максимум {settings.batch_max_items}"
+        )
+    
+    use_cache = not request.no_cache
+    concurrency = min(request.concurrency or settings.batch_max_concurrency, settings.batch_max_concurrency)
+    
+    # Одинаковые тексты анализируем один раз
+    groups: Dict[str, List[int]] = {}
+    texts: Dict[str, str] = {}
+    invalid: List[int] = []
+    for index, text in enumerate(request.texts):
+        if len(text.strip()) < 10:
+            invalid.append(index)
+            continue
+        key = openai_service.text_cache_key(text)
+        groups.setdefault(key, []).append(index)
+        texts.setdefault(key, text)
+    
+    logger.info(f"  Текстов: {len(request.texts)}, уникальных: {len(groups)}, некорректных: {len(invalid)}")
+    logger.info(f"  Параллельность: {concurrency}")
+    
+    async def events():
+        start_time = time.time()
+        semaphore = asyncio.Semaphore(concurrency)
+        history_entries = []
+        succeeded = failed = 0
+        
+        async def run(key: str):
+            async with semaphore:
+                try:
+                    return key, await analyze_text_coalesced(texts[key], use_cache), None
+                except Exception as e:
+                    return key, None, str(e)
+        
+        for index in invalid:
+            failed += 1
+            yield {"type": "item", "index": index, "success": False, "error": "Текст короче 10 символов"}
+        
+        tasks = [asyncio.ensure_future(run(key)) for key in groups]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                key, analysis, error = await next_done
+                indexes = groups[key]
+                if analysis is not None:
+                    # Запись на каждый элемент пакета; повторы ссылаются на первую
+                    first = len(history_entries)
+                    for position, index in enumerate(indexes):
+                        entry = {
+                            "request_type": "text",
+                            "request_summary": text_summary(request.texts[index]),
+                            "response_summary": analysis.summary
+                        }
+                        if position:
+                            entry["duplicate_of"] = first
+                        history_entries.append(entry)
+                for position, index in enumerate(indexes):
+                    event = {"type": "item", "index": index, "success": analysis is not None}
+                    if analysis is not None:
+                        succeeded += 1
+                        event["analysis"] = analysis.model_dump()
+                    else:
+                        failed += 1
+                        event["error"] = error
+                    if position:
+                        event["duplicate_of"] = indexes[0]
+                    yield event
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Вся пачка попадает в историю одной транзакцией. Если клиент отключился,
+            # задача уже отменена и await здесь тоже прервался бы — запись идёт в
+            # отдельной задаче под shield и завершается, даже когда ответ оборван
+            await asyncio.shield(history_service.add_entries(history_entries))
+        
+        elapsed = time.time() - start_time
+        logger.info(f"  ✅ Пакет обработан за {elapsed:.2f} сек: успешно {succeeded}, ошибок {failed}")
+        logger.info("=" * 50)
+        yield {
+            "type": "done",
+            "total": len(request.texts),
+            "unique": len(groups),
+            "succeeded": succeeded,
+            "failed": failed,
+            "elapsed": round(elapsed, 2)
+        }
+    
+    return ndjson_response(events(), http_request)
+
+
 @app.post("/analyze_image", response_model=ImageAnalysisResponse)
-async def analyze_image(file: UploadFile = File(...)):
+async def analyze_image(http_request: Request, file: UploadFile = File(...), no_cache: bool = Form(False)):
     """
     Анализ изображения конкурента
     """
@@ -181,22 +390,32 @@ async def analyze_image(file: UploadFile = File(...)):
         file_size_kb = len(content) / 1024
         logger.info(f"  Размер файла: {file_size_kb:.1f} KB")
         
-        image_base64 = base64.b64encode(content).decode('utf-8')
+        # Уменьшаем и перекодируем перед отправкой
+        prepared = await image_service.prepare_async(content, file.content_type)
+        image_base64 = prepared.base64
         logger.info(f"  Base64 размер: {len(image_base64)} символов")
         
         # Анализируем
         logger.info("  🔍 Отправка на анализ...")
-        analysis = await openai_service.analyze_image(
-            image_base64=image_base64,
-            mime_type=file.content_type
-        )
+        image_key = hashlib.sha256(content).hexdigest()
+        async with cancellation.guard(http_request):
+            analysis = await singleflight.do(
+                "image",
+                f"{image_key}|cache={not no_cache}",
+                lambda: openai_service.analyze_image(
+                    image_base64=image_base64,
+                    mime_type=prepared.mime_type,
+                    use_cache=not no_cache,
+                    detail=prepared.detail
+                )
+            )
         
         elapsed = time.time() - start_time
         logger.info(f"  ✓ Анализ завершён за {elapsed:.2f} сек")
         
         # Сохраняем в историю
         logger.info("  💾 Сохранение в историю...")
-        history_service.add_entry(
+        await history_service.add_entry(
             request_type="image",
             request_summary=f"Изображение: {file.filename}",
             response_summary=analysis.description[:200] if analysis.description else "Анализ изображения"
@@ -209,6 +428,8 @@ async def analyze_image(file: UploadFile = File(...)):
             success=True,
             analysis=analysis
         )
+    except ClientDisconnected:
+        raise
     except Exception as e:
         logger.error(f"  ❌ ОШИБКА: {e}")
         logger.error("=" * 50)
@@ -219,88 +440,59 @@ async def analyze_image(file: UploadFile = File(...)):
 
 
 @app.post("/parse_demo", response_model=ParseDemoResponse)
-async def parse_demo(request: ParseDemoRequest):
+async def parse_demo(request: ParseDemoRequest, http_request: Request):
     """
-    Парсинг и анализ сайта конкурента через Chrome
+    Парсинг и анализ сайта конкурента (по HTTP или через Chrome)
     """
     logger.info("=" * 50)
     logger.info("🌐 API: ПАРСИНГ САЙТА")
     logger.info(f"  URL: {request.url}")
+    budget = request_budget(request, http_request)
+    logger.info(f"  Бюджет времени: {budget:.0f} сек")
     
     try:
-        total_start = time.time()
-        
-        # Открываем страницу в Chrome и делаем скриншот
-        logger.info("  🔍 Запуск парсинга...")
-        parse_start = time.time()
-        title, h1, first_paragraph, screenshot_bytes, error = await parser_service.parse_url(request.url)
-        parse_elapsed = time.time() - parse_start
-        logger.info(f"  ✓ Парсинг завершён за {parse_elapsed:.2f} сек")
-        
-        if error:
-            logger.error(f"  ❌ Ошибка парсинга: {error}")
-            logger.info("=" * 50)
-            return ParseDemoResponse(
-                success=False,
-                error=error
-            )
-        
-        logger.info(f"  📌 Title: {title[:50] if title else 'N/A'}...")
-        logger.info(f"  📌 H1: {h1[:50] if h1 else 'N/A'}...")
-        logger.info(f"  📌 Screenshot: {len(screenshot_bytes) / 1024:.1f} KB" if screenshot_bytes else "  📌 Screenshot: N/A")
-        
-        # Конвертируем скриншот в base64
-        screenshot_base64 = parser_service.screenshot_to_base64(screenshot_bytes) if screenshot_bytes else None
-        
-        # Анализируем сайт через Vision API (скриншот + контекст)
-        logger.info("  🤖 Запуск AI анализа...")
-        ai_start = time.time()
-        
-        if screenshot_base64:
-            analysis = await openai_service.analyze_website_screenshot(
-                screenshot_base64=screenshot_base64,
-                url=request.url,
-                title=title,
-                h1=h1,
-                first_paragraph=first_paragraph
-            )
-        else:
-            logger.warning("  ⚠ Скриншот недоступен, fallback на текстовый анализ")
-            analysis = await openai_service.analyze_parsed_content(
-                title=title,
-                h1=h1,
-                paragraph=first_paragraph
-            )
-        
-        ai_elapsed = time.time() - ai_start
-        logger.info(f"  ✓ AI анализ завершён за {ai_elapsed:.2f} сек")
-        
-        parsed_content = ParsedContent(
-            url=request.url,
-            title=title,
-            h1=h1,
-            first_paragraph=first_paragraph,
-            analysis=analysis
-        )
+        # Если клиент закроет соединение, браузер и вызов API освобождаются сразу
+        async with cancellation.guard(http_request):
+            with deadline_scope(budget):
+                parsed_content = await pipeline_service.parse_and_analyze(
+                    request.url,
+                    use_cache=not request.no_cache,
+                    screenshot=request.screenshot,
+                    max_age=request.max_age
+                )
+        analysis = parsed_content.analysis
         
         # Сохраняем в историю
         logger.info("  💾 Сохранение в историю...")
-        history_service.add_entry(
+        await history_service.add_entry(
             request_type="parse",
             request_summary=f"URL: {request.url}",
-            response_summary=analysis.summary[:100] if analysis.summary else f"Title: {title or 'N/A'}"
+            response_summary=analysis.summary[:100] if analysis.summary else f"Title: {parsed_content.title or 'N/A'}",
+            url=request.url
         )
         
-        total_elapsed = time.time() - total_start
-        logger.info(f"  ✅ УСПЕХ: Парсинг и анализ завершён за {total_elapsed:.2f} сек")
-        logger.info(f"    - Парсинг: {parse_elapsed:.2f} сек")
-        logger.info(f"    - AI анализ: {ai_elapsed:.2f} сек")
+        logger.info("  ✅ УСПЕХ: Парсинг и анализ завершён")
         logger.info("=" * 50)
         
         return ParseDemoResponse(
             success=True,
             data=parsed_content
         )
+    except ParseError as e:
+        logger.info("=" * 50)
+        return ParseDemoResponse(
+            success=False,
+            error=str(e)
+        )
+    except DeadlineExceeded as e:
+        logger.warning(f"  ⏱️ {e} ({budget:.0f} сек)")
+        logger.info("=" * 50)
+        return ParseDemoResponse(
+            success=False,
+            error=str(e)
+        )
+    except ClientDisconnected:
+        raise
     except Exception as e:
         logger.error(f"  ❌ ОШИБКА: {e}")
         logger.error("=" * 50)
@@ -310,13 +502,184 @@ async def parse_demo(request: ParseDemoRequest):
         )
 
 
+@app.post("/analyze_text/stream")
+async def analyze_text_stream(request: TextAnalysisRequest, http_request: Request):
+    """
+    Потоковый анализ текста: поля анализа приходят по мере генерации (NDJSON)
+    """
+    logger.info("📝 API: ПОТОКОВЫЙ АНАЛИЗ ТЕКСТА")
+    logger.info(f"  Длина текста: {len(request.text)} символов")
+    
+    async def events():
+        yield {"type": "start"}
+        try:
+            async for event in openai_service.stream_text(request.text, use_cache=not request.no_cache):
+                if event["type"] == "result":
+                    await history_service.add_entry(
+                        request_type="text",
+                        request_summary=text_summary(request.text),
+                        response_summary=event["analysis"]["summary"]
+                    )
+                yield event
+        except Exception as e:
+            logger.error(f"  ❌ ОШИБКА: {e}")
+            yield {"type": "error", "error": str(e)}
+    
+    return ndjson_response(events(), http_request)
+
+
+@app.post("/analyze_image/stream")
+async def analyze_image_stream(http_request: Request, file: UploadFile = File(...), no_cache: bool = Form(False)):
+    """
+    Потоковый анализ изображения (NDJSON)
+    """
+    logger.info("🖼️ API: ПОТОКОВЫЙ АНАЛИЗ ИЗОБРАЖЕНИЯ")
+    logger.info(f"  Имя файла: {file.filename}")
+    
+    allowed_types = ["image/jpeg", "image/png", "image/gif", "image/webp"]
+    if file.content_type not in allowed_types:
+        logger.warning(f"  ⚠ Неподдерживаемый тип файла: {file.content_type}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неподдерживаемый тип файла. Разрешены: {', '.join(allowed_types)}"
+        )
+    
+    content = await file.read()
+    filename = file.filename
+    mime_type = file.content_type
+    
+    async def events():
+        yield {"type": "start"}
+        try:
+            prepared = await image_service.prepare_async(content, mime_type)
+            async for event in openai_service.stream_image(
+                prepared.base64,
+                prepared.mime_type,
+                use_cache=not no_cache,
+                detail=prepared.detail
+            ):
+                if event["type"] == "result":
+                    description = event["analysis"]["description"]
+                    await history_service.add_entry(
+                        request_type="image",
+                        request_summary=f"Изображение: {filename}",
+                        response_summary=description[:200] if description else "Анализ изображения"
+                    )
+                yield event
+        except Exception as e:
+            logger.error(f"  ❌ ОШИБКА: {e}")
+            yield {"type": "error", "error": str(e)}
+    
+    return ndjson_response(events(), http_request)
+
+
+@app.post("/parse_demo/stream")
+async def parse_demo_stream(request: ParseDemoRequest, http_request: Request):
+    """
+    Потоковый парсинг и анализ сайта: сначала данные страницы, затем поля анализа (NDJSON)
+    """
+    logger.info("🌐 API: ПОТОКОВЫЙ ПАРСИНГ САЙТА")
+    logger.info(f"  URL: {request.url}")
+    budget = request_budget(request, http_request)
+    expires = time.monotonic() + budget
+    
+    async def events():
+        yield {"type": "phase", "phase": "parsing"}
+        try:
+            need_screenshot = settings.parser_screenshot if request.screenshot is None else request.screenshot
+            # Бюджет ограничивает загрузку страницы и выбор пути анализа; поля анализа
+            # приходят по мере генерации, поэтому сам поток не обрывается
+            with deadline_scope(budget), deadline_scope(pipeline_service.parse_budget()):
+                parsed = await parser_service.parse_url(request.url, screenshot=need_screenshot, max_age=request.max_age)
+            if parsed.error:
+                yield {"type": "error", "error": parsed.error}
+                return
+            title, h1, first_paragraph, screenshot_bytes = parsed.title, parsed.h1, parsed.first_paragraph, parsed.screenshot
+            
+            yield {
+                "type": "parsed",
+                "data": {
+                    "url": request.url,
+                    "title": title,
+                    "h1": h1,
+                    "first_paragraph": first_paragraph,
+                    "details": parsed.details.model_dump() if parsed.details else None,
+                    "engine": parsed.engine,
+                    "timings": parsed.timings,
+                    "resources": parsed.resources,
+                    "cache_age": parsed.cache_age
+                }
+            }
+            with deadline_scope(expires - time.monotonic()):
+                path = pipeline_service.choose_path(bool(screenshot_bytes))
+            yield {"type": "phase", "phase": "analyzing", "path": path}
+            
+            if path == "vision":
+                screenshot = await image_service.prepare_async(screenshot_bytes, "image/png")
+                analysis_events = openai_service.stream_website_screenshot(
+                    screenshot_base64=screenshot.base64,
+                    url=request.url,
+                    title=title,
+                    h1=h1,
+                    first_paragraph=first_paragraph,
+                    use_cache=not request.no_cache,
+                    mime_type=screenshot.mime_type,
+                    detail=screenshot.detail,
+                    details=parsed.details
+                )
+            else:
+                if path == "text" and need_screenshot:
+                    logger.warning("  ⚠ Скриншот недоступен, fallback на текстовый анализ")
+                analysis_events = openai_service.stream_parsed_content(
+                    title=title,
+                    h1=h1,
+                    paragraph=first_paragraph,
+                    use_cache=not request.no_cache,
+                    details=parsed.details
+                )
+            
+            async for event in analysis_events:
+                if event["type"] == "result":
+                    analysis = event["analysis"]
+                    await history_service.add_entry(
+                        request_type="parse",
+                        request_summary=f"URL: {request.url}",
+                        response_summary=analysis["summary"][:100] if analysis["summary"] else f"Title: {title or 'N/A'}",
+                        url=request.url
+                    )
+                    event = {
+                        "type": "result",
+                        "data": ParsedContent(
+                            url=request.url,
+                            title=title,
+                            h1=h1,
+                            first_paragraph=first_paragraph,
+                            details=parsed.details,
+                            analysis=analysis,
+                            engine=parsed.engine,
+                            timings=parsed.timings,
+                            resources=parsed.resources,
+                            cache_age=parsed.cache_age,
+                            analysis_path=path
+                        ).model_dump(),
+                        "cached": event["cached"]
+                    }
+                yield event
+        except Exception as e:
+            logger.error(f"  ❌ ОШИБКА: {e}")
+            yield {"type": "error", "error": str(e)}
+    
+    return ndjson_response(events(), http_request)
+
+
 @app.get("/history", response_model=HistoryResponse)
-async def get_history():
+async def get_history(request_type: Optional[str] = None, url: Optional[str] = None, limit: Optional[int] = None):
     """
-    Получить историю последних 10 запросов
+    Получить историю последних запросов (по умолчанию MAX_HISTORY_ITEMS),
+    с фильтром по типу запроса (text, image, parse) и URL
     """
     logger.info("📋 API: Получение истории")
-    items = history_service.get_history()
+    items = await history_service.get_history(request_type=request_type, url=url, limit=limit)
     logger.info(f"  Записей: {len(items)}")
     return HistoryResponse(
         items=items,
@@ -330,17 +693,208 @@ async def clear_history():
     Очистить историю запросов
     """
     logger.info("🗑️ API: Очистка истории")
-    history_service.clear_history()
+    await history_service.clear_history()
     logger.info("  ✓ История очищена")
     return {"success": True, "message": "История очищена"}
 
 
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Статистика кэша результатов анализа"""
+    return openai_service.cache_stats()
+
+
+@app.delete("/cache")
+async def clear_cache():
+    """Очистить кэш результатов анализа"""
+    logger.info("🗑️ API: Очистка кэша")
+    openai_service.clear_cache()
+    return {"success": True, "message": "Кэш очищен"}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики производительности: кэши, объединение запросов, лимиты API"""
+    return {
+        "cache": openai_service.cache_stats(),
+        "singleflight": singleflight.stats(),
+        "upstream": upstream_governor.stats(),
+        "images": image_service.stats(),
+        "structured": openai_service.structured_stats(),
+        "browser": browser_supervisor.stats(),
+        "readiness": browser_supervisor.worker_stats("readiness"),
+        "blocked_resources": browser_supervisor.worker_stats("blocked_resources"),
+        "http_fetch": {**http_fetcher.stats(), "engines": parser_service.engines.stats()},
+        "crawl": crawl_service.stats(),
+        "parse_cache": parse_cache.stats(),
+        "changes": change_detector.stats(),
+        "scheduler": scheduler_service.stats(),
+        "jobs": job_service.stats(),
+        "history": history_service.stats(),
+        "cancellation": {
+            **cancellation.stats(),
+            "parse_checkpoints": browser_supervisor.worker_stats("cancelled")
+        },
+        "deadline": {
+            "default": settings.request_deadline,
+            **pipeline_service.stats(),
+            "browser_cutoffs": browser_supervisor.deadline_cutoffs
+        }
+    }
+
+
+@app.get("/usage")
+async def get_usage(group_by: str = "endpoint", hours: float = 24):
+    """Расход токенов и время API за последние hours часов (group_by: hour, endpoint, competitor, model, cache_status)"""
+    if group_by not in GROUPINGS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестная группировка: {group_by}. Доступны: {', '.join(GROUPINGS)}"
+        )
+    return {
+        "group_by": group_by,
+        "hours": hours,
+        "rows": await usage_ledger.summary(group_by, hours),
+        "budgets": usage_ledger.budget_stats()
+    }
+
+
+@app.get("/usage/calls")
+async def get_usage_calls(limit: int = 100):
+    """Последние вызовы API из журнала"""
+    return {"calls": await usage_ledger.recent(min(max(limit, 1), 1000))}
+
+
 @app.get("/competitor_urls")
 async def get_competitor_urls():
     """Получить список URL конкурентов из конфигурации"""
     return {"urls": settings.competitor_urls}
 
 
+@app.post("/competitors/crawl")
+async def crawl_competitors(request: CrawlRequest, http_request: Request):
+    """
+    Параллельный парсинг и анализ всех сайтов конкурентов: ход обхода и результаты (NDJSON)
+    """
+    logger.info("🕸️ API: ОБХОД КОНКУРЕНТОВ")
+    
+    urls = [url.strip() for url in (request.urls or settings.competitor_urls) if url and url.strip()]
+    if not urls:
+        raise HTTPException(status_code=400, detail="Список URL пуст: передайте urls или задайте COMPETITOR_URLS")
+    if len(urls) > settings.batch_max_items:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком много URL: максимум {settings.batch_max_items}"
+        )
+    
+    return ndjson_response(crawl_service.crawl(
+        urls,
+        use_cache=not request.no_cache,
+        screenshot=request.screenshot,
+        browser_concurrency=request.browser_concurrency,
+        upstream_concurrency=request.upstream_concurrency,
+        max_age=request.max_age
+    ), http_request)
+
+
+@app.get("/schedules", response_model=List[ScheduleInfo])
+async def list_schedules():
+    """Расписания периодических проверок: следующий запуск и длительность последнего"""
+    return scheduler_service.list_schedules()
+
+
+@app.post("/schedules", response_model=ScheduleInfo)
+async def add_schedule(request: ScheduleCreate):
+    """Добавить расписание проверки URL (interval_seconds или cron)"""
+    try:
+        schedule = scheduler_service.add(
+            request.url,
+            interval_seconds=request.interval_seconds,
+            cron=request.cron,
+            screenshot=request.screenshot,
+            jitter_seconds=request.jitter_seconds,
+            catch_up=request.catch_up,
+            paused=request.paused
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return scheduler_service.info(schedule)
+
+
+def _schedule_or_404(schedule) -> ScheduleInfo:
+    if schedule is None:
+        raise HTTPException(status_code=404, detail="Расписание не найдено")
+    return scheduler_service.info(schedule)
+
+
+@app.post("/schedules/{schedule_id}/pause", response_model=ScheduleInfo)
+async def pause_schedule(schedule_id: str):
+    """Приостановить расписание"""
+    return _schedule_or_404(scheduler_service.set_paused(schedule_id, True))
+
+
+@app.post("/schedules/{schedule_id}/resume", response_model=ScheduleInfo)
+async def resume_schedule(schedule_id: str):
+    """Возобновить расписание"""
+    return _schedule_or_404(scheduler_service.set_paused(schedule_id, False))
+
+
+@app.post("/schedules/{schedule_id}/run", response_model=ScheduleInfo)
+async def trigger_schedule(schedule_id: str):
+    """Запустить проверку сейчас, вне расписания"""
+    return _schedule_or_404(scheduler_service.trigger(schedule_id))
+
+
+@app.delete("/schedules/{schedule_id}")
+async def delete_schedule(schedule_id: str):
+    """Удалить расписание"""
+    if not scheduler_service.delete(schedule_id):
+        raise HTTPException(status_code=404, detail="Расписание не найдено")
+    return {"success": True}
+
+
+@app.post("/jobs", response_model=JobInfo, status_code=202)
+async def create_job(request: ParseDemoRequest):
+    """Поставить парсинг и анализ URL в очередь; id задания возвращается сразу"""
+    if not job_service.enabled:
+        raise HTTPException(status_code=503, detail="Очередь заданий выключена (JOBS_ENABLED=false)")
+    job, deduplicated = await job_service.submit(
+        request.url,
+        use_cache=not request.no_cache,
+        screenshot=request.screenshot,
+        max_age=request.max_age
+    )
+    return job_info(job, deduplicated)
+
+
+async def _job_or_404(job_id: str, wait: float = 0, phase: Optional[str] = None):
+    if wait > 0:
+        job = await job_service.wait(job_id, wait, phase)
+    else:
+        job = await job_service.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str, wait: float = 0, phase: Optional[str] = None):
+    """
+    Статус, фаза и результат задания
+
+    wait > 0 — long-poll: ответ придёт, когда задание завершится (или сменится
+    фаза phase), но не позже wait сек (максимум JOBS_POLL_TIMEOUT).
+    """
+    return job_info(await _job_or_404(job_id, wait, phase))
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """События задания (SSE): phase при смене фазы, затем result или error"""
+    await _job_or_404(job_id)
+    return sse_response(job_service.watch(job_id))
+
+
 @app.get("/health")
 async def health_check():
     """Проверка работоспособности сервиса"""
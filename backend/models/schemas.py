@@ -2,7 +2,7 @@
 Pydantic схемы для API
 """
 from datetime import datetime
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 from pydantic import BaseModel, Field
 
 
@@ -11,11 +11,78 @@ from pydantic import BaseModel, Field
 class TextAnalysisRequest(BaseModel):
     """Запрос на анализ текста"""
     text: str = Field(..., min_length=10, description="Текст для анализа")
+    no_cache: bool = Field(False, description="Не использовать кэш, выполнить анализ заново")
+
+
+class TextBatchRequest(BaseModel):
+    """Запрос на пакетный анализ текстов"""
+    texts: List[str] = Field(..., min_length=1, description="Тексты для анализа")
+    no_cache: bool = Field(False, description="Не использовать кэш, выполнить анализ заново")
+    concurrency: Optional[int] = Field(None, ge=1, description="Сколько текстов анализировать параллельно")
+
+
+class CrawlRequest(BaseModel):
+    """Запрос на обход сайтов конкурентов"""
+    urls: Optional[List[str]] = Field(None, description="URL для обхода (по умолчанию COMPETITOR_URLS)")
+    no_cache: bool = Field(False, description="Не использовать кэш, выполнить анализ заново")
+    screenshot: Optional[bool] = Field(None, description="Делать скриншот для vision анализа (по умолчанию из настроек)")
+    browser_concurrency: Optional[int] = Field(None, ge=1, description="Сколько страниц загружать параллельно")
+    upstream_concurrency: Optional[int] = Field(None, ge=1, description="Сколько анализов выполнять параллельно")
+    max_age: Optional[int] = Field(
+        None, ge=0,
+        description="Допустимый возраст результата парсинга из кэша, сек (по умолчанию PARSE_CACHE_TTL, 0 — загрузить страницу заново)"
+    )
+
+
+class ScheduleCreate(BaseModel):
+    """Новое расписание проверки URL (interval_seconds или cron)"""
+    url: str = Field(..., description="URL для периодической проверки")
+    interval_seconds: Optional[int] = Field(None, description="Интервал между проверками, сек")
+    cron: Optional[str] = Field(None, description="cron-выражение из 5 полей, например '0 9 * * 1-5'")
+    screenshot: Optional[bool] = Field(None, description="Делать скриншот (по умолчанию из настроек)")
+    jitter_seconds: Optional[int] = Field(None, ge=0, description="Случайный разброс срока запуска, сек")
+    catch_up: str = Field("once", description="Пропущенные при простое запуски: once — выполнить один раз, skip — пропустить")
+    paused: bool = False
+
+
+class ScheduleInfo(BaseModel):
+    """Расписание и статистика его запусков"""
+    id: str
+    url: str
+    interval_seconds: Optional[int] = None
+    cron: Optional[str] = None
+    screenshot: Optional[bool] = None
+    jitter_seconds: int = 0
+    catch_up: str = "once"
+    paused: bool = False
+    running: bool = False
+    created_at: Optional[str] = None
+    next_run: Optional[str] = None
+    last_run: Optional[str] = None
+    last_duration: Optional[float] = Field(None, description="Длительность последней проверки, сек")
+    last_status: Optional[str] = Field(None, description="ok или error")
+    last_error: Optional[str] = None
+    last_change: Optional[str] = Field(None, description="Результат определения изменений: new, changed, unchanged")
+    runs: int = 0
+    failures: int = 0
 
 
 class ParseDemoRequest(BaseModel):
     """Запрос на парсинг URL"""
     url: str = Field(..., description="URL для парсинга")
+    no_cache: bool = Field(False, description="Не использовать кэш, выполнить анализ заново")
+    screenshot: Optional[bool] = Field(
+        None,
+        description="Делать скриншот для vision анализа (по умолчанию из настроек); без скриншота страница может загрузиться по HTTP без браузера"
+    )
+    max_age: Optional[int] = Field(
+        None, ge=0,
+        description="Допустимый возраст результата парсинга из кэша, сек (по умолчанию PARSE_CACHE_TTL, 0 — загрузить страницу заново)"
+    )
+    deadline: Optional[float] = Field(
+        None, gt=0,
+        description="Бюджет времени /parse_demo, сек (вместо заголовка X-Request-Timeout; по умолчанию REQUEST_DEADLINE)"
+    )
 
 
 # === Ответы ===
@@ -42,14 +109,72 @@ class ImageAnalysis(BaseModel):
     recommendations: List[str] = Field(default_factory=list, description="Рекомендации")
 
 
+class PageHeading(BaseModel):
+    """Заголовок страницы (h1-h6)"""
+    level: int
+    text: str
+
+
+class PageLink(BaseModel):
+    """Кнопка или ссылка призыва к действию"""
+    text: str
+    href: Optional[str] = None
+
+
+class PageDetails(BaseModel):
+    """Расширенные данные страницы для анализа"""
+    meta_description: Optional[str] = None
+    headings: List[PageHeading] = Field(default_factory=list, description="Структура заголовков")
+    paragraphs: List[str] = Field(default_factory=list, description="Первые содержательные абзацы")
+    ctas: List[PageLink] = Field(default_factory=list, description="Кнопки и ссылки призыва к действию")
+    og_tags: Dict[str, str] = Field(default_factory=dict, description="OpenGraph теги")
+    price_samples: List[str] = Field(default_factory=list, description="Фрагменты текста с ценами")
+
+
+class ChangeReport(BaseModel):
+    """Изменения страницы с момента последнего анализа"""
+    status: str = Field(..., description="new, changed или unchanged")
+    changed_fields: List[str] = Field(default_factory=list, description="Изменившиеся поля контента и screenshot")
+    text_change: Optional[float] = Field(None, description="Доля изменившегося текста, 0–1")
+    visual_distance: Optional[int] = Field(None, description="Расстояние Хэмминга между хэшами скриншотов")
+    analyzed_at: Optional[str] = Field(None, description="Когда была проанализирована прошлая версия")
+    analysis_reused: bool = False
+
+
 class ParsedContent(BaseModel):
     """Результат парсинга страницы"""
     url: str
     title: Optional[str] = None
     h1: Optional[str] = None
     first_paragraph: Optional[str] = None
+    details: Optional[PageDetails] = None
     analysis: Optional[CompetitorAnalysis] = None
     error: Optional[str] = None
+    engine: Optional[str] = Field(None, description="Чем загружена страница: http или chrome")
+    timings: Optional[Dict[str, float]] = Field(default=None, description="Время этапов парсинга и сигналов готовности, сек")
+    resources: Optional[Dict[str, Any]] = Field(default=None, description="Профиль блокировки и статистика запросов страницы (chrome)")
+    cache_age: Optional[float] = Field(default=None, description="Возраст результата парсинга из кэша, сек (None — страница загружена сейчас)")
+    change: Optional[ChangeReport] = Field(default=None, description="Изменения с прошлого анализа")
+    analysis_path: Optional[str] = Field(
+        default=None,
+        description="Как получен анализ: vision, text, text_fallback (vision не укладывался в бюджет времени) или reused"
+    )
+
+
+class JobInfo(BaseModel):
+    """Асинхронное задание на парсинг и анализ URL"""
+    id: str
+    url: str
+    status: str = Field(..., description="queued, running, done или failed")
+    phase: str = Field(..., description="Фаза выполнения: queued, parsing, analyzing, done, failed")
+    attempts: int = 0
+    created_at: Optional[str] = None
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    duration: Optional[float] = Field(None, description="Время выполнения, сек")
+    deduplicated: bool = Field(False, description="Возвращено существующее задание с теми же параметрами")
+    result: Optional[ParsedContent] = None
+    error: Optional[str] = None
 
 
 class TextAnalysisResponse(BaseModel):
@@ -82,6 +207,9 @@ class HistoryItem(BaseModel):
     request_type: str  # "text", "image", "parse"
     request_summary: str
     response_summary: str
+    url: Optional[str] = None
+    # ID записи, повтором которой является эта (одинаковые тексты в пакете)
+    duplicate_of: Optional[str] = None
 
 
 class HistoryResponse(BaseModel):
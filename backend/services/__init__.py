@@ -1,4 +1,22 @@
-from .openai_service import OpenAIService
-from .parser_service import ParserService
-from .history_service import HistoryService
+"""
+Сервисы приложения
 
+Модули сервисов создают глобальные экземпляры при импорте (база журнала,
+пул соединений, история), поэтому пакет их не импортирует: процессы-исполнители
+браузеров загружают только нужные им модули. Классы ниже доступны лениво.
+"""
+import importlib
+
+_EXPORTS = {
+    "OpenAIService": ".openai_service",
+    "ParserService": ".parser_service",
+    "HistoryService": ".history_service",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
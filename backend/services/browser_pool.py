@@ -0,0 +1,331 @@
+"""
+Пул заранее запущенных Chrome драйверов для парсера
+
+Драйверы переиспользуются между запросами: после каждой страницы состояние
+сбрасывается (вкладки, cookies, storage), а драйвер перезапускается после
+заданного числа страниц или при превышении лимита памяти. Пул создаётся
+внутри процесса-исполнителя (см. browser_supervisor), не в процессе API.
+"""
+import os
+import queue
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.chrome.options import Options
+from webdriver_manager.chrome import ChromeDriverManager
+
+from backend.config import settings
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.browser")
+
+
+def process_tree_pids(root_pid: int) -> List[int]:
+    """PID процесса и всех его потомков (только Linux; иначе — пустой список)"""
+    if not os.path.isdir("/proc"):
+        return []
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Имя процесса в скобках может содержать пробелы — берём поля после ")"
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = []
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+def process_tree_rss_mb(root_pid: int) -> Optional[float]:
+    """Суммарная память (RSS) процесса и всех его потомков, МБ (только Linux)"""
+    pids = process_tree_pids(root_pid)
+    if not pids:
+        return None
+    total_kb = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except (OSError, ValueError):
+            continue
+    return total_kb / 1024
+
+
+class PooledDriver:
+    """Драйвер из пула и его счётчики"""
+
+    def __init__(self, driver: webdriver.Chrome):
+        self.driver = driver
+        self.pages = 0
+        self.created_at = time.time()
+
+    @property
+    def pid(self) -> Optional[int]:
+        process = getattr(self.driver.service, "process", None)
+        return process.pid if process else None
+
+    def rss_mb(self) -> Optional[float]:
+        pid = self.pid
+        return process_tree_rss_mb(pid) if pid else None
+
+
+class BrowserPool:
+    """Пул Chrome драйверов фиксированного размера"""
+
+    def __init__(self, size: Optional[int] = None):
+        self.size = max(1, size if size is not None else settings.browser_pool_size)
+        logger.info("=" * 50)
+        logger.info("Инициализация пула браузеров")
+        logger.info(f"  Размер: {self.size}")
+        logger.info(f"  Перезапуск: после {settings.browser_max_pages} страниц или {settings.browser_max_rss_mb} МБ")
+
+        self._idle: "queue.LifoQueue[PooledDriver]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._resolve_lock = threading.Lock()
+        self._driver_path: Optional[str] = None
+        self._alive = 0
+        self._closed = False
+
+        self.launches = 0
+        self.launch_seconds = 0.0
+        self.reused = 0
+        self.health_failures = 0
+        self.recycled: Dict[str, int] = {"pages": 0, "memory": 0, "reset_failed": 0}
+
+        logger.info("Пул браузеров инициализирован ✓")
+        logger.info("=" * 50)
+
+    def _resolve_driver_path(self) -> str:
+        """Путь к ChromeDriver — определяется один раз за время работы"""
+        with self._resolve_lock:
+            if self._driver_path is None:
+                logger.info("  📥 Загрузка ChromeDriver...")
+                start_time = time.time()
+                self._driver_path = ChromeDriverManager().install()
+                logger.info(f"  ✓ ChromeDriver: {self._driver_path} ({time.time() - start_time:.2f} сек)")
+            return self._driver_path
+
+    def _launch(self) -> PooledDriver:
+        """Запустить новый экземпляр Chrome"""
+        logger.info("  🌐 Создание Chrome драйвера...")
+        start_time = time.time()
+
+        options = Options()
+        # driver.get() возвращается после DOMContentLoaded, дальше ждёт движок готовности
+        options.page_load_strategy = "eager"
+        options.add_argument('--headless=new')
+        options.add_argument('--no-sandbox')
+        options.add_argument('--disable-dev-shm-usage')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--window-size=1920,1080')
+        options.add_argument(f'--user-agent={settings.parser_user_agent}')
+        options.add_argument('--disable-blink-features=AutomationControlled')
+        options.add_experimental_option('excludeSwitches', ['enable-automation'])
+        options.add_experimental_option('useAutomationExtension', False)
+        # Облегчённый профиль: без фоновых сервисов Chrome, расширений и автовоспроизведения
+        options.add_argument('--disable-extensions')
+        options.add_argument('--disable-background-networking')
+        options.add_argument('--disable-component-update')
+        options.add_argument('--disable-default-apps')
+        options.add_argument('--disable-sync')
+        options.add_argument('--no-first-run')
+        options.add_argument('--mute-audio')
+        options.add_argument('--autoplay-policy=user-gesture-required')
+        # Performance-лог нужен для статистики заблокированных запросов
+        options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+
+        service = Service(self._resolve_driver_path())
+        driver = webdriver.Chrome(service=service, options=options)
+
+        elapsed = time.time() - start_time
+        with self._lock:
+            self.launches += 1
+            self.launch_seconds += elapsed
+        logger.info(f"  ✓ Chrome драйвер создан за {elapsed:.2f} сек")
+        return PooledDriver(driver)
+
+    def _quit(self, pooled: PooledDriver):
+        with self._lock:
+            self._alive -= 1
+        try:
+            pooled.driver.quit()
+        except Exception as e:
+            logger.warning(f"  Ошибка при закрытии драйвера: {e}")
+
+    def _is_healthy(self, pooled: PooledDriver) -> bool:
+        """Драйвер отвечает на команды"""
+        try:
+            pooled.driver.execute_script("return 1")
+            return True
+        except Exception as e:
+            logger.warning(f"  ⚠ Драйвер не отвечает, будет заменён: {str(e)[:100]}")
+            with self._lock:
+                self.health_failures += 1
+            return False
+
+    def _reset(self, pooled: PooledDriver):
+        """Очистить состояние после страницы: лишние вкладки, storage, cookies"""
+        driver = pooled.driver
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        origin = driver.execute_script("return window.location.origin")
+        if origin and origin.startswith("http"):
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        driver.get("about:blank")
+
+    def _recycle_reason(self, pooled: PooledDriver) -> Optional[str]:
+        if pooled.pages >= settings.browser_max_pages:
+            return "pages"
+        rss = pooled.rss_mb()
+        if rss is not None and rss >= settings.browser_max_rss_mb:
+            logger.info(f"  Память браузера: {rss:.0f} МБ")
+            return "memory"
+        return None
+
+    def acquire(self) -> PooledDriver:
+        """Взять драйвер из пула (или запустить новый, если пул ещё не заполнен)"""
+        deadline = time.time() + settings.browser_acquire_timeout
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_launch = self._alive < self.size
+                    if can_launch:
+                        self._alive += 1
+                if can_launch:
+                    try:
+                        return self._launch()
+                    except Exception:
+                        with self._lock:
+                            self._alive -= 1
+                        raise
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Нет свободного браузера в пуле")
+                try:
+                    pooled = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    raise TimeoutError("Нет свободного браузера в пуле")
+
+            if self._is_healthy(pooled):
+                with self._lock:
+                    self.reused += 1
+                logger.info(f"  ♻️ Драйвер из пула (страниц: {pooled.pages})")
+                return pooled
+            self._quit(pooled)
+
+    def release(self, pooled: PooledDriver):
+        """Вернуть драйвер в пул, сбросив состояние, или закрыть его"""
+        pooled.pages += 1
+        if self._closed:
+            self._quit(pooled)
+            return
+
+        reason = self._recycle_reason(pooled)
+        if reason is None:
+            try:
+                self._reset(pooled)
+            except Exception as e:
+                logger.warning(f"  ⚠ Не удалось сбросить состояние драйвера: {str(e)[:100]}")
+                reason = "reset_failed"
+
+        if reason is not None:
+            logger.info(f"  🔄 Перезапуск драйвера ({reason}, страниц: {pooled.pages})")
+            with self._lock:
+                self.recycled[reason] += 1
+            self._quit(pooled)
+            if settings.browser_pool_prelaunch:
+                # Замену запускаем в фоне, чтобы следующий запрос не ждал старта Chrome
+                threading.Thread(target=self._replenish, daemon=True).start()
+            return
+
+        self._idle.put(pooled)
+
+    def _replenish(self):
+        """Запустить драйвер на место закрытого и положить его в пул"""
+        with self._lock:
+            if self._closed or self._alive >= self.size:
+                return
+            self._alive += 1
+        try:
+            pooled = self._launch()
+        except Exception as e:
+            with self._lock:
+                self._alive -= 1
+            logger.warning(f"  ⚠ Не удалось запустить браузер на замену: {e}")
+            return
+        if self._closed:
+            self._quit(pooled)
+            return
+        self._idle.put(pooled)
+
+    @contextmanager
+    def driver(self) -> Iterator[webdriver.Chrome]:
+        """Драйвер на время одного парсинга"""
+        pooled = self.acquire()
+        try:
+            yield pooled.driver
+        finally:
+            self.release(pooled)
+
+    def prelaunch(self):
+        """Заранее запустить драйверы, чтобы первые запросы не ждали запуска Chrome"""
+        count = self.size if settings.browser_pool_prelaunch else 0
+        if count == 0:
+            return
+        logger.info(f"🔥 Запуск {count} браузеров заранее...")
+        launched = []
+        try:
+            for _ in range(count):
+                launched.append(self.acquire())
+        except Exception as e:
+            logger.warning(f"  ⚠ Не удалось запустить браузер заранее: {e}")
+        for pooled in launched:
+            pooled.pages -= 1
+            self.release(pooled)
+        logger.info(f"  ✓ Готово браузеров: {len(launched)}")
+
+    def close(self):
+        """Закрыть все драйверы пула"""
+        self._closed = True
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(pooled)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "alive": self._alive,
+            "idle": self._idle.qsize(),
+            "launches": self.launches,
+            "avg_launch_seconds": round(self.launch_seconds / self.launches, 2) if self.launches else None,
+            "reused": self.reused,
+            "health_failures": self.health_failures,
+            "recycled": dict(self.recycled)
+        }
+
@@ -0,0 +1,539 @@
+"""
+Супервизор процессов-исполнителей с браузерами
+
+Chrome работает не в потоках процесса API, а в отдельных процессах
+(browser_worker): зависший или упавший браузер не блокирует сервер.
+Задание, превысившее BROWSER_JOB_TIMEOUT, завершается убийством всего
+дерева процессов исполнителя; исполнитель, превысивший лимит памяти или
+аварийно завершившийся, перезапускается. Фоновый сборщик находит и
+завершает осиротевшие chrome/chromedriver процессы прошлых запусков.
+
+В режиме BROWSER_MODE=tabs у исполнителя несколько слотов (вкладок одного
+Chrome): задания идут параллельно, а супервизор раздаёт слоты, а не процессы.
+По тайм-ауту задания исполнитель сам закрывает только его вкладку, и слот
+возвращается в пул; исполнитель убивается, лишь если и после этого ответа нет
+(Chrome перестал отвечать по CDP).
+
+Если ожидающий результата запрос отменён (клиент отключился), супервизор
+поднимает флаг отмены слота: исполнитель прерывает задание на ближайшей
+контрольной точке и освобождает браузер, слот возвращается в пул.
+
+Остаток бюджета запроса (deadline) передаётся исполнителю вместе с заданием.
+Если ответа к дедлайну нет, запрос получает ошибку сразу, а задание
+останавливается тем же флагом отмены — исполнитель не убивается.
+"""
+import asyncio
+import functools
+import multiprocessing
+import os
+import signal
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from backend.config import settings
+from backend.services.browser_pool import process_tree_pids, process_tree_rss_mb
+from backend.services.browser_worker import OWNER_ENV, WORKER_ENV, ParseResult, worker_main
+from backend.services.cancellation import cancellation
+from backend.services.deadline import bounded, remaining
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.supervisor")
+
+# Запас сверх бюджета запроса на передачу результата из исполнителя, сек
+DEADLINE_GRACE = 0.5
+# Режим tabs: сколько ждать ответа после тайм-аута, пока исполнитель закрывает вкладку, сек
+TAB_ABORT_GRACE = 15.0
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_marker(pid: int) -> Optional[Dict[str, int]]:
+    """Пометки владельца из окружения процесса (None — процесс не наш)"""
+    try:
+        with open(f"/proc/{pid}/environ", "rb") as f:
+            environ = f.read().split(b"\0")
+    except OSError:
+        return None
+    marker = {}
+    for item in environ:
+        key, _, value = item.partition(b"=")
+        if key in (OWNER_ENV.encode(), WORKER_ENV.encode()) and value.isdigit():
+            marker[key.decode()] = int(value)
+    return marker if OWNER_ENV in marker else None
+
+
+def kill_tree(root_pid: int) -> int:
+    """Принудительно завершить процесс и всех его потомков; возвращает число процессов"""
+    # Сначала потомки (chrome, chromedriver), затем сам процесс
+    pids = process_tree_pids(root_pid) or [root_pid]
+    killed = 0
+    for pid in reversed(pids):
+        try:
+            os.kill(pid, signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM)
+            killed += 1
+        except OSError:
+            continue
+    return killed
+
+
+def reap_orphans(live_workers: List[int]) -> int:
+    """Завершить помеченные браузерные процессы, чей владелец или исполнитель уже не работает"""
+    if not os.path.isdir("/proc"):
+        return 0
+    own_pid = os.getpid()
+    reaped = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        if pid == own_pid or pid in live_workers:
+            continue
+        marker = _read_marker(pid)
+        if marker is None:
+            continue
+        owner = marker[OWNER_ENV]
+        worker = marker.get(WORKER_ENV)
+        orphaned = not _pid_alive(owner) if owner != own_pid else worker not in live_workers
+        if not orphaned:
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+            reaped += 1
+        except OSError:
+            continue
+    if reaped:
+        logger.info(f"🧹 Завершено осиротевших браузерных процессов: {reaped}")
+    return reaped
+
+
+class WorkerProcess:
+    """Процесс-исполнитель, его слоты и счётчики"""
+
+    def __init__(self, process, conns: list, cancels: list):
+        self.process = process
+        self.slots = [WorkerSlot(self, conn, cancel) for conn, cancel in zip(conns, cancels)]
+        self.started_at = time.time()
+        self.jobs = 0
+        self.busy = 0
+        # Выведен из работы: новые задания не получает, заменяется после завершения текущих
+        self.retired = False
+        self.replacing = False
+        self.last_snapshot: Optional[dict] = None
+        # Память дерева процессов исполнителя на одно одновременное задание, МБ
+        self.memory_per_parse: Optional[float] = None
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+
+class WorkerSlot:
+    """Канал для одного одновременного задания исполнителя"""
+
+    def __init__(self, worker: WorkerProcess, conn, cancel):
+        self.worker = worker
+        self.conn = conn
+        # Флаг отмены текущего задания (multiprocessing.Event, общий с исполнителем)
+        self.cancel = cancel
+
+
+class BrowserSupervisor:
+    """Пул процессов-исполнителей: тайм-ауты заданий, лимит памяти, перезапуск, сборка сирот"""
+
+    def __init__(self):
+        logger.info("=" * 50)
+        logger.info("Инициализация супервизора браузеров")
+
+        self.mode = settings.browser_mode
+        if self.mode not in ("pool", "tabs"):
+            logger.warning(f"  ⚠ Неизвестный BROWSER_MODE={self.mode}, используется pool")
+            self.mode = "pool"
+        self.size = max(1, settings.browser_pool_size)
+        self.slots_per_worker = max(1, settings.browser_tabs_per_worker) if self.mode == "tabs" else 1
+        self.job_timeout = settings.browser_job_timeout
+        self.max_rss_mb = settings.browser_tabs_max_rss_mb if self.mode == "tabs" else settings.browser_worker_max_rss_mb
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: Dict[int, WorkerProcess] = {}
+        self._idle: Optional[asyncio.Queue] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._reaper_task: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+        self._closed = False
+        # Ожидание ответа исполнителя занимает поток на всё задание — свои потоки,
+        # чтобы зависшие браузеры не заняли общий пул asyncio.to_thread (история, кэши, журнал).
+        # Запас вдвое: слоты выводимого исполнителя ещё ждут, пока запускается замена
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.size * self.slots_per_worker * 2 + self.size,
+            thread_name_prefix="browser-supervisor"
+        )
+
+        self.jobs = 0
+        self.timeouts = 0
+        # Режим tabs: тайм-ауты, после которых закрыта только вкладка
+        self.tab_timeouts = 0
+        self.crashes = 0
+        self.memory_kills = 0
+        self.restarts = 0
+        self.reaped = 0
+        self.cancelled = 0
+        # Ответ исполнителя не пришёл к дедлайну запроса
+        self.deadline_cutoffs = 0
+        # Время от отмены до возврата слота в пул, сек
+        self.cancel_released = 0
+        self.cancel_release_seconds = 0.0
+
+        logger.info(f"  Режим: {self.mode}, исполнителей: {self.size}, слотов в исполнителе: {self.slots_per_worker}")
+        logger.info(f"  Тайм-аут задания: {self.job_timeout} сек, лимит памяти: {self.max_rss_mb} МБ")
+        logger.info("Супервизор браузеров инициализирован ✓")
+        logger.info("=" * 50)
+
+    @property
+    def capacity(self) -> int:
+        """Сколько страниц может загружаться одновременно"""
+        return self.size * self.slots_per_worker
+
+    async def _blocking(self, fn: Callable[..., Any], *args) -> Any:
+        """Выполнить блокирующий вызов в потоках супервизора"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    # === Процессы ===
+
+    def _spawn(self) -> WorkerProcess:
+        pipes = [self._context.Pipe() for _ in range(self.slots_per_worker)]
+        cancels = [self._context.Event() for _ in range(self.slots_per_worker)]
+        process = self._context.Process(
+            target=worker_main,
+            args=([child for _, child in pipes], cancels, os.getpid()),
+            name="browser-worker",
+            daemon=True
+        )
+        process.start()
+        for _, child in pipes:
+            child.close()
+        conns = [parent for parent, _ in pipes]
+
+        # Ждём, пока исполнитель импортирует модули и запустит Chrome
+        deadline = time.time() + settings.browser_worker_start_timeout
+        for conn in conns:
+            ready = conn.poll(max(0.0, deadline - time.time())) and conn.recv() == "ready"
+            if not ready:
+                kill_tree(process.pid)
+                process.join(timeout=5)
+                for parent in conns:
+                    parent.close()
+                raise RuntimeError(f"исполнитель не запустился за {settings.browser_worker_start_timeout} сек")
+
+        worker = WorkerProcess(process, conns, cancels)
+        self._workers[worker.pid] = worker
+        logger.info(f"  🧩 Исполнитель запущен (pid {worker.pid}, слотов: {len(conns)})")
+        return worker
+
+    def _terminate(self, worker: WorkerProcess):
+        """Убить исполнителя вместе с его браузерами"""
+        self._workers.pop(worker.pid, None)
+        killed = kill_tree(worker.pid)
+        try:
+            worker.process.kill()
+        except Exception:
+            pass
+        worker.process.join(timeout=5)
+        for slot in worker.slots:
+            slot.conn.close()
+        logger.info(f"  ☠️ Исполнитель {worker.pid} завершён (процессов: {killed})")
+
+    def _in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _retire(self, worker: WorkerProcess, reason: str, drain: bool = False):
+        """
+        Вывести исполнителя из работы и заменить в фоне — ответ клиенту не ждёт запуска
+
+        drain=True — дождаться текущих заданий других слотов (превышение памяти),
+        иначе процесс убивается сразу (тайм-аут, авария).
+        """
+        if not worker.retired:
+            worker.retired = True
+            self.restarts += 1
+            logger.warning(f"  🔄 Перезапуск исполнителя {worker.pid}: {reason}")
+        if (drain and worker.busy) or worker.replacing:
+            return
+        worker.replacing = True
+        self._in_background(self._replace(worker))
+
+    async def _replace(self, worker: WorkerProcess):
+        await self._blocking(self._terminate, worker)
+        # После аварии браузеры исполнителя могли остаться без родителя
+        self.reaped += await self._blocking(reap_orphans, list(self._workers))
+        await self._respawn()
+
+    async def _respawn(self):
+        """Запустить исполнителя, повторяя попытки до успеха"""
+        while not self._closed:
+            try:
+                worker = await self._blocking(self._spawn)
+                for slot in worker.slots:
+                    self._idle.put_nowait(slot)
+                return
+            except Exception as e:
+                logger.error(f"  ✗ Не удалось запустить исполнителя: {e}")
+                await asyncio.sleep(5)
+
+    async def start(self):
+        """Запустить исполнителей и сборщик сирот (повторный вызов ничего не делает)"""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._idle is not None:
+                return
+            self.reaped += await self._blocking(reap_orphans, [])
+            self._idle = asyncio.Queue()
+            workers = await asyncio.gather(
+                *(self._blocking(self._spawn) for _ in range(self.size)), return_exceptions=True
+            )
+            for worker in workers:
+                if isinstance(worker, Exception):
+                    logger.error(f"  ✗ Не удалось запустить исполнителя: {worker}")
+                    self._in_background(self._respawn())
+                    continue
+                for slot in worker.slots:
+                    self._idle.put_nowait(slot)
+            self._reaper_task = asyncio.create_task(self._reaper())
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(settings.browser_reaper_interval)
+            try:
+                self.reaped += await self._blocking(reap_orphans, list(self._workers))
+            except Exception as e:
+                logger.warning(f"  ⚠ Сборщик сирот: {e}")
+
+    # === Задания ===
+
+    async def _acquire(self) -> Optional[WorkerSlot]:
+        """Свободный слот работающего исполнителя (None — не дождались)"""
+        deadline = time.time() + bounded(settings.browser_acquire_timeout)
+        while True:
+            try:
+                slot = await asyncio.wait_for(self._idle.get(), timeout=max(0.0, deadline - time.time()))
+            except asyncio.TimeoutError:
+                return None
+            # Слоты выведенного из работы исполнителя в очереди просто пропускаем
+            if not slot.worker.retired:
+                return slot
+
+    async def _receive(self, slot: WorkerSlot, timeout: float):
+        """Дождаться ответа исполнителя, не блокируя event loop и общий пул потоков"""
+        ready = await self._blocking(slot.conn.poll, timeout)
+        if not ready:
+            raise TimeoutError
+        return slot.conn.recv()
+
+    def _measure(self, worker: WorkerProcess) -> Optional[float]:
+        """Память дерева процессов исполнителя; обновляет долю на одно задание"""
+        rss = process_tree_rss_mb(worker.pid)
+        if rss is not None:
+            per_parse = rss / max(1, worker.busy)
+            previous = worker.memory_per_parse
+            worker.memory_per_parse = per_parse if previous is None else previous * 0.7 + per_parse * 0.3
+        return rss
+
+    async def _finish(self, slot: WorkerSlot, deadline: float) -> Optional[ParseResult]:
+        """Получить результат задания и вернуть слот в пул (или заменить исполнителя)"""
+        worker = slot.worker
+        try:
+            result, snapshot = await self._receive(slot, max(0.0, deadline - time.time()))
+        except TimeoutError:
+            if self.mode == "tabs" and not worker.retired:
+                # Исполнитель закрывает вкладку сам — остальные задания Chrome не теряют
+                self.timeouts += 1
+                logger.error(f"  ✗ Задание превысило {self.job_timeout} сек, вкладка исполнителя {worker.pid} закрывается")
+                self._in_background(self._recover_tab(slot))
+                return ParseResult(error="Превышено время ожидания загрузки страницы")
+            worker.busy -= 1
+            if not worker.retired:
+                self.timeouts += 1
+                logger.error(f"  ✗ Задание превысило {self.job_timeout} сек, исполнитель {worker.pid} будет убит")
+            self._retire(worker, "timeout")
+            return ParseResult(error="Превышено время ожидания загрузки страницы")
+        except (EOFError, OSError) as e:
+            worker.busy -= 1
+            if not worker.retired:
+                self.crashes += 1
+                logger.error(f"  ✗ Исполнитель {worker.pid} аварийно завершился: {type(e).__name__}")
+            self._retire(worker, "crash")
+            return ParseResult(error="Браузер аварийно завершил работу")
+
+        worker.jobs += 1
+        worker.last_snapshot = snapshot
+        rss = await self._blocking(self._measure, worker)
+        worker.busy -= 1
+        if rss is not None and rss >= self.max_rss_mb and not worker.retired:
+            self.memory_kills += 1
+            self._retire(worker, f"память {rss:.0f} МБ", drain=True)
+        if worker.retired:
+            # Последнее задание выведенного исполнителя завершено — можно заменять
+            self._retire(worker, "drained", drain=True)
+        else:
+            self._idle.put_nowait(slot)
+        return result
+
+    async def _recover_tab(self, slot: WorkerSlot):
+        """Дождаться ответа слота после закрытия вкладки; нет ответа — Chrome завис, исполнитель заменяется"""
+        worker = slot.worker
+        try:
+            await self._receive(slot, TAB_ABORT_GRACE)
+        except (TimeoutError, EOFError, OSError):
+            worker.busy -= 1
+            logger.error(f"  ✗ Исполнитель {worker.pid} не закрыл вкладку, Chrome не отвечает")
+            self._retire(worker, "timeout")
+            return
+        worker.busy -= 1
+        self.tab_timeouts += 1
+        if worker.retired:
+            self._retire(worker, "drained", drain=True)
+        else:
+            self._idle.put_nowait(slot)
+
+    async def parse(self, url: str, screenshot: bool) -> ParseResult:
+        """Распарсить страницу в свободном слоте исполнителя"""
+        await self.start()
+        slot = await self._acquire()
+        if slot is None:
+            if remaining() == 0:
+                return ParseResult(error="Бюджет времени запроса исчерпан в ожидании браузера")
+            return ParseResult(error="Нет свободного браузера, попробуйте позже")
+
+        worker = slot.worker
+        worker.busy += 1
+        self.jobs += 1
+        deadline = time.time() + self.job_timeout
+        # Флаг сбрасывает только супервизор: отмена, поднятая сразу после отправки, не потеряется
+        slot.cancel.clear()
+        budget = remaining()
+        try:
+            slot.conn.send((url, screenshot, budget))
+        except (OSError, ValueError):
+            worker.busy -= 1
+            if not worker.retired:
+                self.crashes += 1
+            self._retire(worker, "crash")
+            return ParseResult(error="Браузер аварийно завершил работу")
+
+        finish = asyncio.ensure_future(self._finish(slot, deadline))
+        try:
+            if budget is None:
+                return await asyncio.shield(finish)
+            # Исполнитель сам укладывается в бюджет; запас — на передачу результата
+            return await asyncio.wait_for(asyncio.shield(finish), timeout=budget + DEADLINE_GRACE)
+        except asyncio.TimeoutError:
+            slot.cancel.set()
+            self.deadline_cutoffs += 1
+            logger.warning(f"  ⏱️ Браузер не уложился в бюджет запроса ({budget:.1f} сек): {url}")
+            self._in_background(self._drain_cancelled(finish, time.time()))
+            return ParseResult(error="Бюджет времени запроса исчерпан при загрузке страницы")
+        except asyncio.CancelledError:
+            # Клиент ушёл: исполнитель остановится на ближайшей контрольной точке,
+            # а слот вернётся в пул, когда придёт его ответ
+            slot.cancel.set()
+            self.cancelled += 1
+            cancellation.count("parses")
+            self._in_background(self._drain_cancelled(finish, time.time()))
+            raise
+
+    async def _drain_cancelled(self, finish: asyncio.Future, cancelled_at: float):
+        await finish
+        self.cancel_released += 1
+        self.cancel_release_seconds += time.time() - cancelled_at
+
+    # === Жизненный цикл ===
+
+    async def close(self):
+        """Остановить исполнителей; не успевших — убить вместе с браузерами"""
+        self._closed = True
+        if self._reaper_task:
+            self._reaper_task.cancel()
+        for task in self._background:
+            task.cancel()
+        workers = list(self._workers.values())
+        for worker in workers:
+            for slot in worker.slots:
+                try:
+                    slot.conn.send(None)
+                except (OSError, ValueError):
+                    pass
+
+        def stop(worker: WorkerProcess):
+            worker.process.join(timeout=settings.browser_shutdown_timeout)
+            if worker.process.is_alive():
+                self._terminate(worker)
+
+        await asyncio.gather(*(self._blocking(stop, worker) for worker in workers))
+        self._workers.clear()
+        await self._blocking(reap_orphans, [])
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        workers = []
+        for worker in list(self._workers.values()):
+            snapshot = worker.last_snapshot or {}
+            workers.append({
+                "pid": worker.pid,
+                "jobs": worker.jobs,
+                "busy": worker.busy,
+                "uptime": round(time.time() - worker.started_at, 1),
+                "rss_mb": process_tree_rss_mb(worker.pid),
+                "memory_per_parse_mb": round(worker.memory_per_parse, 1) if worker.memory_per_parse else None,
+                "pool": snapshot.get("pool"),
+                "tabs": snapshot.get("tabs")
+            })
+        per_parse = [w["memory_per_parse_mb"] for w in workers if w["memory_per_parse_mb"]]
+        return {
+            "mode": self.mode,
+            "size": self.size,
+            "capacity": self.capacity,
+            "idle": sum(len(w.slots) - w.busy for w in self._workers.values() if not w.retired),
+            "jobs": self.jobs,
+            "timeouts": self.timeouts,
+            "tab_timeouts": self.tab_timeouts,
+            "crashes": self.crashes,
+            "memory_kills": self.memory_kills,
+            "restarts": self.restarts,
+            "reaped": self.reaped,
+            "cancelled": self.cancelled,
+            "deadline_cutoffs": self.deadline_cutoffs,
+            "avg_cancel_release_seconds": round(self.cancel_release_seconds / self.cancel_released, 2) if self.cancel_released else None,
+            "memory_per_parse_mb": round(sum(per_parse) / len(per_parse), 1) if per_parse else None,
+            "workers": workers
+        }
+
+    def worker_stats(self, name: str) -> dict:
+        """Статистика сервиса из последнего снимка исполнителей (readiness, blocked_resources)"""
+        snapshots = [w.last_snapshot[name] for w in self._workers.values() if w.last_snapshot]
+        if not snapshots:
+            return {}
+        if name == "readiness":
+            return snapshots[-1]
+        # Счётчики суммируются по всем исполнителям
+        merged = dict(snapshots[0])
+        for snapshot in snapshots[1:]:
+            for key, value in snapshot.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+# Глобальный экземпляр
+logger.info("Создание глобального экземпляра супервизора браузеров...")
+browser_supervisor = BrowserSupervisor()
@@ -0,0 +1,482 @@
+"""
+Параллельный парсинг во вкладках одного Chrome (режим BROWSER_MODE=tabs)
+
+Процесс-исполнитель запускает один Chrome и управляет им напрямую по CDP
+через websocket: каждое задание получает отдельный контекст браузера
+(свои cookies, storage и кэш, как у окна инкогнито) и вкладку в нём.
+Контекст удаляется сразу после парсинга, поэтому задания изолированы,
+а памяти на одно задание уходит на порядок меньше, чем на отдельный Chrome.
+
+Задание, не уложившееся в BROWSER_JOB_TIMEOUT, теряет только свою вкладку:
+её контекст закрывается по CDP, а ждущие ответа команды этой вкладки
+завершаются ошибкой. Остальные вкладки того же Chrome продолжают работу.
+
+CdpTab повторяет ту часть интерфейса WebDriver, которой пользуются
+readiness, resource_blocker и page_extract, — парсинг страницы одинаков
+в обоих режимах.
+"""
+import base64
+import itertools
+import json
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import httpx
+import websocket
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+
+from backend.config import settings
+from backend.services.browser_pool import BrowserPool, PooledDriver
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.tabs")
+
+# Тайм-аут одной CDP команды, сек
+CDP_TIMEOUT = 30.0
+VIEWPORT = {"width": 1920, "height": 1080, "deviceScaleFactor": 1, "mobile": False}
+
+
+class CdpConnection:
+    """Соединение с браузером по CDP: команды из любых потоков, события по сессиям"""
+
+    def __init__(self, ws_url: str):
+        self._ws = websocket.create_connection(ws_url, timeout=CDP_TIMEOUT, suppress_origin=True)
+        # Чтение блокируется до прихода сообщения, тайм-ауты — на ожидании ответа
+        self._ws.settimeout(None)
+        self._ids = itertools.count(1)
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, dict] = {}
+        self._waiters: Dict[int, threading.Event] = {}
+        # Сессия (вкладка) каждой ожидающей команды — чтобы прервать команды закрытой вкладки
+        self._sessions: Dict[int, str] = {}
+        self._listeners: Dict[str, Callable[[str, dict], None]] = {}
+        self.closed = False
+        self._reader = threading.Thread(target=self._read_loop, name="cdp-reader", daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        try:
+            while True:
+                message = json.loads(self._ws.recv())
+                if "id" in message:
+                    waiter = self._waiters.pop(message["id"], None)
+                    self._sessions.pop(message["id"], None)
+                    if waiter is not None:
+                        self._pending[message["id"]] = message
+                        waiter.set()
+                    continue
+                listener = self._listeners.get(message.get("sessionId"))
+                if listener is not None:
+                    listener(message.get("method"), message.get("params", {}))
+        except Exception as e:
+            if not self.closed:
+                logger.error(f"  ✗ CDP соединение с браузером потеряно: {type(e).__name__}")
+        finally:
+            self.closed = True
+            # Разбудить всех, кто ждёт ответа
+            for waiter in list(self._waiters.values()):
+                waiter.set()
+
+    def call(self, method: str, params: Optional[dict] = None, session_id: Optional[str] = None,
+             timeout: float = CDP_TIMEOUT) -> dict:
+        """Выполнить команду и дождаться ответа"""
+        if self.closed:
+            raise WebDriverException("CDP соединение с браузером закрыто")
+        message_id = next(self._ids)
+        message: Dict[str, Any] = {"id": message_id, "method": method, "params": params or {}}
+        waiter = threading.Event()
+        if session_id:
+            message["sessionId"] = session_id
+            self._sessions[message_id] = session_id
+        self._waiters[message_id] = waiter
+        with self._send_lock:
+            self._ws.send(json.dumps(message))
+        if not waiter.wait(timeout):
+            self._waiters.pop(message_id, None)
+            self._sessions.pop(message_id, None)
+            raise TimeoutException(f"CDP {method}: нет ответа за {timeout:.0f} сек")
+        response = self._pending.pop(message_id, None)
+        if response is None:
+            raise WebDriverException("CDP соединение с браузером закрыто")
+        if "error" in response:
+            raise WebDriverException(f"CDP {method}: {response['error'].get('message')}")
+        return response.get("result", {})
+
+    def send(self, method: str, params: Optional[dict] = None, session_id: Optional[str] = None):
+        """Отправить команду, не дожидаясь ответа (из обработчика событий, где ждать нельзя)"""
+        if self.closed:
+            return
+        message: Dict[str, Any] = {"id": next(self._ids), "method": method, "params": params or {}}
+        if session_id:
+            message["sessionId"] = session_id
+        try:
+            with self._send_lock:
+                self._ws.send(json.dumps(message))
+        except Exception as e:
+            logger.warning(f"  ⚠ CDP {method} не отправлена: {type(e).__name__}")
+
+    def subscribe(self, session_id: str, listener: Callable[[str, dict], None]):
+        self._listeners[session_id] = listener
+
+    def unsubscribe(self, session_id: str):
+        self._listeners.pop(session_id, None)
+
+    def fail_session(self, session_id: str, reason: str):
+        """Завершить ошибкой все команды сессии, ждущие ответа (вкладка закрыта)"""
+        for message_id, owner in list(self._sessions.items()):
+            if owner != session_id:
+                continue
+            self._sessions.pop(message_id, None)
+            waiter = self._waiters.pop(message_id, None)
+            if waiter is not None:
+                self._pending[message_id] = {"error": {"message": reason}}
+                waiter.set()
+
+    def close(self):
+        self.closed = True
+        try:
+            self._ws.close()
+        except Exception:
+            pass
+
+
+class FetchBlocker:
+    """
+    Блокировка запросов по типу ресурса (Image, Font, Media) через домен Fetch
+
+    Network.setBlockedURLs видит только URL, а картинки с CDN часто отдаются
+    без расширения. Fetch останавливает запросы нужных типов ещё до отправки,
+    и они завершаются ошибкой BlockedByClient.
+    """
+
+    def __init__(self, connection: CdpConnection, session_id: str):
+        self.connection = connection
+        self.session_id = session_id
+        self.types: frozenset = frozenset()
+
+    def set_types(self, types: List[str]):
+        types = frozenset(types)
+        if types == self.types:
+            return
+        # Типы меняются до команды: остановленный сразу после неё запрос уже увидит новый набор
+        previous, self.types = self.types, types
+        try:
+            if types:
+                patterns = [{"urlPattern": "*", "resourceType": t, "requestStage": "Request"} for t in sorted(types)]
+                self.connection.call("Fetch.enable", {"patterns": patterns}, session_id=self.session_id)
+            else:
+                self.connection.call("Fetch.disable", {}, session_id=self.session_id)
+        except Exception:
+            self.types = previous
+            raise
+
+    def on_event(self, method: str, params: dict) -> bool:
+        """Ответить на остановленный запрос; True — событие обработано"""
+        if method != "Fetch.requestPaused":
+            return False
+        # Вызывается из потока чтения CDP, поэтому ответ без ожидания
+        if params.get("resourceType") in self.types:
+            self.connection.send(
+                "Fetch.failRequest", {"requestId": params["requestId"], "errorReason": "BlockedByClient"}, self.session_id
+            )
+        else:
+            self.connection.send("Fetch.continueRequest", {"requestId": params["requestId"]}, self.session_id)
+        return True
+
+
+class PageSession:
+    """
+    Своя CDP-сессия к вкладке WebDriver (режим pool) для блокировки по типу ресурса
+
+    chromedriver не передаёт события CDP, без которых Fetch не работает, поэтому
+    к той же вкладке подключается второй клиент. Вкладка драйвера пула одна
+    на всё время его жизни (пул закрывает лишние между страницами), сессия тоже.
+    """
+
+    def __init__(self, driver):
+        address = driver.capabilities["goog:chromeOptions"]["debuggerAddress"]
+        ws_url = httpx.get(f"http://{address}/json/version", timeout=10).json()["webSocketDebuggerUrl"]
+        self.connection = CdpConnection(ws_url)
+        try:
+            # Дескриптор окна chromedriver — это targetId вкладки
+            session_id = self.connection.call(
+                "Target.attachToTarget", {"targetId": driver.current_window_handle, "flatten": True}
+            )["sessionId"]
+        except Exception:
+            self.connection.close()
+            raise
+        self.blocker = FetchBlocker(self.connection, session_id)
+        self.connection.subscribe(session_id, self.blocker.on_event)
+
+    @property
+    def closed(self) -> bool:
+        return self.connection.closed
+
+    def close(self):
+        self.connection.close()
+
+
+class CdpTab:
+    """Вкладка в отдельном контексте браузера с интерфейсом, совместимым с WebDriver"""
+
+    def __init__(self, connection: CdpConnection, session_id: str, cancelled: Optional[Callable[[], bool]] = None):
+        self.connection = connection
+        self.session_id = session_id
+        self.cancelled = cancelled or (lambda: False)
+        self.page_load_timeout = float(settings.parser_timeout)
+        self._log: List[dict] = []
+        self._log_lock = threading.Lock()
+        self._loaded = threading.Event()
+        # Вкладка закрыта по тайм-ауту задания: новые команды сразу завершаются ошибкой
+        self.aborted = False
+        self.blocker = FetchBlocker(connection, session_id)
+        connection.subscribe(session_id, self._on_event)
+
+    def _on_event(self, method: str, params: dict):
+        if self.blocker.on_event(method, params):
+            return
+        if method.startswith("Network."):
+            # Тот же формат, что у performance-лога chromedriver
+            with self._log_lock:
+                self._log.append({"message": json.dumps({"message": {"method": method, "params": params}})})
+        elif method == "Page.domContentEventFired":
+            self._loaded.set()
+
+    def _cdp(self, method: str, params: Optional[dict] = None) -> dict:
+        if self.aborted:
+            raise TimeoutException("Вкладка закрыта по тайм-ауту задания")
+        return self.connection.call(method, params, session_id=self.session_id)
+
+    # === Интерфейс WebDriver ===
+
+    def set_page_load_timeout(self, seconds: float):
+        self.page_load_timeout = float(seconds)
+
+    def execute_cdp_cmd(self, cmd: str, params: dict) -> dict:
+        return self._cdp(cmd, params)
+
+    def block_resource_types(self, types: List[str]):
+        """Блокировать запросы ресурсов этих типов CDP (Image, Font, Media)"""
+        if self.aborted:
+            raise TimeoutException("Вкладка закрыта по тайм-ауту задания")
+        self.blocker.set_types(types)
+
+    def get(self, url: str):
+        """
+        Открыть URL и дождаться DOMContentLoaded (как page_load_strategy=eager)
+
+        Если задание отменено, загрузка останавливается и get() возвращается сразу.
+        """
+        self._loaded.clear()
+        result = self._cdp("Page.navigate", {"url": url})
+        if result.get("errorText"):
+            raise WebDriverException(f"unknown error: {result['errorText']}")
+        deadline = time.time() + self.page_load_timeout
+        while not self._loaded.wait(min(0.2, max(0.0, deadline - time.time()))):
+            if self.aborted:
+                raise TimeoutException("Вкладка закрыта по тайм-ауту задания")
+            if self.cancelled():
+                self._cdp("Page.stopLoading")
+                return
+            if time.time() >= deadline:
+                raise TimeoutException(f"Страница не загрузилась за {self.page_load_timeout:.0f} сек")
+
+    def execute_script(self, script: str, *args) -> Any:
+        # Тело скрипта WebDriver: аргументы в arguments[], результат через return
+        expression = f"(function() {{\n{script}\n}}).apply(null, {json.dumps(list(args))})"
+        result = self._cdp("Runtime.evaluate", {"expression": expression, "returnByValue": True})
+        if "exceptionDetails" in result:
+            details = result["exceptionDetails"]
+            text = details.get("exception", {}).get("description") or details.get("text")
+            raise WebDriverException(f"javascript error: {text}")
+        return result.get("result", {}).get("value")
+
+    def find_element(self, by: str, value: str) -> bool:
+        """Наличие элемента по тегу (достаточно для ожидания body)"""
+        if by != By.TAG_NAME:
+            raise WebDriverException(f"CdpTab поддерживает поиск только по тегу, не {by}")
+        if not self.execute_script("return document.getElementsByTagName(arguments[0]).length > 0", value):
+            raise NoSuchElementException(f"Элемент {value} не найден")
+        return True
+
+    def get_log(self, log_type: str) -> List[dict]:
+        """Накопленные сетевые события вкладки (лог очищается)"""
+        with self._log_lock:
+            entries, self._log = self._log, []
+        return entries
+
+    def get_screenshot_as_png(self) -> bytes:
+        return base64.b64decode(self._cdp("Page.captureScreenshot", {"format": "png"})["data"])
+
+    def js_heap_mb(self) -> Optional[float]:
+        """Используемая JS-куча страницы, МБ"""
+        try:
+            metrics = self._cdp("Performance.getMetrics")["metrics"]
+        except Exception:
+            return None
+        for metric in metrics:
+            if metric["name"] == "JSHeapUsedSize":
+                return round(metric["value"] / 1024 / 1024, 1)
+        return None
+
+
+class TabBrowser:
+    """Один Chrome и изолированные вкладки для параллельных заданий"""
+
+    def __init__(self, pool: BrowserPool):
+        self.pool = pool
+        self.pooled: Optional[PooledDriver] = None
+        self.connection: Optional[CdpConnection] = None
+        self._lock = threading.Lock()
+
+        self.active = 0
+        self.peak_active = 0
+        self.contexts = 0
+        self.cleanup_failures = 0
+        # Вкладки, закрытые по тайм-ауту задания
+        self.timeouts = 0
+        # Память Chrome в расчёте на одну одновременную вкладку, МБ
+        self.rss_per_tab: List[float] = []
+        self.js_heap: List[float] = []
+
+    @property
+    def broken(self) -> bool:
+        return self.connection is None or self.connection.closed
+
+    def start(self):
+        """Запустить Chrome через пул и подключиться к нему по CDP"""
+        self.pooled = self.pool.acquire()
+        address = self.pooled.driver.capabilities["goog:chromeOptions"]["debuggerAddress"]
+        ws_url = httpx.get(f"http://{address}/json/version", timeout=10).json()["webSocketDebuggerUrl"]
+        self.connection = CdpConnection(ws_url)
+        logger.info(f"  🗂️ Режим вкладок: Chrome {address}")
+
+    @staticmethod
+    def _close(connection: CdpConnection, target_id: Optional[str], context_id: str):
+        if target_id:
+            connection.call("Target.closeTarget", {"targetId": target_id}, timeout=5)
+        connection.call("Target.disposeBrowserContext", {"browserContextId": context_id}, timeout=5)
+
+    def _abort(self, tab: CdpTab, target_id: str, context_id: str, state: dict):
+        """
+        Закрыть вкладку, превысившую тайм-аут задания, вместе с её контекстом
+
+        Зависшие команды вкладки (например, Runtime.evaluate с бесконечным
+        скриптом) завершаются ошибкой, и поток задания возвращает результат.
+        Если Chrome не отвечает и на закрытие, соединение разрывается — исполнитель
+        завершится, и супервизор запустит новый.
+        """
+        with self._lock:
+            if state["done"]:
+                return
+            state["aborted"] = True
+            self.timeouts += 1
+        tab.aborted = True
+        connection = tab.connection
+        logger.warning(f"  ⏱️ Задание во вкладке превысило {settings.browser_job_timeout} сек, вкладка закрывается")
+        try:
+            self._close(connection, target_id, context_id)
+        except Exception as e:
+            logger.error(f"  ✗ Chrome не закрыл вкладку: {str(e)[:100]}")
+            connection.close()
+        connection.unsubscribe(tab.session_id)
+        connection.fail_session(tab.session_id, "Вкладка закрыта по тайм-ауту задания")
+
+    @contextmanager
+    def open_tab(
+        self,
+        cancelled: Optional[Callable[[], bool]] = None,
+        timeout: Optional[float] = None
+    ) -> Iterator[CdpTab]:
+        """
+        Вкладка в новом контексте браузера; контекст удаляется вместе с cookies и storage
+
+        timeout — через сколько секунд закрыть вкладку, если задание ещё не завершилось.
+        """
+        connection = self.connection
+        context_id = connection.call("Target.createBrowserContext", {"disposeOnDetach": True})["browserContextId"]
+        target_id = None
+        session_id = None
+        state = {"done": False, "aborted": False}
+        watchdog = None
+        try:
+            target_id = connection.call(
+                "Target.createTarget", {"url": "about:blank", "browserContextId": context_id}
+            )["targetId"]
+            session_id = connection.call(
+                "Target.attachToTarget", {"targetId": target_id, "flatten": True}
+            )["sessionId"]
+            tab = CdpTab(connection, session_id, cancelled)
+            if timeout is not None:
+                watchdog = threading.Timer(timeout, self._abort, args=(tab, target_id, context_id, state))
+                watchdog.daemon = True
+                watchdog.start()
+            tab.execute_cdp_cmd("Page.enable", {})
+            tab.execute_cdp_cmd("Performance.enable", {})
+            tab.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", VIEWPORT)
+            with self._lock:
+                self.contexts += 1
+                self.active += 1
+                self.peak_active = max(self.peak_active, self.active)
+            try:
+                yield tab
+            finally:
+                with self._lock:
+                    self.active -= 1
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            with self._lock:
+                state["done"] = True
+            # Если вкладка закрыта по тайм-ауту, контекст уже удалил _abort
+            if not state["aborted"]:
+                if session_id:
+                    connection.unsubscribe(session_id)
+                try:
+                    self._close(connection, target_id, context_id)
+                except Exception as e:
+                    logger.warning(f"  ⚠ Контекст вкладки не удалён: {str(e)[:100]}")
+                    with self._lock:
+                        self.cleanup_failures += 1
+
+    def memory(self, tab: CdpTab) -> dict:
+        """Память Chrome и её доля на одну одновременную вкладку"""
+        rss = self.pooled.rss_mb()
+        heap = tab.js_heap_mb()
+        with self._lock:
+            active = max(1, self.active)
+            per_tab = round(rss / active, 1) if rss is not None else None
+            if per_tab is not None:
+                self.rss_per_tab = (self.rss_per_tab + [per_tab])[-100:]
+            if heap is not None:
+                self.js_heap = (self.js_heap + [heap])[-100:]
+        return {
+            "browser_rss_mb": rss,
+            "tabs_active": active,
+            "rss_per_tab_mb": per_tab,
+            "js_heap_mb": heap
+        }
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        if self.pooled is not None:
+            self.pool.close()
+            self.pool.release(self.pooled)
+            self.pooled = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": self.active,
+                "peak_active": self.peak_active,
+                "contexts": self.contexts,
+                "cleanup_failures": self.cleanup_failures,
+                "timeouts": self.timeouts,
+                "avg_rss_per_tab_mb": round(sum(self.rss_per_tab) / len(self.rss_per_tab), 1) if self.rss_per_tab else None,
+                "avg_js_heap_mb": round(sum(self.js_heap) / len(self.js_heap), 1) if self.js_heap else None
+            }
@@ -0,0 +1,356 @@
+"""
+Процесс-исполнитель браузерного парсинга
+
+Запускается супервизором (browser_supervisor) через multiprocessing: держит
+свой Chrome, получает задания (url, screenshot, budget) по каналам слотов и отвечает
+ParseResult вместе со снимком статистики. Слот один (режим pool) или
+BROWSER_TABS_PER_WORKER (режим tabs — задания идут параллельно во вкладках).
+У каждого слота есть флаг отмены: супервизор поднимает его, когда клиент
+ушёл, и задание прерывается на ближайшей контрольной точке.
+Все chrome/chromedriver процессы исполнителя наследуют переменные окружения
+с PID владельца — по ним супервизор находит и завершает осиротевшие браузеры.
+"""
+import os
+import signal
+import threading
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from backend.config import settings
+from backend.models.schemas import PageDetails
+from backend.services.page_extract import extract_in_browser, details_from_payload
+from backend.services.browser_pool import BrowserPool
+from backend.services.browser_tabs import TabBrowser
+from backend.services.readiness import readiness_engine
+from backend.services.resource_blocker import resource_blocker
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.parser")
+
+# Переменные окружения, которыми помечены процессы браузеров
+OWNER_ENV = "COMPETITOR_MONITOR_OWNER"
+WORKER_ENV = "COMPETITOR_MONITOR_WORKER"
+
+# Запас бюджета запроса на извлечение данных и скриншот, сек
+BUDGET_RESERVE = 1.0
+
+# Отменённые задания по контрольным точкам, на которых они остановлены
+_cancelled: Dict[str, int] = {}
+_cancelled_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """Задание отменено супервизором (клиент отключился)"""
+
+
+@dataclass
+class ParseResult:
+    """Результат парсинга страницы"""
+    title: Optional[str] = None
+    h1: Optional[str] = None
+    first_paragraph: Optional[str] = None
+    screenshot: Optional[bytes] = None
+    error: Optional[str] = None
+    details: Optional[PageDetails] = None
+    # Время этапов, сек: загрузка, сигналы готовности, скриншот, итого
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Чем загружена страница: http (без браузера) или chrome
+    engine: str = "chrome"
+    not_modified: bool = False
+    # Профиль блокировки ресурсов и статистика запросов страницы (только chrome)
+    resources: Optional[dict] = None
+    # Возраст результата из кэша парсинга, сек (None — страница загружена сейчас)
+    cache_age: Optional[float] = None
+
+
+def result_from_payload(payload: dict, **kwargs) -> ParseResult:
+    """ParseResult из payload извлечения (браузерного или lxml)"""
+    paragraphs = payload.get("paragraphs") or []
+    return ParseResult(
+        title=payload.get("title") or None,
+        h1=payload.get("h1"),
+        first_paragraph=paragraphs[0] if paragraphs else None,
+        details=details_from_payload(payload),
+        **kwargs
+    )
+
+
+def log_result(result: ParseResult):
+    """Вывести в лог извлечённые данные страницы"""
+    logger.info(f"  📌 Title: {result.title[:60] if result.title else 'N/A'}...")
+    logger.info(f"  📌 H1: {result.h1[:60] if result.h1 else 'N/A'}...")
+    logger.info(f"  📌 Первый абзац: {result.first_paragraph[:60] if result.first_paragraph else 'N/A'}...")
+    if result.details:
+        details = result.details
+        logger.info(
+            f"  📌 Заголовков: {len(details.headings)}, CTA: {len(details.ctas)}, "
+            f"OG: {len(details.og_tags)}, цен: {len(details.price_samples)}"
+        )
+
+
+def load_page(
+    driver,
+    url: str,
+    screenshot: bool,
+    memory: Callable[[], dict],
+    cancelled: Callable[[], bool] = lambda: False,
+    budget: Optional[float] = None
+) -> ParseResult:
+    """
+    Загрузить страницу в драйвере (WebDriver или вкладка CdpTab) и извлечь данные
+
+    Без скриншота страница грузится с профилем "text" (без изображений и шрифтов),
+    со скриншотом — с профилем "visual" (блокируются только трекеры и медиа).
+    memory() возвращает память браузера для поля resources; cancelled()
+    проверяется перед загрузкой, после неё, во время ожидания готовности
+    и перед скриншотом.
+
+    budget — остаток бюджета запроса, сек: загрузка, ожидание body и готовности
+    делят его между собой (каждая — не дольше PARSER_TIMEOUT), на извлечение
+    данных и скриншот оставляется BUDGET_RESERVE.
+    """
+    profile = "visual" if screenshot else "text"
+    logger.info("=" * 50)
+    logger.info(f"🔍 ПАРСИНГ САЙТА: {url} (профиль {profile})")
+
+    total_start = time.time()
+
+    def checkpoint(stage: str):
+        if cancelled():
+            raise JobCancelled(stage)
+
+    def left() -> Optional[float]:
+        if budget is None:
+            return None
+        return budget - (time.time() - total_start) - BUDGET_RESERVE
+
+    def stage_timeout() -> float:
+        if budget is None:
+            return settings.parser_timeout
+        return max(0.5, min(settings.parser_timeout, left()))
+
+    try:
+        checkpoint("start")
+        driver.set_page_load_timeout(stage_timeout())
+        resource_blocker.apply(driver, profile)
+
+        # Переходим на страницу
+        logger.info(f"  📄 Загрузка страницы...")
+        page_start = time.time()
+        driver.get(url)
+        page_elapsed = time.time() - page_start
+        checkpoint("page_load")
+        logger.info(f"  ✓ Страница загружена за {page_elapsed:.2f} сек")
+
+        # Ждём загрузки body
+        logger.info("  ⏳ Ожидание body элемента...")
+        WebDriverWait(driver, stage_timeout()).until(
+            EC.presence_of_element_located((By.TAG_NAME, "body"))
+        )
+        logger.info("  ✓ Body элемент найден")
+
+        # Ждём готовности страницы по сигналам (readyState, контент, затишье DOM и сети)
+        logger.info("  ⏳ Ожидание готовности страницы...")
+        timings = {"page_load": round(page_elapsed, 3)}
+        timings.update(readiness_engine.wait(driver, url, cancelled, left()))
+        checkpoint("readiness")
+
+        # Извлекаем все данные страницы одним запросом к браузеру
+        extract_start = time.time()
+        payload = extract_in_browser(driver)
+        timings["extract"] = round(time.time() - extract_start, 3)
+
+        result = result_from_payload(payload, timings=timings)
+        log_result(result)
+
+        if screenshot:
+            checkpoint("screenshot")
+            # Делаем скриншот
+            logger.info("  📸 Создание скриншота...")
+            screenshot_start = time.time()
+            result.screenshot = driver.get_screenshot_as_png()
+            screenshot_elapsed = time.time() - screenshot_start
+            timings["screenshot"] = round(screenshot_elapsed, 3)
+            screenshot_size_kb = len(result.screenshot) / 1024
+            logger.info(f"  ✓ Скриншот создан за {screenshot_elapsed:.2f} сек ({screenshot_size_kb:.1f} KB)")
+
+        resources = resource_blocker.collect(driver)
+        resources["profile"] = profile
+        resources.update(memory())
+        result.resources = resources
+        logger.info(
+            f"  🚫 Заблокировано запросов: {resources['blocked']} из {resources['requests']}, "
+            f"сэкономлено ~{resources['bytes_saved_estimate'] / 1024:.0f} KB"
+        )
+
+        total_elapsed = time.time() - total_start
+        timings["total"] = round(total_elapsed, 3)
+        logger.info(f"  ✅ ПАРСИНГ ЗАВЕРШЁН за {total_elapsed:.2f} сек")
+        logger.info("=" * 50)
+
+        return result
+
+    except JobCancelled as e:
+        stage = str(e)
+        with _cancelled_lock:
+            _cancelled[stage] = _cancelled.get(stage, 0) + 1
+        logger.info(f"  ⏹️ Задание отменено ({stage}) через {time.time() - total_start:.2f} сек")
+        logger.info("=" * 50)
+        return ParseResult(error=f"Задание отменено: клиент отключился ({stage})")
+
+    except TimeoutException:
+        total_elapsed = time.time() - total_start
+        logger.error(f"  ✗ TIMEOUT за {total_elapsed:.2f} сек")
+        logger.error("=" * 50)
+        if budget is not None and left() <= 0:
+            return ParseResult(error="Бюджет времени запроса исчерпан при загрузке страницы")
+        return ParseResult(error="Превышено время ожидания загрузки страницы")
+
+    except WebDriverException as e:
+        total_elapsed = time.time() - total_start
+        error_msg = str(e)
+        logger.error(f"  ✗ WebDriver ошибка за {total_elapsed:.2f} сек")
+        logger.error(f"  Детали: {error_msg[:200]}")
+        logger.error("=" * 50)
+
+        if 'net::ERR_NAME_NOT_RESOLVED' in error_msg:
+            return ParseResult(error="Не удалось найти сайт по указанному адресу")
+        elif 'net::ERR_CONNECTION_REFUSED' in error_msg:
+            return ParseResult(error="Соединение отклонено сервером")
+        elif 'net::ERR_CONNECTION_TIMED_OUT' in error_msg:
+            return ParseResult(error="Превышено время ожидания соединения")
+        else:
+            return ParseResult(error=f"Ошибка браузера: {error_msg[:200]}")
+
+    except Exception as e:
+        total_elapsed = time.time() - total_start
+        logger.error(f"  ✗ Неизвестная ошибка за {total_elapsed:.2f} сек: {e}")
+        logger.error("=" * 50)
+        return ParseResult(error=f"Ошибка при загрузке страницы: {str(e)[:200]}")
+
+
+def parse_page(
+    pool: BrowserPool,
+    url: str,
+    screenshot: bool = True,
+    cancelled: Callable[[], bool] = lambda: False,
+    budget: Optional[float] = None
+) -> ParseResult:
+    """Синхронный парсинг URL в браузере из пула (режим pool)"""
+    try:
+        # Берём уже запущенный драйвер из пула вместо запуска Chrome
+        pooled = pool.acquire()
+    except Exception as e:
+        logger.error(f"  ✗ Браузер недоступен: {e}")
+        return ParseResult(error=f"Ошибка при загрузке страницы: {str(e)[:200]}")
+    try:
+        return load_page(pooled.driver, url, screenshot, lambda: {"browser_rss_mb": pooled.rss_mb()}, cancelled, budget)
+    finally:
+        pool.release(pooled)
+
+
+def parse_in_tab(
+    tabs: TabBrowser,
+    url: str,
+    screenshot: bool = True,
+    cancelled: Callable[[], bool] = lambda: False,
+    budget: Optional[float] = None
+) -> ParseResult:
+    """
+    Синхронный парсинг URL в отдельной вкладке общего Chrome (режим tabs)
+
+    Вкладка, не уложившаяся в BROWSER_JOB_TIMEOUT, закрывается — Chrome и
+    остальные вкладки исполнителя продолжают работу.
+    """
+    try:
+        with tabs.open_tab(cancelled, settings.browser_job_timeout) as tab:
+            return load_page(tab, url, screenshot, lambda: tabs.memory(tab), cancelled, budget)
+    except Exception as e:
+        logger.error(f"  ✗ Не удалось открыть вкладку: {e}")
+        return ParseResult(error=f"Ошибка при загрузке страницы: {str(e)[:200]}")
+
+
+def snapshot(pool: BrowserPool, tabs: Optional[TabBrowser] = None) -> dict:
+    """Статистика процесса-исполнителя для метрик супервизора"""
+    return {
+        "pool": pool.stats(),
+        "tabs": tabs.stats() if tabs else None,
+        "readiness": readiness_engine.stats(),
+        "blocked_resources": resource_blocker.stats(),
+        "cancelled": dict(_cancelled)
+    }
+
+
+def _serve(
+    conn,
+    cancel,
+    parse: Callable[[str, bool, Callable[[], bool], Optional[float]], ParseResult],
+    stats: Callable[[], dict],
+    tabs: Optional[TabBrowser]
+):
+    """Обслуживать задания одного слота до закрытия канала (cancel — флаг отмены слота)"""
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        url, screenshot, budget = job
+        result = parse(url, screenshot, cancel.is_set, budget)
+        conn.send((result, stats()))
+        if tabs is not None and tabs.broken:
+            # Chrome потерян — все вкладки исполнителя бесполезны, супервизор запустит новый
+            logger.error("  ✗ Браузер исполнителя недоступен, завершение процесса")
+            os._exit(1)
+
+
+def worker_main(conns: List, cancels: List, owner_pid: int):
+    """
+    Цикл процесса-исполнителя: задание -> (ParseResult, статистика)
+
+    cancels — флаги отмены слотов (multiprocessing.Event), по одному на канал.
+
+    В режиме pool исполнитель держит один Chrome на один слот (conns из
+    одного канала), в режиме tabs — один Chrome на все слоты, по вкладке на задание.
+    """
+    # Ctrl+C получает процесс API, исполнителей он завершает сам
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ[OWNER_ENV] = str(owner_pid)
+    os.environ[WORKER_ENV] = str(os.getpid())
+
+    pool = BrowserPool(size=1)
+    tabs = None
+    if settings.browser_mode == "tabs":
+        tabs = TabBrowser(pool)
+        tabs.start()
+        parse = lambda url, screenshot, cancelled, budget: parse_in_tab(tabs, url, screenshot, cancelled, budget)
+    else:
+        pool.prelaunch()
+        parse = lambda url, screenshot, cancelled, budget: parse_page(pool, url, screenshot, cancelled, budget)
+    stats = lambda: snapshot(pool, tabs)
+
+    try:
+        # Время запуска не засчитывается в тайм-аут первого задания
+        for conn in conns:
+            conn.send("ready")
+        threads = [
+            threading.Thread(target=_serve, args=(conn, cancel, parse, stats, tabs), name=f"slot-{i}", daemon=True)
+            for i, (conn, cancel) in enumerate(zip(conns, cancels))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if tabs is not None:
+            tabs.close()
+        else:
+            pool.close()
@@ -0,0 +1,360 @@
+"""
+Кэш результатов анализа: LRU в памяти + файловое хранилище на диске
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import unicodedata
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+from backend.config import settings
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.cache")
+
+
+def normalize_text(text: str) -> str:
+    """Нормализовать текст для ключа кэша (Unicode NFKC, схлопнутые пробелы)"""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def make_cache_key(*parts: Any) -> str:
+    """Построить ключ кэша как SHA-256 от компонентов"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """Двухуровневый кэш: LRU в памяти и JSON-файлы на диске с TTL"""
+
+    def __init__(
+        self,
+        namespace: str,
+        directory: Optional[str] = None,
+        memory_items: Optional[int] = None,
+        disk_max_bytes: Optional[int] = None,
+        ttl_seconds: Optional[int] = None
+    ):
+        self.namespace = namespace
+        self.directory = Path(directory or settings.cache_dir) / namespace
+        self.memory_items = memory_items if memory_items is not None else settings.cache_memory_items
+        self.disk_max_bytes = disk_max_bytes if disk_max_bytes is not None else settings.cache_disk_max_mb * 1024 * 1024
+        self.ttl = ttl_seconds if ttl_seconds is not None else settings.cache_ttl_seconds
+
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._disk_index: Dict[str, int] = {}
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan_disk()
+
+        logger.info(f"  Кэш '{namespace}': {len(self._disk_index)} записей на диске ({self._disk_bytes / 1024:.1f} KB)")
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _scan_disk(self):
+        """Построить индекс файлов на диске"""
+        for path in self.directory.glob("*/*.json"):
+            try:
+                size = path.stat().st_size
+            except OSError:
+                continue
+            self._disk_index[path.stem] = size
+            self._disk_bytes += size
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _remember(self, key: str, created: float, value: Any):
+        """Положить запись в LRU память"""
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        try:
+            record = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return None
+
+        if self._expired(record.get("created", 0)):
+            self._delete_disk(key)
+            return None
+
+        # Обновляем mtime — по нему вытесняются давно не использованные записи
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return record["created"], record["value"]
+
+    def _write_disk(self, key: str, created: float, value: Any):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({"created": created, "value": value}, ensure_ascii=False, default=str)
+
+        # Атомарная запись через временный файл
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, path)
+
+        size = len(data.encode("utf-8"))
+        with self._lock:
+            self._disk_bytes += size - self._disk_index.get(key, 0)
+            self._disk_index[key] = size
+
+        self._evict_disk()
+
+    def _delete_disk(self, key: str):
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+        with self._lock:
+            self._disk_bytes -= self._disk_index.pop(key, 0)
+
+    def _evict_disk(self):
+        """Вытеснить самые старые по доступу файлы, пока не уложимся в лимит"""
+        if self._disk_bytes <= self.disk_max_bytes:
+            return
+
+        entries = []
+        for key in list(self._disk_index):
+            try:
+                entries.append((self._path(key).stat().st_mtime, key))
+            except OSError:
+                self._delete_disk(key)
+        entries.sort()
+
+        for _, key in entries:
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            self._delete_disk(key)
+            self.evictions += 1
+        logger.debug(f"Кэш '{self.namespace}': вытеснение, на диске {self._disk_bytes / 1024:.1f} KB")
+
+    def get_memory(self, key: str) -> Optional[Any]:
+        """Быстрый поиск только в памяти"""
+        with self._lock:
+            record = self._memory.get(key)
+            if record is None:
+                return None
+            if self._expired(record[0]):
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+        self.hits_memory += 1
+        return record[1]
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Найти значение в памяти, затем на диске"""
+        value = self.get_memory(key)
+        if value is not None:
+            return value
+
+        record = None
+        if key in self._disk_index:
+            record = await asyncio.to_thread(self._read_disk, key)
+
+        if record is None:
+            self.misses += 1
+            return None
+
+        self.hits_disk += 1
+        self._remember(key, *record)
+        return record[1]
+
+    async def set(self, key: str, value: Any):
+        """Сохранить значение в обоих уровнях"""
+        created = time.time()
+        self._remember(key, created, value)
+        try:
+            await asyncio.to_thread(self._write_disk, key, created, value)
+        except OSError as e:
+            logger.warning(f"Кэш '{self.namespace}': не удалось записать на диск: {e}")
+
+    def clear(self):
+        """Очистить оба уровня"""
+        with self._lock:
+            self._memory.clear()
+        for key in list(self._disk_index):
+            self._delete_disk(key)
+        logger.info(f"Кэш '{self.namespace}' очищен")
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и размер кэша"""
+        hits = self.hits_memory + self.hits_disk
+        total = hits + self.misses
+        return {
+            "hits": hits,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "evictions": self.evictions,
+            "memory_items": len(self._memory),
+            "disk_items": len(self._disk_index),
+            "disk_bytes": self._disk_bytes
+        }
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """Разностный перцептивный хэш (dHash) изображения
+
+    Устойчив к перекодированию, масштабированию и мелким изменениям пикселей.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (hash_size * 16, hash_size * 16))
+        gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = list(gray.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Расстояние Хэмминга между двумя хэшами"""
+    # int.bit_count() появился только в Python 3.10, а поддерживается 3.9+
+    return bin(a ^ b).count("1")
+
+
+class PerceptualCache:
+    """Кэш результатов анализа изображений по перцептивному хэшу
+
+    Значения хранятся в AnalysisCache, а индекс (хэш -> ключ) — в памяти
+    и в index.json. Поиск — ближайший хэш в пределах порога Хэмминга
+    среди записей с той же областью (модель, промпт, контекст).
+    """
+
+    def __init__(self, namespace: str, threshold: Optional[int] = None, max_items: Optional[int] = None):
+        self.namespace = namespace
+        self.threshold = threshold if threshold is not None else settings.image_cache_hamming_threshold
+        self.max_items = max_items if max_items is not None else settings.image_cache_max_items
+        self.store = AnalysisCache(namespace)
+        self._index_path = self.store.directory / "index.json"
+        self._index: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Снимок индекса и запись файла — под одной блокировкой: файл не откатится к старому снимку
+        self._save_lock = threading.Lock()
+
+        self.hits_exact = 0
+        self.hits_near = 0
+        self.misses = 0
+
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            raw = json.loads(self._index_path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return
+        for key, (scope, phash) in raw.items():
+            if key in self.store._disk_index:
+                self._index[key] = (scope, int(phash))
+
+    def _save_index(self):
+        with self._save_lock:
+            with self._lock:
+                data = {key: [scope, phash] for key, (scope, phash) in self._index.items()}
+            tmp = self._index_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp, self._index_path)
+
+    def _nearest(self, scope: str, phash: int) -> Optional[tuple]:
+        best = None
+        with self._lock:
+            for key, (entry_scope, entry_hash) in self._index.items():
+                if entry_scope != scope:
+                    continue
+                distance = hamming_distance(phash, entry_hash)
+                if distance <= self.threshold and (best is None or distance < best[1]):
+                    best = (key, distance)
+                    if distance == 0:
+                        break
+        return best
+
+    async def get(self, scope: str, phash: int) -> Optional[Any]:
+        """Найти результат для визуально близкого изображения"""
+        nearest = self._nearest(scope, phash)
+        if nearest is None:
+            self.misses += 1
+            return None
+
+        key, distance = nearest
+        value = await self.store.get(key)
+        if value is None:
+            # Запись истекла или вытеснена — чистим индекс
+            with self._lock:
+                self._index.pop(key, None)
+            self.misses += 1
+            return None
+
+        with self._lock:
+            self._index.move_to_end(key)
+        if distance == 0:
+            self.hits_exact += 1
+        else:
+            self.hits_near += 1
+        logger.info(f"  Кэш '{self.namespace}': найдено похожее изображение (расстояние {distance})")
+        return value
+
+    async def set(self, scope: str, phash: int, value: Any):
+        """Сохранить результат для изображения"""
+        key = make_cache_key(scope, phash)
+        await self.store.set(key, value)
+        with self._lock:
+            self._index[key] = (scope, phash)
+            self._index.move_to_end(key)
+            while len(self._index) > self.max_items:
+                self._index.popitem(last=False)
+        try:
+            await asyncio.to_thread(self._save_index)
+        except OSError as e:
+            logger.warning(f"Кэш '{self.namespace}': не удалось сохранить индекс: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+        self.store.clear()
+        try:
+            self._index_path.unlink()
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        hits = self.hits_exact + self.hits_near
+        total = hits + self.misses
+        return {
+            "hits": hits,
+            "hits_exact": self.hits_exact,
+            "hits_near": self.hits_near,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "items": len(self._index),
+            "threshold": self.threshold,
+            "disk_bytes": self.store.stats()["disk_bytes"]
+        }
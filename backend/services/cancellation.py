@@ -0,0 +1,90 @@
+"""
+Отмена обработки запроса, когда клиент закрыл соединение
+
+Пока выполняется обработчик, фоновая задача ждёт сообщения об отключении; при
+отключении клиента задача обработчика отменяется. CancelledError проходит по
+конвейеру: вызов API прерывается, ожидание в очередях освобождается, а задание
+в браузере останавливается на ближайшей контрольной точке исполнителя
+(загрузка страницы, ожидание готовности, скриншот) — см. browser_supervisor.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+from fastapi import Request
+
+from backend.config import settings
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.cancellation")
+
+
+class ClientDisconnected(Exception):
+    """Клиент отключился, обработка запроса отменена"""
+
+
+class CancellationTracker:
+    """Отслеживание отключений клиентов и счётчики отменённой работы"""
+
+    def __init__(self):
+        self.enabled = settings.cancel_on_disconnect
+        # Что отменено: requests — запросы, parses — задания браузера, upstream_calls — вызовы API
+        self.counters: Dict[str, int] = {"requests": 0, "parses": 0, "upstream_calls": 0}
+        self.by_endpoint: Dict[str, int] = defaultdict(int)
+
+    def count(self, kind: str):
+        self.counters[kind] = self.counters.get(kind, 0) + 1
+
+    async def _watch(self, request: Request, task: asyncio.Task, state: dict):
+        # Тело запроса уже прочитано: следующее сообщение сервера — http.disconnect.
+        # request.is_disconnected() за BaseHTTPMiddleware отключение не видит, поэтому ждём receive()
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                state["disconnected"] = True
+                task.cancel()
+                return
+
+    @asynccontextmanager
+    async def guard(self, request: Request) -> AsyncIterator[None]:
+        """
+        Отменить текущую задачу, если клиент отключится внутри блока
+
+        Использовать после того, как тело запроса прочитано. Отмена из-за
+        отключения превращается в ClientDisconnected, любая другая (остановка
+        сервера) проходит как есть.
+        """
+        if not self.enabled:
+            yield
+            return
+        task = asyncio.current_task()
+        state = {"disconnected": False}
+        watcher = asyncio.create_task(self._watch(request, task, state))
+        try:
+            yield
+        except asyncio.CancelledError:
+            if not state["disconnected"]:
+                raise
+            # Task.uncancel() есть только с Python 3.11; на более старых
+            # версиях счётчика отмен нет и сбрасывать нечего
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            self.count("requests")
+            self.by_endpoint[request.url.path] += 1
+            logger.info(f"🔌 Клиент отключился, обработка отменена: {request.url.path}")
+            raise ClientDisconnected()
+        finally:
+            watcher.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            **self.counters,
+            "by_endpoint": dict(self.by_endpoint)
+        }
+
+
+# Глобальный экземпляр
+cancellation = CancellationTracker()
@@ -0,0 +1,159 @@
+"""
+Определение изменений страницы между проверками
+
+Для каждого URL хранится отпечаток последней проанализированной версии:
+нормализованные поля извлечённого контента (с общим хэшем) и перцептивный
+хэш скриншота — вместе с результатом анализа. Если текст и внешний вид
+изменились меньше порогов, прошлый CompetitorAnalysis используется повторно.
+"""
+import asyncio
+import difflib
+import hashlib
+import time
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from backend.config import settings
+from backend.models.schemas import ChangeReport, CompetitorAnalysis
+from backend.services.cache_service import AnalysisCache, dhash, hamming_distance, make_cache_key, normalize_text
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.changes")
+
+# Поля контента, которые сравниваются между версиями страницы
+FIELDS = ("title", "h1", "meta_description", "headings", "paragraphs", "ctas", "prices")
+
+
+def page_fields(parsed) -> Dict[str, str]:
+    """Нормализованные поля контента из ParseResult"""
+    details = parsed.details
+    fields = {
+        "title": parsed.title or "",
+        "h1": parsed.h1 or "",
+        "meta_description": "",
+        "headings": "",
+        "paragraphs": parsed.first_paragraph or "",
+        "ctas": "",
+        "prices": ""
+    }
+    if details:
+        fields["meta_description"] = details.meta_description or ""
+        fields["headings"] = "\n".join(f"h{h.level} {h.text}" for h in details.headings)
+        fields["paragraphs"] = "\n".join(details.paragraphs) or fields["paragraphs"]
+        fields["ctas"] = "\n".join(sorted(c.text for c in details.ctas))
+        fields["prices"] = "\n".join(sorted(details.price_samples))
+    return {name: normalize_text(value).lower() for name, value in fields.items()}
+
+
+def text_hash(fields: Dict[str, str]) -> str:
+    return hashlib.sha256("\x00".join(fields[name] for name in FIELDS).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class Fingerprint:
+    """Отпечаток текущей версии страницы"""
+    fields: Dict[str, str]
+    text_hash: str
+    phash: Optional[int] = None
+
+
+class ChangeDetector:
+    """Сравнение страницы с последней проанализированной версией"""
+
+    def __init__(self):
+        self.enabled = settings.change_detection_enabled
+        self.text_threshold = settings.change_text_threshold
+        self.visual_threshold = settings.change_visual_threshold
+        self.store = AnalysisCache("pages", ttl_seconds=settings.change_detection_ttl) if self.enabled else None
+
+        self.checks = 0
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+
+        logger.info(
+            f"Определение изменений: {'включено' if self.enabled else 'выключено'}, "
+            f"порог текста {self.text_threshold:.0%}, порог скриншота {self.visual_threshold}"
+        )
+
+    @staticmethod
+    def _key(canonical_url: str, screenshot: bool) -> str:
+        # Анализ по скриншоту и по тексту отличаются — храним их отдельно
+        return make_cache_key("page", canonical_url, "vision" if screenshot else "text")
+
+    async def fingerprint(self, parsed) -> Fingerprint:
+        fields = page_fields(parsed)
+        phash = None
+        if parsed.screenshot:
+            try:
+                phash = await asyncio.to_thread(dhash, parsed.screenshot)
+            except Exception as e:
+                logger.warning(f"  ⚠ Не удалось вычислить хэш скриншота: {e}")
+        return Fingerprint(fields=fields, text_hash=text_hash(fields), phash=phash)
+
+    async def compare(self, canonical_url: str, screenshot: bool, fingerprint: Fingerprint):
+        """Сравнить с прошлой версией: (ChangeReport, прошлый анализ или None)"""
+        self.checks += 1
+        previous = await self.store.get(self._key(canonical_url, screenshot))
+        if previous is None:
+            self.new += 1
+            return ChangeReport(status="new"), None
+
+        changed_fields: List[str] = [
+            name for name in FIELDS if previous["fields"].get(name, "") != fingerprint.fields[name]
+        ]
+        if previous["text_hash"] == fingerprint.text_hash:
+            text_change = 0.0
+        else:
+            before = "\n".join(previous["fields"].get(name, "") for name in FIELDS)
+            after = "\n".join(fingerprint.fields[name] for name in FIELDS)
+            text_change = 1.0 - difflib.SequenceMatcher(None, before, after, autojunk=False).ratio()
+
+        visual_distance = None
+        if fingerprint.phash is not None and previous.get("phash") is not None:
+            visual_distance = hamming_distance(fingerprint.phash, previous["phash"])
+            if visual_distance > self.visual_threshold:
+                changed_fields.append("screenshot")
+
+        unchanged = text_change <= self.text_threshold and (
+            visual_distance is None or visual_distance <= self.visual_threshold
+        )
+        report = ChangeReport(
+            status="unchanged" if unchanged else "changed",
+            changed_fields=changed_fields,
+            text_change=round(text_change, 4),
+            visual_distance=visual_distance,
+            analyzed_at=datetime.fromtimestamp(previous["analyzed_at"]).isoformat(timespec="seconds"),
+            analysis_reused=unchanged
+        )
+        if unchanged:
+            self.unchanged += 1
+            return report, CompetitorAnalysis.model_validate(previous["analysis"])
+        self.changed += 1
+        return report, None
+
+    async def remember(self, canonical_url: str, screenshot: bool, fingerprint: Fingerprint, analysis: CompetitorAnalysis):
+        """Сохранить отпечаток и анализ проанализированной версии"""
+        await self.store.set(self._key(canonical_url, screenshot), {
+            "fields": fingerprint.fields,
+            "text_hash": fingerprint.text_hash,
+            "phash": fingerprint.phash,
+            "analysis": analysis.model_dump(),
+            "analyzed_at": time.time()
+        })
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "checks": self.checks,
+            "new": self.new,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+            "reuse_rate": round(self.unchanged / self.checks, 3) if self.checks else 0.0
+        }
+
+
+# Глобальный экземпляр
+change_detector = ChangeDetector()
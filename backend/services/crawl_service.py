@@ -0,0 +1,194 @@
+"""
+Параллельный обход всех сайтов конкурентов
+
+Парсинг и AI анализ ограничены раздельно: браузерный этап — числом
+одновременных загрузок, этап анализа — числом одновременных вызовов API.
+Для каждого домена соблюдается вежливость: не больше N загрузок сразу
+и пауза между началом загрузок. Ход обхода отдаётся событиями.
+"""
+import asyncio
+import time
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from backend.config import settings
+from backend.services.browser_supervisor import browser_supervisor
+from backend.services.history_service import history_service
+from backend.services.parser_service import canonicalize_url, parser_service
+from backend.services.pipeline_service import pipeline_service
+from backend.services.usage_ledger import set_competitor
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.crawl")
+
+
+class DomainGate:
+    """Ограничение одновременных загрузок и пауза между загрузками одного домена"""
+
+    def __init__(self, concurrency: int, delay: float):
+        self.concurrency = max(1, concurrency)
+        self.delay = delay
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._next_start: Dict[str, float] = {}
+        self.waited = 0.0
+
+    async def __call__(self, domain: str) -> asyncio.Semaphore:
+        """Дождаться очереди домена; возвращает семафор, который нужно освободить"""
+        semaphore = self._semaphores.setdefault(domain, asyncio.Semaphore(self.concurrency))
+        await semaphore.acquire()
+        now = time.monotonic()
+        start_at = max(now, self._next_start.get(domain, 0.0))
+        self._next_start[domain] = start_at + self.delay
+        if start_at > now:
+            self.waited += start_at - now
+            await asyncio.sleep(start_at - now)
+        return semaphore
+
+
+class CrawlService:
+    """Обход списка URL: парсинг и анализ с раздельными лимитами"""
+
+    def __init__(self):
+        self.crawls = 0
+        self.pages = 0
+        self.failed = 0
+        self.last_elapsed: Optional[float] = None
+
+    async def crawl(
+        self,
+        urls: List[str],
+        use_cache: bool = True,
+        screenshot: Optional[bool] = None,
+        browser_concurrency: Optional[int] = None,
+        upstream_concurrency: Optional[int] = None,
+        max_age: Optional[float] = None
+    ) -> AsyncIterator[dict]:
+        """Обойти URL параллельно; события: start, stage, item, progress, done"""
+        if screenshot is None:
+            screenshot = settings.parser_screenshot
+        browser_concurrency = browser_concurrency or settings.crawl_browser_concurrency or browser_supervisor.capacity
+        upstream_concurrency = upstream_concurrency or settings.crawl_upstream_concurrency
+
+        # Одинаковые URL обходим один раз
+        groups: Dict[str, List[int]] = {}
+        originals: Dict[str, str] = {}
+        for index, url in enumerate(urls):
+            canonical = canonicalize_url(url)
+            groups.setdefault(canonical, []).append(index)
+            originals.setdefault(canonical, url)
+
+        logger.info("=" * 50)
+        logger.info(f"🕸️ ОБХОД КОНКУРЕНТОВ: {len(urls)} URL, уникальных {len(groups)}")
+        logger.info(f"  Параллельность: браузер {browser_concurrency}, API {upstream_concurrency}")
+
+        start_time = time.time()
+        browser_semaphore = asyncio.Semaphore(browser_concurrency)
+        upstream_semaphore = asyncio.Semaphore(upstream_concurrency)
+        gate = DomainGate(settings.crawl_domain_concurrency, settings.crawl_domain_delay)
+        events: "asyncio.Queue[dict]" = asyncio.Queue()
+
+        async def run(canonical: str):
+            url = originals[canonical]
+            indexes = groups[canonical]
+            domain = urlsplit(canonical).hostname or ""
+            item_start = time.time()
+            set_competitor(domain)
+            try:
+                # Свежий результат из кэша парсинга не занимает браузер и не ждёт очереди домена
+                parsed = await parser_service.cached(url, screenshot, max_age)
+                if parsed is None:
+                    semaphore = await gate(domain)
+                    try:
+                        async with browser_semaphore:
+                            events.put_nowait({"type": "stage", "index": indexes[0], "url": url, "stage": "parsing"})
+                            parsed = await pipeline_service.parse(url, screenshot, max_age)
+                    finally:
+                        semaphore.release()
+                async with upstream_semaphore:
+                    events.put_nowait({"type": "stage", "index": indexes[0], "url": url, "stage": "analyzing"})
+                    result = await pipeline_service.analyze(url, parsed, use_cache, screenshot)
+                events.put_nowait({"type": "_result", "canonical": canonical, "data": result, "elapsed": time.time() - item_start})
+            except Exception as e:
+                events.put_nowait({"type": "_result", "canonical": canonical, "error": str(e), "elapsed": time.time() - item_start})
+
+        tasks = [asyncio.ensure_future(run(canonical)) for canonical in groups]
+        succeeded = failed = completed = 0
+        history_entries = []
+        try:
+            yield {
+                "type": "start",
+                "total": len(urls),
+                "unique": len(groups),
+                "browser_concurrency": browser_concurrency,
+                "upstream_concurrency": upstream_concurrency
+            }
+            while completed < len(groups):
+                event = await events.get()
+                if event["type"] != "_result":
+                    yield event
+                    continue
+
+                completed += 1
+                canonical = event["canonical"]
+                data = event.get("data")
+                if data is not None:
+                    history_entries.append({
+                        "request_type": "parse",
+                        "request_summary": f"URL: {originals[canonical]}",
+                        "response_summary": data.analysis.summary[:100] if data.analysis.summary else f"Title: {data.title or 'N/A'}",
+                        "url": originals[canonical]
+                    })
+                for position, index in enumerate(groups[canonical]):
+                    item = {
+                        "type": "item",
+                        "index": index,
+                        "url": urls[index],
+                        "success": data is not None,
+                        "elapsed": round(event["elapsed"], 2)
+                    }
+                    if data is not None:
+                        succeeded += 1
+                        item["data"] = data.model_dump()
+                    else:
+                        failed += 1
+                        item["error"] = event["error"]
+                    if position:
+                        item["duplicate_of"] = groups[canonical][0]
+                    yield item
+                yield {"type": "progress", "completed": completed, "unique": len(groups)}
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Весь обход попадает в историю одной транзакцией — под shield, как в пакетном
+            # анализе: после отключения клиента await в отменённой задаче не выполнился бы
+            await asyncio.shield(history_service.add_entries(history_entries))
+
+        elapsed = time.time() - start_time
+        self.crawls += 1
+        self.pages += len(groups)
+        self.failed += failed
+        self.last_elapsed = round(elapsed, 2)
+        logger.info(f"  ✅ Обход завершён за {elapsed:.2f} сек: успешно {succeeded}, ошибок {failed}")
+        logger.info(f"  Ожидание вежливости доменов: {gate.waited:.2f} сек")
+        logger.info("=" * 50)
+        yield {
+            "type": "done",
+            "total": len(urls),
+            "unique": len(groups),
+            "succeeded": succeeded,
+            "failed": failed,
+            "elapsed": round(elapsed, 2)
+        }
+
+    def stats(self) -> dict:
+        return {
+            "crawls": self.crawls,
+            "pages": self.pages,
+            "failed": self.failed,
+            "last_elapsed": self.last_elapsed
+        }
+
+
+# Глобальный экземпляр
+crawl_service = CrawlService()
@@ -0,0 +1,81 @@
+"""
+Бюджет времени запроса (дедлайн), общий для всех этапов обработки
+
+Дедлайн задаётся эндпоинтом на весь запрос и хранится в ContextVar (как
+эндпоинт и конкурент в usage_ledger), поэтому парсер, супервизор браузеров и
+OpenAI сервис видят его без передачи через аргументы. Каждый этап берёт
+оставшуюся часть бюджета; вложенный дедлайн может только сократить внешний.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Optional, TypeVar
+
+from backend.config import settings
+
+T = TypeVar("T")
+
+# Момент дедлайна по time.monotonic() (None — без ограничения)
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Бюджет времени запроса исчерпан"""
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Ограничить блок seconds секундами от текущего момента (None — оставить как есть)"""
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + max(0.0, seconds)
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось до дедлайна (None — дедлайна нет)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def bounded(timeout: float) -> float:
+    """Тайм-аут этапа, не выходящий за дедлайн"""
+    left = remaining()
+    return timeout if left is None else min(timeout, left)
+
+
+async def with_deadline(awaitable: Awaitable[T], stage: str) -> T:
+    """Дождаться результата до дедлайна, иначе отменить и бросить DeadlineExceeded"""
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout=left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"Превышен бюджет времени запроса ({stage})")
+
+
+def resolve_budget(value: Optional[float], header: Optional[str]) -> float:
+    """
+    Бюджет запроса, сек: параметр запроса, иначе заголовок X-Request-Timeout,
+    иначе REQUEST_DEADLINE; не больше REQUEST_DEADLINE_MAX. ValueError — некорректный заголовок.
+    """
+    if value is None and header:
+        try:
+            value = float(header)
+        except ValueError:
+            raise ValueError(f"X-Request-Timeout: ожидается число секунд, получено {header!r}")
+        if value <= 0:
+            raise ValueError("X-Request-Timeout должен быть больше 0")
+    if value is None:
+        value = settings.request_deadline
+    return min(value, settings.request_deadline_max)
@@ -1,12 +1,23 @@
 """
 Сервис для работы с историей запросов
+
+История хранится в SQLite (WAL): запись — одна вставка в конец таблицы,
+без чтения и перезаписи всей истории, поэтому несколько процессов uvicorn
+пишут в один файл без гонок. Старые записи удаляются по индексу (номер
+записи и время). При первом запуске записи из прежнего history.json
+переносятся в базу один раз, файл переименовывается в *.migrated.
 """
+import asyncio
 import json
+import os
+import sqlite3
+import threading
+import time
 import uuid
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 from backend.config import settings
 from backend.models.schemas import HistoryItem
@@ -14,115 +25,292 @@ from backend.models.schemas import HistoryItem
 # Логгер для сервиса
 logger = logging.getLogger("competitor_monitor.history")
 
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    request_type TEXT NOT NULL,
+    url TEXT,
+    request_summary TEXT NOT NULL,
+    response_summary TEXT NOT NULL,
+    duplicate_of TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp);
+CREATE INDEX IF NOT EXISTS idx_history_type ON history (request_type, seq);
+CREATE INDEX IF NOT EXISTS idx_history_url ON history (url, seq);
+CREATE TABLE IF NOT EXISTS history_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_COLUMNS = ("id", "timestamp", "request_type", "url", "request_summary", "response_summary", "duplicate_of")
+
+# Ожидание блокировки записи другим процессом, сек
+_BUSY_TIMEOUT = 10.0
+
+# В старом history.json URL парсинга был только в request_summary, обрезанном до 200 символов
+_LEGACY_URL_PREFIX = "URL: "
+_LEGACY_SUMMARY_LIMIT = 200
+
+
+def _row(
+    request_type: str,
+    request_summary: str,
+    response_summary: str,
+    url: Optional[str] = None,
+    duplicate_of: Optional[str] = None
+) -> tuple:
+    return (
+        str(uuid.uuid4()),
+        time.time(),
+        request_type,
+        url,
+        request_summary[:200],
+        response_summary[:500],
+        duplicate_of
+    )
+
+
+def _legacy_url(entry: dict) -> Optional[str]:
+    """URL записи парсинга из старой истории ("URL: https://...")"""
+    summary = entry.get("request_summary") or ""
+    if entry.get("request_type") != "parse" or not summary.startswith(_LEGACY_URL_PREFIX):
+        return None
+    if len(summary) >= _LEGACY_SUMMARY_LIMIT:
+        # Адрес мог быть обрезан — неполный URL хуже отсутствующего
+        return None
+    return summary[len(_LEGACY_URL_PREFIX):].strip() or None
+
+
+def _item(row: tuple) -> HistoryItem:
+    data = dict(zip(_COLUMNS, row))
+    data["timestamp"] = datetime.fromtimestamp(data["timestamp"])
+    return HistoryItem(**data)
+
 
 class HistoryService:
     """Управление историей запросов"""
-    
+
     def __init__(self):
         logger.info("=" * 50)
         logger.info("Инициализация History сервиса")
-        
-        self.history_file = Path(settings.history_file)
+
+        self.db_file = Path(settings.history_db_file)
+        self.legacy_file = Path(settings.history_file)
         self.max_items = settings.max_history_items
-        
-        logger.info(f"  Файл истории: {self.history_file}")
-        logger.info(f"  Макс. записей: {self.max_items}")
-        
-        self._ensure_file_exists()
-        
-        # Загружаем и показываем текущее состояние
-        history = self._load_history()
-        logger.info(f"  Текущих записей: {len(history)}")
+        self.retention_rows = settings.history_retention_rows
+        self.retention_days = settings.history_retention_days
+        self._db_lock = threading.Lock()
+
+        self.inserted = 0
+        self.pruned = 0
+        self.migrated = 0
+
+        logger.info(f"  База истории: {self.db_file}")
+        logger.info(f"  Хранится записей: {self.retention_rows}, дней: {self.retention_days or 'без ограничения'}")
+        logger.info(f"  Записей в ответе: {self.max_items}")
+
+        self._conn = self._connect()
+        self._migrate_json()
+
+        logger.info(f"  Текущих записей: {self._count()}")
         logger.info("History сервис инициализирован ✓")
         logger.info("=" * 50)
-    
-    def _ensure_file_exists(self):
-        """Создать файл истории если его нет"""
-        if not self.history_file.exists():
-            logger.info(f"  📁 Создание файла истории: {self.history_file}")
-            self.history_file.write_text("[]", encoding="utf-8")
-            logger.info("  ✓ Файл создан")
-        else:
-            logger.debug(f"  Файл истории существует: {self.history_file}")
-    
-    def _load_history(self) -> List[dict]:
-        """Загрузить историю из файла"""
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db_file.parent != Path("."):
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_file, timeout=_BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        # Базы первой версии — без колонки duplicate_of
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        if "duplicate_of" not in columns:
+            try:
+                conn.execute("ALTER TABLE history ADD COLUMN duplicate_of TEXT")
+                conn.commit()
+            except sqlite3.OperationalError:
+                # Колонку одновременно добавил другой процесс
+                pass
+        return conn
+
+    def _migrate_json(self):
+        """Перенести записи из history.json (один раз на базу, даже при нескольких процессах)"""
+        if not self.legacy_file.exists():
+            return
         try:
-            content = self.history_file.read_text(encoding="utf-8")
-            history = json.loads(content)
-            logger.debug(f"История загружена: {len(history)} записей")
-            return history
-        except json.JSONDecodeError as e:
-            logger.warning(f"Ошибка парсинга JSON истории: {e}")
-            return []
-        except FileNotFoundError:
-            logger.warning(f"Файл истории не найден: {self.history_file}")
-            return []
-    
-    def _save_history(self, history: List[dict]):
-        """Сохранить историю в файл"""
-        logger.debug(f"Сохранение истории: {len(history)} записей")
-        self.history_file.write_text(
-            json.dumps(history, ensure_ascii=False, indent=2, default=str),
-            encoding="utf-8"
-        )
-        logger.debug("История сохранена ✓")
-    
-    def add_entry(
+            legacy = json.loads(self.legacy_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"  ⚠ Старая история не прочитана: {e}")
+            return
+
+        rows = []
+        # В JSON новые записи первыми, в базе — в порядке добавления
+        for entry in reversed(legacy if isinstance(legacy, list) else []):
+            try:
+                rows.append((
+                    entry.get("id") or str(uuid.uuid4()),
+                    datetime.fromisoformat(entry["timestamp"]).timestamp(),
+                    entry["request_type"],
+                    _legacy_url(entry),
+                    entry.get("request_summary", "")[:200],
+                    entry.get("response_summary", "")[:500],
+                    None
+                ))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"  ⚠ Запись старой истории пропущена: {e}")
+
+        with self._db_lock:
+            # Блокировка записи сразу: второй процесс дождётся и увидит отметку о переносе
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self._conn.execute(
+                    "SELECT value FROM history_meta WHERE key = 'migrated_from'"
+                ).fetchone()
+                if done is None:
+                    self._conn.executemany(
+                        f"INSERT INTO history ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})", rows
+                    )
+                    self._conn.execute(
+                        "INSERT INTO history_meta (key, value) VALUES ('migrated_from', ?)", (str(self.legacy_file),)
+                    )
+                    self.migrated = len(rows)
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+        if self.migrated:
+            logger.info(f"  📦 Перенесено записей из {self.legacy_file}: {self.migrated}")
+        try:
+            os.replace(self.legacy_file, self.legacy_file.with_name(self.legacy_file.name + ".migrated"))
+        except OSError:
+            # Файл уже переименовал другой процесс
+            pass
+
+    # === Хранилище ===
+
+    def _insert(self, rows: List[tuple]):
+        """Добавить записи в конец и удалить вышедшие за пределы хранения"""
+        with self._db_lock:
+            cursor = self._conn.cursor()
+            cursor.executemany(
+                f"INSERT INTO history ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})", rows
+            )
+            last_seq = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+            # Номера записей растут во всех процессах, поэтому граница — диапазон первичного ключа
+            pruned = cursor.execute("DELETE FROM history WHERE seq <= ?", (last_seq - self.retention_rows,)).rowcount
+            if self.retention_days:
+                pruned += cursor.execute(
+                    "DELETE FROM history WHERE timestamp < ?", (time.time() - self.retention_days * 86400,)
+                ).rowcount
+            self._conn.commit()
+        self.inserted += len(rows)
+        self.pruned += pruned
+        if pruned:
+            logger.info(f"  🗑️ Удалено старых записей: {pruned}")
+
+    def _select(self, request_type: Optional[str], url: Optional[str], limit: int) -> List[tuple]:
+        conditions, params = [], []
+        if request_type:
+            conditions.append("request_type = ?")
+            params.append(request_type)
+        if url:
+            conditions.append("url = ?")
+            params.append(url)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with self._db_lock:
+            return self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM history {where}ORDER BY seq DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+
+    def _delete_all(self) -> int:
+        with self._db_lock:
+            deleted = self._conn.execute("DELETE FROM history").rowcount
+            self._conn.commit()
+        return deleted
+
+    def _count(self) -> int:
+        with self._db_lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    # === API ===
+
+    async def add_entry(
         self,
         request_type: str,
         request_summary: str,
-        response_summary: str
+        response_summary: str,
+        url: Optional[str] = None
     ) -> HistoryItem:
         """Добавить запись в историю"""
         logger.info(f"📝 Добавление записи в историю")
         logger.info(f"  Тип: {request_type}")
         logger.info(f"  Запрос: {request_summary[:50]}...")
         logger.info(f"  Ответ: {response_summary[:50]}...")
-        
-        history = self._load_history()
-        
-        item = {
-            "id": str(uuid.uuid4()),
-            "timestamp": datetime.now().isoformat(),
-            "request_type": request_type,
-            "request_summary": request_summary[:200],
-            "response_summary": response_summary[:500]
-        }
-        
-        # Добавляем в начало
-        history.insert(0, item)
-        old_count = len(history)
-        
-        # Оставляем только последние N записей
-        history = history[:self.max_items]
-        
-        if old_count > len(history):
-            logger.info(f"  🗑️ Удалено старых записей: {old_count - len(history)}")
-        
-        self._save_history(history)
-        
-        logger.info(f"  ✓ Запись добавлена (ID: {item['id'][:8]}...)")
-        logger.info(f"  Всего записей: {len(history)}")
-        
-        return HistoryItem(**item)
-    
-    def get_history(self) -> List[HistoryItem]:
-        """Получить всю историю"""
+
+        row = _row(request_type, request_summary, response_summary, url)
+        await asyncio.to_thread(self._insert, [row])
+
+        logger.info(f"  ✓ Запись добавлена (ID: {row[0][:8]}...)")
+        return _item(row)
+
+    async def add_entries(self, entries: List[dict]) -> List[HistoryItem]:
+        """Добавить пачку записей одной транзакцией
+
+        entries — словари с ключами request_type, request_summary, response_summary
+        (и необязательным url) в порядке выполнения (последняя запись окажется
+        первой в истории). duplicate_of — номер записи этой же пачки, повтором
+        которой является запись; в истории он заменяется её ID.
+        """
+        if not entries:
+            return []
+
+        logger.info(f"📝 Добавление {len(entries)} записей в историю")
+        rows = []
+        for entry in entries:
+            original = entry.get("duplicate_of")
+            rows.append(_row(
+                entry["request_type"],
+                entry["request_summary"],
+                entry["response_summary"],
+                entry.get("url"),
+                rows[original][0] if original is not None else None
+            ))
+        await asyncio.to_thread(self._insert, rows)
+
+        logger.info("  ✓ Записи добавлены")
+        return [_item(row) for row in rows]
+
+    async def get_history(
+        self,
+        request_type: Optional[str] = None,
+        url: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[HistoryItem]:
+        """Последние записи истории (новые первыми), с фильтром по типу запроса и URL"""
         logger.info("📋 Получение истории")
-        history = self._load_history()
-        logger.info(f"  Записей: {len(history)}")
-        return [HistoryItem(**item) for item in history]
-    
-    def clear_history(self):
+        limit = max(1, min(limit or self.max_items, self.retention_rows))
+        rows = await asyncio.to_thread(self._select, request_type, url, limit)
+        logger.info(f"  Записей: {len(rows)}")
+        return [_item(row) for row in rows]
+
+    async def clear_history(self):
         """Очистить историю"""
         logger.info("🗑️ Очистка истории")
-        old_history = self._load_history()
-        logger.info(f"  Удаляется записей: {len(old_history)}")
-        
-        self._save_history([])
-        
-        logger.info("  ✓ История очищена")
+        deleted = await asyncio.to_thread(self._delete_all)
+        logger.info(f"  ✓ История очищена, удалено записей: {deleted}")
+
+    def stats(self) -> dict:
+        return {
+            "rows": self._count(),
+            "inserted": self.inserted,
+            "pruned": self.pruned,
+            "migrated": self.migrated
+        }
 
 
 # Глобальный экземпляр
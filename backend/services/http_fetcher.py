@@ -0,0 +1,160 @@
+"""
+Быстрая загрузка страниц по HTTP без браузера
+
+Для серверного рендеринга Chrome не нужен: страница скачивается общим
+httpx клиентом и разбирается lxml. Повторные загрузки идут с условными
+заголовками (ETag / Last-Modified), неизменённая страница стоит один 304.
+"""
+import re
+import asyncio
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import httpx
+import lxml.etree
+
+from backend.config import settings
+from backend.services.cache_service import AnalysisCache, make_cache_key
+from backend.services.deadline import DeadlineExceeded, bounded, with_deadline
+from backend.services.page_extract import extract_from_html
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.http_fetch")
+
+# Признаки страниц, которые рендерятся JavaScript-ом на клиенте
+_SPA_MARKERS = (
+    re.compile(rb"""<div[^>]+id=["'](?:root|app|__next|__nuxt)["'][^>]*>\s*</div>""", re.IGNORECASE),
+    re.compile(rb"<app-root[^>]*>\s*</app-root>", re.IGNORECASE),
+    re.compile(rb"<noscript[^>]*>[^<]*(?:enable|" + "включите".encode("utf-8") + rb")\s+javascript", re.IGNORECASE)
+)
+
+
+@dataclass
+class FetchResult:
+    """Результат загрузки страницы по HTTP"""
+    payload: Optional[dict] = None
+    # Почему нужен браузер (None — страница разобрана без него)
+    needs_browser: Optional[str] = None
+    not_modified: bool = False
+    status_code: Optional[int] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class HttpFetcher:
+    """Загрузка и разбор HTML с условными запросами"""
+
+    def __init__(self):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.parser_timeout),
+            limits=httpx.Limits(
+                max_connections=settings.http_fetch_max_connections,
+                max_keepalive_connections=settings.http_fetch_max_connections
+            ),
+            follow_redirects=True,
+            headers={
+                "User-Agent": settings.parser_user_agent,
+                "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+                "Accept-Language": "ru,en;q=0.8"
+            }
+        )
+        # Валидаторы и разобранный payload по URL — для ответов 304
+        self.validators = AnalysisCache("http") if settings.cache_enabled else None
+
+        self.fetches = 0
+        self.not_modified = 0
+        self.escalations: Dict[str, int] = {}
+
+    def _needs_browser(self, html: bytes, payload: dict) -> Optional[str]:
+        """Причина, по которой страницу надо открыть в браузере, или None"""
+        if payload.get("text_length", 0) < settings.http_min_text_length:
+            return "empty_body"
+        if not payload.get("h1") and not payload.get("paragraphs"):
+            for marker in _SPA_MARKERS:
+                if marker.search(html):
+                    return "spa_marker"
+        return None
+
+    def _escalate(self, reason: str) -> FetchResult:
+        self.escalations[reason] = self.escalations.get(reason, 0) + 1
+        return FetchResult(needs_browser=reason)
+
+    async def fetch(self, url: str, canonical_url: str) -> FetchResult:
+        """Скачать и разобрать страницу; при необходимости JS — вернуть причину"""
+        start_time = time.time()
+        cache_key = make_cache_key("http", canonical_url)
+        cached = await self.validators.get(cache_key) if self.validators else None
+
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        self.fetches += 1
+        # Тайм-ауты httpx действуют на каждую фазу отдельно, поэтому загрузка
+        # целиком тоже ограничена остатком бюджета запроса
+        timeout = bounded(settings.parser_timeout)
+        try:
+            response = await with_deadline(self.client.get(url, headers=headers, timeout=timeout), "загрузка по HTTP")
+        except httpx.TimeoutException as e:
+            if timeout < settings.parser_timeout:
+                raise DeadlineExceeded("Бюджет времени запроса исчерпан при загрузке по HTTP") from e
+            logger.info(f"  ⚠ HTTP загрузка не удалась ({type(e).__name__}), переход на браузер")
+            return self._escalate("http_error")
+        except httpx.HTTPError as e:
+            logger.info(f"  ⚠ HTTP загрузка не удалась ({type(e).__name__}), переход на браузер")
+            return self._escalate("http_error")
+        fetch_elapsed = round(time.time() - start_time, 3)
+
+        if response.status_code == 304 and cached:
+            self.not_modified += 1
+            logger.info(f"  ⚡ Страница не изменилась (304) за {fetch_elapsed:.2f} сек")
+            return FetchResult(payload=cached["payload"], not_modified=True, status_code=304, timings={"fetch": fetch_elapsed})
+
+        if response.status_code >= 400:
+            logger.info(f"  ⚠ HTTP {response.status_code}, переход на браузер")
+            return self._escalate(f"status_{response.status_code}")
+
+        content_type = response.headers.get("content-type", "")
+        if "html" not in content_type:
+            return self._escalate("not_html")
+
+        extract_start = time.time()
+        # Разбор HTML — в отдельном потоке, чтобы не блокировать event loop
+        try:
+            payload = await asyncio.to_thread(extract_from_html, response.content, response.charset_encoding)
+        except (lxml.etree.LxmlError, ValueError) as e:
+            # Пустой ответ или одни комментарии: lxml бросает "Document is empty"
+            logger.info(f"  ⚠ HTML не разобран ({str(e)[:100]}), переход на браузер")
+            return self._escalate("parse_error")
+        timings = {"fetch": fetch_elapsed, "extract": round(time.time() - extract_start, 3)}
+
+        reason = self._needs_browser(response.content, payload)
+        if reason:
+            logger.info(f"  ⚠ Странице нужен JavaScript ({reason}), переход на браузер")
+            return self._escalate(reason)
+
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if self.validators and (etag or last_modified):
+            await self.validators.set(cache_key, {"etag": etag, "last_modified": last_modified, "payload": payload})
+
+        logger.info(f"  ✓ Страница загружена по HTTP за {fetch_elapsed:.2f} сек ({len(response.content) / 1024:.1f} KB)")
+        return FetchResult(payload=payload, status_code=response.status_code, timings=timings)
+
+    def stats(self) -> dict:
+        return {
+            "fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "escalations": dict(self.escalations)
+        }
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# Глобальный экземпляр
+http_fetcher = HttpFetcher()
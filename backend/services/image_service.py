@@ -0,0 +1,180 @@
+"""
+Подготовка изображений перед отправкой в Vision API:
+уменьшение, перекодирование в JPEG/WebP, удаление метаданных
+"""
+import asyncio
+import base64
+import io
+import threading
+import time
+import logging
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+from backend.config import settings
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.image")
+
+_MIME_BY_FORMAT = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def decoded_size(data_base64: str) -> int:
+    """Размер в байтах данных, закодированных в base64 (без декодирования)"""
+    return len(data_base64) * 3 // 4 - data_base64[-2:].count("=")
+
+
+@dataclass
+class PreparedImage:
+    """Изображение, готовое к отправке в Vision API"""
+    data: bytes
+    mime_type: str
+    detail: str
+    width: int
+    height: int
+    original_size: int
+    preprocessed: bool
+
+    @property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_size - len(self.data)
+
+
+class ImageService:
+    """Предобработка изображений и статистика по сэкономленному трафику"""
+
+    def __init__(self):
+        logger.info("=" * 50)
+        logger.info("Инициализация Image сервиса")
+        logger.info(f"  Предобработка: {'включена' if settings.image_preprocess_enabled else 'выключена'}")
+        logger.info(f"  Макс. сторона: {settings.image_max_edge}px, формат: {settings.image_format}, качество: {settings.image_quality}")
+
+        self.format = settings.image_format.upper()
+        if self.format not in _MIME_BY_FORMAT:
+            logger.warning(f"  ⚠ Неподдерживаемый формат {self.format}, используется JPEG")
+            self.format = "JPEG"
+
+        self._lock = threading.Lock()
+        self.images = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.prepare_seconds = 0.0
+        # Задержка Vision API: с предобработкой и без неё
+        self._latency = {
+            "preprocessed": {"calls": 0, "seconds": 0.0, "payload_bytes": 0},
+            "original": {"calls": 0, "seconds": 0.0, "payload_bytes": 0}
+        }
+
+        logger.info("Image сервис инициализирован ✓")
+        logger.info("=" * 50)
+
+    def _choose_detail(self, width: int, height: int) -> str:
+        """Уровень детализации для Vision API по итоговому размеру"""
+        return "low" if max(width, height) <= settings.image_low_detail_max_edge else "high"
+
+    def prepare(self, data: bytes, mime_type: str = "image/png") -> PreparedImage:
+        """Уменьшить, перекодировать и очистить изображение от метаданных"""
+        if not settings.image_preprocess_enabled:
+            with Image.open(io.BytesIO(data)) as image:
+                width, height = image.size
+            return PreparedImage(data, mime_type, "auto", width, height, len(data), False)
+
+        start_time = time.time()
+        with Image.open(io.BytesIO(data)) as image:
+            # Первый кадр для анимированных GIF/WebP, поворот по EXIF до удаления метаданных
+            image.seek(0)
+            image = ImageOps.exif_transpose(image)
+
+            max_edge = settings.image_max_edge
+            resized = max(image.size) > max_edge
+            if resized:
+                image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            if image.mode not in ("RGB", "L"):
+                rgba = image.convert("RGBA")
+                background = Image.new("RGB", rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                image = background
+
+            # Сохраняем без exif/icc — метаданные в результат не попадают
+            buffer = io.BytesIO()
+            image.save(buffer, format=self.format, quality=settings.image_quality, optimize=True)
+            encoded = buffer.getvalue()
+            result_mime = _MIME_BY_FORMAT[self.format]
+
+            # Графика с плоскими заливками бывает компактнее в PNG
+            if len(encoded) >= len(data):
+                buffer = io.BytesIO()
+                image.save(buffer, format="PNG", optimize=True)
+                if len(buffer.getvalue()) < len(encoded):
+                    encoded = buffer.getvalue()
+                    result_mime = "image/png"
+            width, height = image.size
+
+        # Даже если перекодированное изображение не меньше исходника, отправляем его:
+        # в исходнике остаются EXIF (в том числе GPS) и другие метаданные
+        prepared = PreparedImage(
+            data=encoded,
+            mime_type=result_mime,
+            detail=self._choose_detail(width, height),
+            width=width,
+            height=height,
+            original_size=len(data),
+            preprocessed=True
+        )
+
+        elapsed = time.time() - start_time
+        with self._lock:
+            self.images += 1
+            self.bytes_before += len(data)
+            self.bytes_after += len(encoded)
+            self.prepare_seconds += elapsed
+
+        logger.info(
+            f"  🗜️ Изображение подготовлено за {elapsed:.2f} сек: "
+            f"{len(data) / 1024:.1f} KB -> {len(encoded) / 1024:.1f} KB "
+            f"({width}x{height}, {result_mime}, detail={prepared.detail})"
+        )
+        return prepared
+
+    async def prepare_async(self, data: bytes, mime_type: str = "image/png") -> PreparedImage:
+        """Подготовить изображение в отдельном потоке, не блокируя event loop"""
+        return await asyncio.to_thread(self.prepare, data, mime_type)
+
+    def record_vision_latency(self, seconds: float, payload_bytes: int):
+        """Учесть время ответа Vision API для сравнения «до/после» предобработки"""
+        mode = "preprocessed" if settings.image_preprocess_enabled else "original"
+        with self._lock:
+            bucket = self._latency[mode]
+            bucket["calls"] += 1
+            bucket["seconds"] += seconds
+            bucket["payload_bytes"] += payload_bytes
+
+    def stats(self) -> dict:
+        latency = {}
+        for mode, bucket in self._latency.items():
+            calls = bucket["calls"]
+            latency[mode] = {
+                "calls": calls,
+                "avg_seconds": round(bucket["seconds"] / calls, 3) if calls else None,
+                "avg_payload_kb": round(bucket["payload_bytes"] / calls / 1024, 1) if calls else None
+            }
+        return {
+            "enabled": settings.image_preprocess_enabled,
+            "images": self.images,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "bytes_saved": self.bytes_before - self.bytes_after,
+            "avg_prepare_seconds": round(self.prepare_seconds / self.images, 3) if self.images else None,
+            "vision_latency": latency
+        }
+
+
+# Глобальный экземпляр
+logger.info("Создание глобального экземпляра Image сервиса...")
+image_service = ImageService()
@@ -0,0 +1,441 @@
+"""
+Асинхронные задания на парсинг и анализ URL (POST /jobs)
+
+Задание сохраняется в SQLite сразу при создании, клиент получает id и
+опрашивает статус (GET /jobs/{id}, с ожиданием изменений) или подписывается
+на события (SSE). Выполняют задания фоновые исполнители; задания, прерванные
+остановкой сервера, после перезапуска возвращаются в очередь. Одинаковые
+задания (тот же URL и параметры) не дублируются: пока задание в очереди или
+выполняется, а также в течение JOBS_DEDUPE_WINDOW после успешного завершения
+отдаётся уже существующее.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from backend.config import settings
+from backend.models.schemas import JobInfo, ParsedContent
+from backend.services.browser_supervisor import browser_supervisor
+from backend.services.cache_service import make_cache_key
+from backend.services.history_service import history_service
+from backend.services.parser_service import canonicalize_url
+from backend.services.pipeline_service import pipeline_service, ParseError
+from backend.services.usage_ledger import usage_scope
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.jobs")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    input_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_input_key ON jobs (input_key, created_at);
+"""
+
+_COLUMNS = (
+    "id", "input_key", "url", "params", "status", "phase", "attempts",
+    "created_at", "started_at", "finished_at", "result", "error"
+)
+
+# Статусы: queued -> running -> done | failed; фазы выполнения: queued, parsing, analyzing, done, failed
+FINISHED = ("done", "failed")
+
+
+@dataclass
+class Job:
+    """Задание и его состояние"""
+    id: str
+    input_key: str
+    url: str
+    params: dict
+    status: str
+    phase: str
+    attempts: int
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "Job":
+        data = dict(zip(_COLUMNS, row))
+        data["params"] = json.loads(data["params"])
+        data["result"] = json.loads(data["result"]) if data["result"] else None
+        return cls(**data)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp).isoformat(timespec="seconds") if timestamp else None
+
+
+def job_info(job: Job, deduplicated: bool = False) -> JobInfo:
+    """Задание в формате ответа API"""
+    duration = None
+    if job.started_at:
+        duration = round((job.finished_at or time.time()) - job.started_at, 2)
+    return JobInfo(
+        id=job.id,
+        url=job.url,
+        status=job.status,
+        phase=job.phase,
+        attempts=job.attempts,
+        created_at=_iso(job.created_at),
+        started_at=_iso(job.started_at),
+        finished_at=_iso(job.finished_at),
+        duration=duration,
+        deduplicated=deduplicated,
+        result=ParsedContent.model_validate(job.result) if job.result else None,
+        error=job.error
+    )
+
+
+class JobService:
+    """Очередь заданий в SQLite и фоновые исполнители"""
+
+    def __init__(self):
+        logger.info("=" * 50)
+        logger.info("Инициализация очереди заданий")
+
+        self.enabled = settings.jobs_enabled
+        self.db_file = Path(settings.jobs_db_file)
+        self.workers = max(1, min(settings.jobs_workers, browser_supervisor.capacity))
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # Очередь создаётся в start(): на Python 3.9 asyncio.Queue, созданная
+        # при импорте, привязывается к другому event loop
+        self._queue: Optional["asyncio.Queue[str]"] = None
+        self._tasks: List[asyncio.Task] = []
+        # Ожидающие изменений задания (long-poll и SSE): id -> событие
+        self._changed: Dict[str, asyncio.Event] = {}
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.completed = 0
+        self.failed = 0
+        self.recovered = 0
+        self.run_seconds = 0.0
+
+        if self.enabled:
+            self._conn = self._connect()
+            logger.info(f"  Файл: {self.db_file}, исполнителей: {self.workers}")
+        else:
+            logger.info("  Очередь заданий выключена")
+
+        logger.info("Очередь заданий инициализирована ✓")
+        logger.info("=" * 50)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db_file.parent != Path("."):
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    # === Хранилище ===
+
+    def _fetch(self, job_id: str) -> Optional[Job]:
+        with self._db_lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return Job.from_row(row) if row else None
+
+    def _update(self, job_id: str, **fields):
+        if "result" in fields and fields["result"] is not None:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False, default=str)
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._db_lock:
+            try:
+                self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def _insert_or_reuse(self, job: Job, reuse_done_after: float) -> Tuple[Job, bool]:
+        """Вставить задание или вернуть существующее с тем же input_key"""
+        with self._db_lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE input_key = ? "
+                "AND (status IN ('queued', 'running') OR (status = 'done' AND finished_at >= ?)) "
+                "ORDER BY created_at DESC LIMIT 1",
+                (job.input_key, reuse_done_after)
+            ).fetchone()
+            if row:
+                return Job.from_row(row), True
+            self._conn.execute(
+                f"INSERT INTO jobs ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                (
+                    job.id, job.input_key, job.url, json.dumps(job.params), job.status, job.phase,
+                    job.attempts, job.created_at, None, None, None, None
+                )
+            )
+            self._conn.commit()
+        return job, False
+
+    def _recover(self) -> List[str]:
+        """Вернуть в очередь задания, прерванные остановкой сервера; id заданий в очереди"""
+        with self._db_lock:
+            self.recovered = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', phase = 'queued' WHERE status = 'running' AND attempts < ?",
+                (settings.jobs_max_attempts,)
+            ).rowcount
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', phase = 'failed', finished_at = ?, "
+                "error = 'Задание прервано перезапуском сервера слишком много раз' WHERE status = 'running'",
+                (time.time(),)
+            )
+            cutoff = time.time() - settings.jobs_retention_hours * 3600
+            deleted = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,)
+            ).rowcount
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+            ).fetchall()
+        if deleted:
+            logger.info(f"  🗑️ Удалено старых заданий: {deleted}")
+        return [row[0] for row in rows]
+
+    def _claim(self, job_id: str) -> Optional[Job]:
+        """Перевести задание из очереди в работу (None — уже взято или удалено)"""
+        with self._db_lock:
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = 'running', phase = 'parsing', started_at = ?, attempts = attempts + 1 "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            ).rowcount
+            self._conn.commit()
+        return self._fetch(job_id) if claimed else None
+
+    def _counts(self) -> Dict[str, int]:
+        with self._db_lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    # === Уведомления ===
+
+    def _notify(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _set(self, job_id: str, **fields):
+        await asyncio.to_thread(self._update, job_id, **fields)
+        self._notify(job_id)
+
+    # === API ===
+
+    async def submit(
+        self,
+        url: str,
+        use_cache: bool = True,
+        screenshot: Optional[bool] = None,
+        max_age: Optional[float] = None
+    ) -> Tuple[Job, bool]:
+        """Поставить задание в очередь; (задание, True) если такое уже есть"""
+        url = url.strip()
+        if screenshot is None:
+            screenshot = settings.parser_screenshot
+        params = {"use_cache": use_cache, "screenshot": screenshot, "max_age": max_age}
+        job = Job(
+            id=uuid.uuid4().hex,
+            input_key=make_cache_key("job", canonicalize_url(url), json.dumps(params, sort_keys=True)),
+            url=url,
+            params=params,
+            status="queued",
+            phase="queued",
+            attempts=0,
+            created_at=time.time()
+        )
+        # no_cache — нужен свежий результат: переиспользуем только незавершённое задание
+        window = settings.jobs_dedupe_window if use_cache else 0
+        job, existing = await asyncio.to_thread(self._insert_or_reuse, job, time.time() - window)
+        if existing:
+            self.deduplicated += 1
+            logger.info(f"📋 Задание {job.id} уже есть ({job.status}): {url}")
+        else:
+            self.submitted += 1
+            # До start() задание остаётся в базе как queued и подхватится восстановлением
+            if self._queue is not None:
+                self._queue.put_nowait(job.id)
+            logger.info(f"📋 Задание {job.id} в очереди: {url}")
+        return job, existing
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self._fetch, job_id)
+
+    async def wait(self, job_id: str, timeout: float, phase: Optional[str] = None) -> Optional[Job]:
+        """
+        Дождаться изменения задания (long-poll)
+
+        Возвращается, когда фаза отличается от phase (без phase — когда задание
+        завершено) или по истечении timeout.
+        """
+        deadline = time.time() + min(max(timeout, 0), settings.jobs_poll_timeout)
+        while True:
+            # Событие создаётся до чтения, чтобы не пропустить изменение между ними
+            event = self._changed.setdefault(job_id, asyncio.Event())
+            job = await self.get(job_id)
+            if job is None or job.finished or (phase is not None and job.phase != phase):
+                return job
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return job
+            try:
+                await asyncio.wait_for(event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return job
+
+    async def watch(self, job_id: str) -> AsyncIterator[dict]:
+        """События задания для SSE: phase при каждой смене фазы, затем result или error"""
+        phase = None
+        while True:
+            event = self._changed.setdefault(job_id, asyncio.Event())
+            job = await self.get(job_id)
+            if job is None:
+                yield {"type": "error", "error": "Задание не найдено"}
+                return
+            if job.phase != phase:
+                phase = job.phase
+                yield {"type": "phase", "phase": job.phase, "status": job.status}
+            if job.finished:
+                info = job_info(job)
+                if job.status == "done":
+                    yield {"type": "result", "data": info.result.model_dump() if info.result else None}
+                else:
+                    yield {"type": "error", "error": job.error}
+                return
+            try:
+                await asyncio.wait_for(event.wait(), timeout=settings.jobs_poll_timeout)
+            except asyncio.TimeoutError:
+                # Поддерживаем соединение через прокси
+                yield {"type": "ping"}
+
+    # === Выполнение ===
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            job = await asyncio.to_thread(self._claim, job_id)
+            if job is None:
+                continue
+            self._notify(job_id)
+            try:
+                await self._run(job)
+            except Exception as e:
+                # Даже пометить задание не удалось (база недоступна) — исполнитель продолжает работу,
+                # а задание, оставшееся running, вернётся в очередь при перезапуске
+                logger.error(f"  ❌ Задание {job.id}: не удалось сохранить итог: {e}")
+
+    async def _run(self, job: Job):
+        logger.info(f"📋 Выполнение задания {job.id}: {job.url}")
+        start = time.time()
+        params = job.params
+        try:
+            with usage_scope(endpoint="/jobs", competitor=urlsplit(canonicalize_url(job.url)).hostname):
+                parsed = await pipeline_service.parse(job.url, params["screenshot"], params["max_age"])
+                await self._set(job.id, phase="analyzing")
+                content = await pipeline_service.analyze(job.url, parsed, params["use_cache"], params["screenshot"])
+
+            analysis = content.analysis
+            try:
+                await history_service.add_entry(
+                    request_type="parse",
+                    request_summary=f"URL: {job.url}",
+                    response_summary=analysis.summary[:100] if analysis.summary else f"Title: {content.title or 'N/A'}",
+                    url=job.url
+                )
+            except Exception as e:
+                # Результат уже получен — без записи в истории задание всё равно выполнено
+                logger.warning(f"  ⚠ Задание {job.id}: запись в историю не добавлена: {e}")
+            await self._set(
+                job.id, status="done", phase="done", finished_at=time.time(), result=content.model_dump(mode="json")
+            )
+        except asyncio.CancelledError:
+            # Остановка сервера: задание остаётся running и вернётся в очередь при запуске
+            raise
+        except Exception as e:
+            if not isinstance(e, ParseError):
+                logger.error(f"  ❌ Задание {job.id} не выполнено: {e}")
+            self.failed += 1
+            await self._set(job.id, status="failed", phase="failed", finished_at=time.time(), error=str(e)[:1000])
+            return
+
+        self.completed += 1
+        self.run_seconds += time.time() - start
+        logger.info(f"  ✅ Задание {job.id} выполнено за {time.time() - start:.2f} сек")
+
+    def start(self):
+        """Восстановить очередь и запустить исполнителей (в работающем event loop)"""
+        if not self.enabled or self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        queued = self._recover()
+        for job_id in queued:
+            self._queue.put_nowait(job_id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(
+            f"📋 Очередь заданий запущена: в очереди {len(queued)} (возвращено после перезапуска: {self.recovered}), "
+            f"{self.workers} исполнителей"
+        )
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict:
+        if not self.enabled or self._conn is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "workers": self.workers,
+            "statuses": self._counts(),
+            "queue": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "completed": self.completed,
+            "failed": self.failed,
+            "recovered": self.recovered,
+            "avg_run_seconds": round(self.run_seconds / self.completed, 2) if self.completed else None
+        }
+
+
+# Глобальный экземпляр
+job_service = JobService()
@@ -0,0 +1,197 @@
+"""
+Инкрементальный толерантный парсер JSON-ответов модели
+
+Разбирает ответ по мере поступления токенов и отдаёт события, как только
+очередное поле верхнего уровня или элемент массива полностью получены.
+Пропускает текст и markdown-ограждения до первой `{` и всё после закрывающей `}`.
+"""
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+# Логгер для парсера
+logger = logging.getLogger("competitor_monitor.json_stream")
+
+_WHITESPACE = " \t\r\n"
+_DELIMITERS = ",}]" + _WHITESPACE
+
+
+def _scan_string(buf: str, start: int) -> Optional[int]:
+    """Конец строки, начинающейся с кавычки в позиции start (индекс после кавычки)"""
+    i = start + 1
+    n = len(buf)
+    while i < n:
+        ch = buf[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == '"':
+            return i + 1
+        i += 1
+    return None
+
+
+def _scan_value(buf: str, start: int, final: bool = False) -> Optional[int]:
+    """Конец JSON значения, начинающегося в позиции start, или None если оно неполное"""
+    ch = buf[start]
+    if ch == '"':
+        return _scan_string(buf, start)
+
+    if ch in "{[":
+        depth = 0
+        i = start
+        n = len(buf)
+        while i < n:
+            ch = buf[i]
+            if ch == '"':
+                end = _scan_string(buf, i)
+                if end is None:
+                    return None
+                i = end
+                continue
+            if ch in "{[":
+                depth += 1
+            elif ch in "}]":
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+        return None
+
+    # Число или литерал: завершены, когда дальше идёт разделитель
+    i = start
+    n = len(buf)
+    while i < n and buf[i] not in _DELIMITERS:
+        i += 1
+    if i < n or final:
+        return i
+    return None
+
+
+class IncrementalJSONParser:
+    """Потоковый разбор JSON объекта верхнего уровня
+
+    feed() возвращает список событий:
+      ("field", key, value)        — скалярное поле или вложенный объект получен целиком
+      ("item", key, index, value)  — очередной элемент массива
+      ("array", key, values)       — массив закрыт
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._state = "seek"  # seek -> key -> colon -> value -> (array) -> comma -> done
+        self._key: Optional[str] = None
+        self._items: List[Any] = []
+        self.data: Dict[str, Any] = {}
+        self.errors = 0
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def _skip_ws(self):
+        buf = self._buf
+        while self._pos < len(buf) and buf[self._pos] in _WHITESPACE:
+            self._pos += 1
+
+    def _decode(self, raw: str) -> Tuple[bool, Any]:
+        try:
+            return True, json.loads(raw)
+        except json.JSONDecodeError as e:
+            self.errors += 1
+            logger.debug(f"Пропущено некорректное значение: {raw[:80]!r} ({e})")
+            return False, None
+
+    def feed(self, chunk: str, final: bool = False) -> list:
+        """Добавить фрагмент ответа и вернуть новые события"""
+        self._buf += chunk
+        events = []
+        buf = self._buf
+
+        while True:
+            self._skip_ws()
+            if self._pos >= len(buf) or self._state == "done":
+                break
+            ch = buf[self._pos]
+
+            if self._state == "seek":
+                idx = buf.find("{", self._pos)
+                if idx < 0:
+                    self._pos = len(buf)
+                    break
+                self._pos = idx + 1
+                self._state = "key"
+
+            elif self._state == "key":
+                if ch == "}":
+                    self._pos += 1
+                    self._state = "done"
+                    continue
+                if ch == ",":
+                    self._pos += 1
+                    continue
+                if ch != '"':
+                    # Мусор вместо ключа — пропускаем символ
+                    self._pos += 1
+                    continue
+                end = _scan_string(buf, self._pos)
+                if end is None:
+                    break
+                ok, key = self._decode(buf[self._pos:end])
+                self._pos = end
+                self._key = key if ok else None
+                self._state = "colon"
+
+            elif self._state == "colon":
+                self._pos += 1
+                if ch == ":":
+                    self._state = "value"
+
+            elif self._state == "value":
+                if ch == "[":
+                    self._pos += 1
+                    self._items = []
+                    self._state = "array"
+                    continue
+                end = _scan_value(buf, self._pos, final)
+                if end is None:
+                    break
+                ok, value = self._decode(buf[self._pos:end])
+                self._pos = end
+                if ok and self._key is not None:
+                    self.data[self._key] = value
+                    events.append(("field", self._key, value))
+                self._state = "key"
+
+            elif self._state == "array":
+                if ch == ",":
+                    self._pos += 1
+                    continue
+                if ch == "]":
+                    self._pos += 1
+                    if self._key is not None:
+                        self.data[self._key] = self._items
+                        events.append(("array", self._key, self._items))
+                    self._state = "key"
+                    continue
+                end = _scan_value(buf, self._pos, final)
+                if end is None:
+                    break
+                ok, value = self._decode(buf[self._pos:end])
+                self._pos = end
+                if ok:
+                    self._items.append(value)
+                    if self._key is not None:
+                        events.append(("item", self._key, len(self._items) - 1, value))
+
+        return events
+
+    def close(self) -> list:
+        """Завершить разбор: дописать незакрытый массив и числовые поля в конце"""
+        events = self.feed("", final=True)
+        if self._state == "array" and self._key is not None:
+            self.data[self._key] = self._items
+            events.append(("array", self._key, self._items))
+            self._state = "key"
+        return events
@@ -2,21 +2,163 @@
 Сервис для работы с ProxyAPI (OpenAI-совместимый API)
 https://proxyapi.ru/docs/openai-text-generation
 """
+import asyncio
 import base64
-import json
-import re
+import copy
+import functools
 import time
 import logging
-from typing import Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Type
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
+from pydantic import BaseModel, ConfigDict, ValidationError, create_model
+from pydantic_core import PydanticUndefined
 
 from backend.config import settings
-from backend.models.schemas import CompetitorAnalysis, ImageAnalysis
+from backend.models.schemas import CompetitorAnalysis, ImageAnalysis, PageDetails
+from backend.services.cache_service import (
+    AnalysisCache,
+    PerceptualCache,
+    dhash,
+    make_cache_key,
+    normalize_text
+)
+from backend.services.json_stream import IncrementalJSONParser
+from backend.services.cancellation import cancellation
+from backend.services.deadline import with_deadline
+from backend.services.rate_limiter import upstream_governor
+from backend.services.usage_ledger import usage_ledger, set_cache_status
+from backend.services.image_service import decoded_size, image_service
 
 # Логгер для сервиса
 logger = logging.getLogger("competitor_monitor.openai")
 
+# Версия промпта анализа текста — входит в ключ кэша,
+# при изменении промпта версию нужно поднять
+TEXT_PROMPT_VERSION = "text-v1"
+TEXT_TEMPERATURE = 0.7
+TEXT_MAX_TOKENS = 2000
+VISION_TEMPERATURE = 0.7
+IMAGE_MAX_TOKENS = 2000
+SCREENSHOT_MAX_TOKENS = 3000
+IMAGE_PROMPT_VERSION = "image-v1"
+SCREENSHOT_PROMPT_VERSION = "screenshot-v1"
+
+TEXT_SYSTEM_PROMPT = """Ты — эксперт по конкурентному анализу и маркетингу. Проанализируй предоставленный текст конкурента и верни структурированный JSON-ответ.
+
+Оцени текст по модели AIDA (Attention — привлечение внимания, Interest — интерес, Desire — желание, Action — призыв к действию). Дай общую оценку 0-10 и краткий анализ.
+
+Формат ответа (строго JSON):
+{
+    "aida_score": 7,
+    "aida_analysis": "Краткий анализ: насколько текст соответствует AIDA: внимание (заголовок), интерес (детали), желание (выгоды), действие (CTA)",
+    "strengths": ["сильная сторона 1", "сильная сторона 2", ...],
+    "weaknesses": ["слабая сторона 1", "слабая сторона 2", ...],
+    "unique_offers": ["уникальное предложение 1", "уникальное предложение 2", ...],
+    "recommendations": ["рекомендация 1", "рекомендация 2", ...],
+    "summary": "Краткое резюме анализа"
+}
+
+Важно:
+- aida_score: число от 0 до 10
+- Каждый массив должен содержать 3-5 пунктов
+- Пиши на русском языке
+- Будь конкретен и практичен в рекомендациях"""
+
+IMAGE_SYSTEM_PROMPT = """Ты — эксперт по визуальному маркетингу и дизайну. Проанализируй изображение конкурента (баннер, сайт, упаковка товара и т.д.) и верни структурированный JSON-ответ.
+
+Формат ответа (строго JSON):
+{
+    "description": "Детальное описание того, что изображено",
+    "marketing_insights": ["инсайт 1", "инсайт 2", ...],
+    "visual_style_score": 7,
+    "visual_style_analysis": "Анализ визуального стиля конкурента",
+    "animation_potential": 6,
+    "animation_potential_analysis": "Краткое пояснение: какие элементы подходят для анимации и почему (не более 3 предложений)",
+    "recommendations": ["рекомендация 1", "рекомендация 2", ...]
+}
+
+Важно:
+- visual_style_score от 0 до 10 — оценка визуального стиля
+- animation_potential от 0 до 10 — потенциал изображения для анимации (насколько легко/эффектно можно анимировать элементы, есть ли динамика, движение глаз, возможности для motion design)
+- animation_potential_analysis — пояснение оценки потенциала анимации, не более 3 предложений
+- Каждый массив должен содержать 3-5 пунктов
+- Пиши на русском языке
+- Оценивай: цветовую палитру, типографику, композицию, UX/UI элементы"""
+
+SCREENSHOT_SYSTEM_PROMPT = """Ты — эксперт по конкурентному анализу и UX/UI дизайну. Проанализируй скриншот сайта конкурента и верни структурированный JSON-ответ.
+
+Оцени контент страницы по модели AIDA (Attention — привлечение внимания, Interest — интерес, Desire — желание, Action — призыв к действию). Дай общую оценку 0-10 и краткий анализ.
+
+Формат ответа (строго JSON):
+{
+    "aida_score": 7,
+    "aida_analysis": "Краткий анализ: насколько страница соответствует AIDA",
+    "strengths": ["сильная сторона 1", "сильная сторона 2", ...],
+    "weaknesses": ["слабая сторона 1", "слабая сторона 2", ...],
+    "unique_offers": ["уникальное предложение/фича 1", "уникальное предложение/фича 2", ...],
+    "recommendations": ["рекомендация 1", "рекомендация 2", ...],
+    "summary": "Комплексное резюме анализа сайта конкурента"
+}
+
+При анализе обращай внимание на:
+- Дизайн и визуальный стиль (цвета, шрифты, композиция)
+- UX/UI: навигация, расположение элементов, CTA кнопки
+- Контент: заголовки, тексты, призывы к действию
+- Уникальные торговые предложения (УТП)
+- Целевая аудитория (на кого ориентирован сайт)
+- Технологичность и современность дизайна
+
+Важно:
+- Каждый массив должен содержать 4-6 конкретных пунктов
+- Пиши на русском языке
+- Будь конкретен и практичен
+- Давай actionable рекомендации"""
+
+
+class StructuredOutputError(ValueError):
+    """Ответ модели не удалось привести к схеме даже после исправления"""
+
+
+def strict_json_schema(model_cls: Type[BaseModel]) -> Dict[str, Any]:
+    """JSON Schema модели в строгом виде для structured outputs
+
+    Все поля обязательные, лишние запрещены, default/title удалены —
+    этого требует режим strict.
+    """
+    def clean(node: Any) -> Any:
+        if isinstance(node, dict):
+            node = {k: clean(v) for k, v in node.items() if k not in ("default", "title")}
+            if node.get("type") == "object" and "properties" in node:
+                node["required"] = list(node["properties"])
+                node["additionalProperties"] = False
+            return node
+        if isinstance(node, list):
+            return [clean(item) for item in node]
+        return node
+
+    return clean(model_cls.model_json_schema())
+
+
+@functools.lru_cache(maxsize=None)
+def strict_model(model_cls: Type[BaseModel]) -> Type[BaseModel]:
+    """Копия модели для проверки ответа: все поля обязательные, лишние запрещены
+
+    У моделей ответа у всех полей есть значения по умолчанию, поэтому пустой
+    объект или обёртка вида {"analysis": {...}} прошли бы проверку как
+    пустой анализ. Строгая копия совпадает со схемой из strict_json_schema.
+    """
+    fields = {}
+    for name, field in model_cls.model_fields.items():
+        required = copy.copy(field)
+        required.default = PydanticUndefined
+        required.default_factory = None
+        fields[name] = (field.annotation, required)
+    return create_model(
+        f"{model_cls.__name__}Strict", __config__=ConfigDict(extra="forbid"), __doc__=model_cls.__doc__, **fields
+    )
+
 
 class OpenAIService:
     """Сервис для анализа через ProxyAPI"""
@@ -29,43 +171,500 @@ class OpenAIService:
         logger.info(f"  Модель vision: {settings.openai_vision_model}")
         logger.info(f"  API ключ: {'*' * 10}...{settings.proxy_api_key[-4:] if settings.proxy_api_key else 'НЕ ЗАДАН'}")
         
+        # Общий keep-alive пул соединений: все запросы к API идут через него,
+        # поэтому параллельные эндпоинты не блокируют event loop и друг друга
+        self.http_client = self._create_http_client()
+        
         # ProxyAPI - OpenAI-совместимый API для России
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             api_key=settings.proxy_api_key,
-            base_url=settings.proxy_api_base_url
+            base_url=settings.proxy_api_base_url,
+            http_client=self.http_client,
+            timeout=settings.openai_timeout,
+            # Повторы выполняет upstream_governor с учётом Retry-After
+            max_retries=0
         )
         self.model = settings.openai_model
         self.vision_model = settings.openai_vision_model
         
+        # Схемы ответов для structured outputs
+        self.response_formats = {
+            CompetitorAnalysis: self._response_format(CompetitorAnalysis, "competitor_analysis"),
+            ImageAnalysis: self._response_format(ImageAnalysis, "image_analysis")
+        }
+        self.repairs = 0
+        self.repair_failures = 0
+        
+        # Средняя длительность анализа (EMA, с очередью и повторами) — по ней
+        # конвейер решает, укладывается ли vision анализ в бюджет запроса
+        self.latency_ema = {
+            "text": settings.text_latency_estimate,
+            "vision": settings.vision_latency_estimate
+        }
+        self.latency_samples = {"text": 0, "vision": 0}
+        
+        # Кэш результатов анализа текста
+        self.text_cache = AnalysisCache("text") if settings.cache_enabled else None
+        # Кэши vision анализа по перцептивному хэшу изображения
+        self.image_cache = PerceptualCache("image") if settings.cache_enabled else None
+        self.screenshot_cache = PerceptualCache("screenshot") if settings.cache_enabled else None
+        
         logger.info("OpenAI сервис инициализирован успешно ✓")
         logger.info("=" * 50)
     
-    def _parse_json_response(self, content: str) -> dict:
-        """Извлечь JSON из ответа модели"""
-        logger.debug(f"Парсинг JSON ответа, длина: {len(content)} символов")
+    def _create_http_client(self) -> httpx.AsyncClient:
+        """Создать общий HTTP клиент с настроенным пулом соединений"""
+        http2 = settings.openai_http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.info("  HTTP/2 недоступен (пакет h2 не установлен), используется HTTP/1.1")
+                http2 = False
+        
+        limits = httpx.Limits(
+            max_connections=settings.openai_max_connections,
+            max_keepalive_connections=settings.openai_max_keepalive_connections,
+            keepalive_expiry=settings.openai_keepalive_expiry
+        )
+        timeout = httpx.Timeout(
+            settings.openai_timeout,
+            connect=settings.openai_connect_timeout
+        )
+        
+        logger.info(f"  Пул соединений: max={limits.max_connections}, keep-alive={limits.max_keepalive_connections}")
+        logger.info(f"  Таймауты: connect={settings.openai_connect_timeout} сек, total={settings.openai_timeout} сек")
+        logger.info(f"  HTTP/2: {'да' if http2 else 'нет'}")
+        
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+    
+    async def warmup(self):
+        """Прогреть пул: заранее установить TCP/TLS соединения с API"""
+        count = settings.openai_warmup_connections
+        if count <= 0:
+            return
+        
+        logger.info(f"🔥 Прогрев соединений с API ({count} шт.)...")
+        start_time = time.time()
+        url = str(self.client.base_url).rstrip("/") + "/models"
+        headers = {"Authorization": f"Bearer {settings.proxy_api_key}"}
+        
+        results = await asyncio.gather(
+            *(self.http_client.get(url, headers=headers) for _ in range(count)),
+            return_exceptions=True
+        )
+        
+        errors = [r for r in results if isinstance(r, Exception)]
+        elapsed = time.time() - start_time
+        if errors:
+            logger.warning(f"  ⚠ Прогрев частично не удался ({len(errors)}/{count}): {errors[0]}")
+        else:
+            logger.info(f"  ✓ Соединения прогреты за {elapsed:.2f} сек")
+    
+    def expected_latency(self, budget: str) -> float:
+        """Ожидаемая длительность вызова анализа, сек (text или vision)"""
+        return self.latency_ema[budget]
+    
+    def _observe_latency(self, budget: str, seconds: float):
+        if self.latency_samples[budget] == 0:
+            self.latency_ema[budget] = seconds
+        else:
+            self.latency_ema[budget] = 0.7 * self.latency_ema[budget] + 0.3 * seconds
+        self.latency_samples[budget] += 1
+    
+    def latency_stats(self) -> dict:
+        return {
+            budget: {"expected": round(self.latency_ema[budget], 2), "samples": self.latency_samples[budget]}
+            for budget in self.latency_ema
+        }
+    
+    def cache_stats(self) -> dict:
+        """Статистика кэшей анализа"""
+        return {
+            "text": self.text_cache.stats() if self.text_cache else None,
+            "image": self.image_cache.stats() if self.image_cache else None,
+            "screenshot": self.screenshot_cache.stats() if self.screenshot_cache else None
+        }
+    
+    def clear_cache(self):
+        """Очистить кэши анализа"""
+        for cache in (self.text_cache, self.image_cache, self.screenshot_cache):
+            if cache:
+                cache.clear()
+    
+    async def close(self):
+        """Закрыть пул соединений"""
+        logger.info("Закрытие OpenAI сервиса...")
+        await self.client.close()
+        await self.http_client.aclose()
+        logger.info("OpenAI сервис закрыт ✓")
+    
+    @staticmethod
+    def _response_format(model_cls: Type[BaseModel], name: str) -> dict:
+        """Параметр response_format: строгая JSON Schema или просто JSON объект"""
+        if not settings.openai_structured_outputs:
+            return {"type": "json_object"}
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": name,
+                "schema": strict_json_schema(model_cls),
+                "strict": True
+            }
+        }
+    
+    @staticmethod
+    def _validate_content(model_cls: Type[BaseModel], content: str) -> BaseModel:
+        """Разобрать ответ сразу в модель (pydantic-core/jiter, без regex)
+
+        Если модель обернула JSON в markdown или текст — берём срез от первой
+        «{» до последней «}» и пробуем ещё раз. Проверка строгая (strict_model):
+        пропущенные и лишние поля — ошибка, а не анализ из значений по умолчанию.
+        """
+        strict = strict_model(model_cls)
+        try:
+            validated = strict.model_validate_json(content)
+        except ValidationError:
+            start = content.find("{")
+            end = content.rfind("}")
+            if start < 0 or end <= start or (start == 0 and end == len(content) - 1):
+                raise
+            validated = strict.model_validate_json(content[start:end + 1])
+        return model_cls.model_validate(validated.model_dump())
+    
+    async def _parse_or_repair(
+        self,
+        budget: str,
+        model: str,
+        model_cls: Type[BaseModel],
+        system_prompt: str,
+        content: str,
+        max_tokens: int
+    ) -> BaseModel:
+        """Провалидировать ответ; для действительно битого ответа — один запрос на исправление"""
+        try:
+            return self._validate_content(model_cls, content)
+        except ValidationError as e:
+            error = e
         
-        # Пробуем найти JSON в markdown блоке
-        json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', content)
-        if json_match:
-            content = json_match.group(1)
-            logger.debug("JSON найден в markdown блоке")
+        self.repairs += 1
+        errors = "; ".join(f"{'.'.join(map(str, err['loc'])) or 'root'}: {err['msg']}" for err in error.errors()[:5])
+        logger.warning(f"  ⚠ Ответ не соответствует схеме ({errors}), запрашиваем исправление")
+        logger.debug(f"  Проблемный контент: {content[:200]}...")
         
-        # Пробуем найти JSON объект
-        json_match = re.search(r'\{[\s\S]*\}', content)
-        if json_match:
-            content = json_match.group(0)
-            logger.debug("JSON объект извлечён")
+        # Исправление — текстовый запрос без изображения: нужен только формат
+        repair_messages = [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": (
+                    "Твой предыдущий ответ не соответствует требуемой JSON-схеме.\n"
+                    f"Ошибки: {errors}\n\n"
+                    f"Предыдущий ответ:\n{content[:6000]}\n\n"
+                    "Верни исправленный ответ строго в формате JSON по схеме, сохранив содержание."
+                )
+            }
+        ]
+        repaired = await self._complete(
+            budget, model, repair_messages, 0.0, max_tokens, self.response_formats[model_cls], kind="repair"
+        )
+        try:
+            result = self._validate_content(model_cls, repaired)
+        except ValidationError as e:
+            self.repair_failures += 1
+            raise StructuredOutputError(f"Модель вернула ответ не по схеме: {errors}") from e
         
+        logger.info("  ✓ Ответ исправлен")
+        return result
+    
+    def structured_stats(self) -> dict:
+        return {
+            "structured_outputs": settings.openai_structured_outputs,
+            "repairs": self.repairs,
+            "repair_failures": self.repair_failures
+        }
+    
+    async def image_phash(self, image_base64: str) -> Optional[int]:
+        """Перцептивный хэш изображения (None, если изображение не читается)"""
         try:
-            result = json.loads(content)
-            logger.debug(f"JSON успешно распарсен, ключей: {len(result)}")
-            return result
-        except json.JSONDecodeError as e:
-            logger.warning(f"Ошибка парсинга JSON: {e}")
-            logger.debug(f"Проблемный контент: {content[:200]}...")
-            return {}
+            image_bytes = base64.b64decode(image_base64)
+            return await asyncio.to_thread(dhash, image_bytes)
+        except Exception as e:
+            logger.warning(f"  ⚠ Не удалось вычислить перцептивный хэш: {e}")
+            return None
     
-    async def analyze_text(self, text: str) -> CompetitorAnalysis:
+    def text_cache_key(self, text: str) -> str:
+        """Ключ кэша анализа текста: текст, модель, версия промпта, параметры"""
+        return make_cache_key(
+            normalize_text(text),
+            self.model,
+            TEXT_PROMPT_VERSION,
+            TEXT_TEMPERATURE,
+            TEXT_MAX_TOKENS
+        )
+    
+    # === Формирование запросов ===
+    
+    def _text_messages(self, text: str) -> List[dict]:
+        return [
+            {"role": "system", "content": TEXT_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Проанализируй текст конкурента:\n\n{text}"}
+        ]
+    
+    def _image_messages(self, image_base64: str, mime_type: str, detail: str = "auto") -> List[dict]:
+        return [
+            {"role": "system", "content": IMAGE_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "Проанализируй это изображение конкурента с точки зрения маркетинга и дизайна:"
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{image_base64}",
+                            "detail": detail
+                        }
+                    }
+                ]
+            }
+        ]
+    
+    def _screenshot_messages(
+        self,
+        screenshot_base64: str,
+        context: str,
+        mime_type: str = "image/jpeg",
+        detail: str = "auto"
+    ) -> List[dict]:
+        return [
+            {"role": "system", "content": SCREENSHOT_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": f"Проведи комплексный конкурентный анализ этого сайта:\n\n{context}"
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{screenshot_base64}",
+                            "detail": detail
+                        }
+                    }
+                ]
+            }
+        ]
+    
+    @staticmethod
+    def _screenshot_context(
+        url: str,
+        title: Optional[str],
+        h1: Optional[str],
+        first_paragraph: Optional[str],
+        details: Optional[PageDetails] = None
+    ) -> str:
+        """Текстовый контекст страницы для анализа скриншота"""
+        context_parts = [f"URL сайта: {url}"]
+        if title:
+            context_parts.append(f"Title страницы: {title}")
+        if h1:
+            context_parts.append(f"Главный заголовок (H1): {h1}")
+        if first_paragraph:
+            context_parts.append(f"Текст на странице: {first_paragraph[:300]}")
+        context_parts.extend(OpenAIService._details_parts(details))
+        return "\n".join(context_parts)
+    
+    @staticmethod
+    def _parsed_content_text(
+        title: Optional[str],
+        h1: Optional[str],
+        paragraph: Optional[str],
+        details: Optional[PageDetails] = None
+    ) -> str:
+        """Собрать текст для анализа из распарсенных элементов страницы"""
+        content_parts = []
+        if title:
+            content_parts.append(f"Заголовок страницы (title): {title}")
+        if h1:
+            content_parts.append(f"Главный заголовок (H1): {h1}")
+        if paragraph:
+            content_parts.append(f"Первый абзац: {paragraph}")
+        content_parts.extend(OpenAIService._details_parts(details))
+        return "\n\n".join(content_parts)
+    
+    @staticmethod
+    def _details_parts(details: Optional[PageDetails]) -> List[str]:
+        """Расширенные данные страницы в виде строк для промпта"""
+        if details is None:
+            return []
+        parts = []
+        if details.meta_description:
+            parts.append(f"Meta description: {details.meta_description}")
+        og = {k: v for k, v in details.og_tags.items() if k in ("title", "description", "type", "site_name")}
+        if og:
+            parts.append("OpenGraph: " + "; ".join(f"{k}: {v}" for k, v in og.items()))
+        if details.headings:
+            parts.append("Структура заголовков:\n" + "\n".join(
+                f"{'  ' * (h.level - 1)}H{h.level}: {h.text}" for h in details.headings
+            ))
+        if len(details.paragraphs) > 1:
+            parts.append("Другие абзацы:\n" + "\n".join(f"- {p[:300]}" for p in details.paragraphs[1:]))
+        if details.ctas:
+            parts.append("Призывы к действию (кнопки): " + ", ".join(f"«{c.text}»" for c in details.ctas))
+        if details.price_samples:
+            parts.append("Цены на странице: " + ", ".join(details.price_samples))
+        return parts
+    
+    # === Вызовы API ===
+    
+    @staticmethod
+    def _estimate_tokens(messages: List[dict], max_tokens: int) -> int:
+        """Грубая оценка расхода токенов до запроса (~4 символа на токен, ~800 на изображение)"""
+        estimate = max_tokens
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                estimate += len(content) // 4
+                continue
+            for part in content:
+                if part["type"] == "text":
+                    estimate += len(part["text"]) // 4
+                else:
+                    estimate += 800
+        return estimate
+    
+    async def _complete(
+        self,
+        budget: str,
+        model: str,
+        messages: List[dict],
+        temperature: float,
+        max_tokens: int,
+        response_format: dict,
+        kind: str = "analysis"
+    ) -> str:
+        """Выполнить запрос к API и вернуть текст ответа (не дольше бюджета запроса)"""
+        usage_ledger.check_budget()
+        call_info = {}
+        start_time = time.monotonic()
+        try:
+            response = await with_deadline(
+                upstream_governor.call(
+                    budget,
+                    lambda: self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        response_format=response_format
+                    ),
+                    self._estimate_tokens(messages, max_tokens),
+                    call_info
+                ),
+                f"вызов API: {budget}"
+            )
+        except BaseException as e:
+            # Отмена (клиент отключился) прерывает HTTP запрос к API — в журнал она попадает как ошибка
+            if isinstance(e, asyncio.CancelledError):
+                cancellation.count("upstream_calls")
+            usage_ledger.record_call(model, kind, None, call_info.get("latency", 0.0), call_info.get("retries", 0), e)
+            raise
+        usage_ledger.record_call(model, kind, response.usage, call_info["latency"], call_info["retries"])
+        if kind == "analysis":
+            self._observe_latency(budget, time.monotonic() - start_time)
+        content = response.choices[0].message.content or ""
+        logger.info(f"  Длина ответа: {len(content)} символов")
+        logger.debug(f"  Использовано токенов: {response.usage.total_tokens if response.usage else 'N/A'}")
+        return content
+    
+    async def _stream_completion(
+        self,
+        budget: str,
+        model: str,
+        messages: List[dict],
+        temperature: float,
+        max_tokens: int,
+        response_format: dict
+    ) -> AsyncIterator[str]:
+        """Выполнить потоковый запрос к API и отдавать фрагменты текста по мере генерации"""
+        usage_ledger.check_budget()
+        call_info = {}
+        usage = None
+        start_time = None
+        try:
+            async with upstream_governor.slot(
+                budget,
+                lambda: self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    response_format=response_format,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                ),
+                self._estimate_tokens(messages, max_tokens),
+                call_info
+            ) as stream:
+                # Задержка считается до конца потока, без ожидания в очереди лимитов
+                start_time = time.monotonic() - call_info["latency"]
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        except BaseException as e:
+            if isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+                cancellation.count("upstream_calls")
+            latency = time.monotonic() - start_time if start_time is not None else call_info.get("latency", 0.0)
+            usage_ledger.record_call(model, "stream", usage, latency, call_info.get("retries", 0), e)
+            raise
+        usage_ledger.record_call(model, "stream", usage, time.monotonic() - start_time, call_info["retries"])
+    
+    # === Кэш ===
+    
+    async def _lookup_text_cache(self, text: str, use_cache: bool):
+        """Вернуть (ключ, закэшированный результат или None)"""
+        if not self.text_cache:
+            set_cache_status("off")
+            return None, None
+        cache_key = self.text_cache_key(text)
+        if not use_cache:
+            logger.info("  Кэш пропущен по запросу")
+            set_cache_status("bypass")
+            return cache_key, None
+        cached = await self.text_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"  ⚡ Результат из кэша (ключ {cache_key[:12]}...)")
+            usage_ledger.record_cache_hit(self.model)
+        else:
+            set_cache_status("miss")
+        return cache_key, cached
+    
+    async def _lookup_image_cache(self, cache: Optional[PerceptualCache], scope: str, image_base64: str, use_cache: bool):
+        """Вернуть (перцептивный хэш, закэшированный результат или None)"""
+        if not cache:
+            set_cache_status("off")
+            return None, None
+        phash = await self.image_phash(image_base64)
+        if phash is None or not use_cache:
+            set_cache_status("bypass" if phash is not None else "off")
+            return phash, None
+        cached = await cache.get(scope, phash)
+        if cached is not None:
+            logger.info(f"  ⚡ Результат из кэша '{cache.namespace}'")
+            usage_ledger.record_cache_hit(self.vision_model)
+        else:
+            set_cache_status("miss")
+        return phash, cached
+    
+    # === Анализ ===
+    
+    async def analyze_text(self, text: str, use_cache: bool = True) -> CompetitorAnalysis:
         """Анализ текста конкурента"""
         logger.info("=" * 50)
         logger.info("📝 АНАЛИЗ ТЕКСТА КОНКУРЕНТА")
@@ -73,63 +672,37 @@ class OpenAIService:
         logger.info(f"  Превью: {text[:100]}...")
         logger.info(f"  Модель: {self.model}")
         
-        system_prompt = """Ты — эксперт по конкурентному анализу и маркетингу. Проанализируй предоставленный текст конкурента и верни структурированный JSON-ответ.
-
-Оцени текст по модели AIDA (Attention — привлечение внимания, Interest — интерес, Desire — желание, Action — призыв к действию). Дай общую оценку 0-10 и краткий анализ.
-
-Формат ответа (строго JSON):
-{
-    "aida_score": 7,
-    "aida_analysis": "Краткий анализ: насколько текст соответствует AIDA: внимание (заголовок), интерес (детали), желание (выгоды), действие (CTA)",
-    "strengths": ["сильная сторона 1", "сильная сторона 2", ...],
-    "weaknesses": ["слабая сторона 1", "слабая сторона 2", ...],
-    "unique_offers": ["уникальное предложение 1", "уникальное предложение 2", ...],
-    "recommendations": ["рекомендация 1", "рекомендация 2", ...],
-    "summary": "Краткое резюме анализа"
-}
-
-Важно:
-- aida_score: число от 0 до 10
-- Каждый массив должен содержать 3-5 пунктов
-- Пиши на русском языке
-- Будь конкретен и практичен в рекомендациях"""
-
+        cache_key, cached = await self._lookup_text_cache(text, use_cache)
+        if cached is not None:
+            logger.info("=" * 50)
+            return CompetitorAnalysis(**cached)
+        
         start_time = time.time()
         logger.info("  Отправка запроса к API...")
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Проанализируй текст конкурента:\n\n{text}"}
-                ],
-                temperature=0.7,
-                max_tokens=2000
+            content = await self._complete(
+                "text",
+                self.model,
+                self._text_messages(text),
+                TEXT_TEMPERATURE,
+                TEXT_MAX_TOKENS,
+                self.response_formats[CompetitorAnalysis]
             )
             
             elapsed = time.time() - start_time
             logger.info(f"  ✓ Ответ получен за {elapsed:.2f} сек")
             
-            content = response.choices[0].message.content
-            logger.info(f"  Длина ответа: {len(content)} символов")
-            logger.debug(f"  Использовано токенов: {response.usage.total_tokens if response.usage else 'N/A'}")
-            
-            data = self._parse_json_response(content)
-            
-            result = CompetitorAnalysis(
-                aida_score=data.get("aida_score", 0),
-                aida_analysis=data.get("aida_analysis", ""),
-                strengths=data.get("strengths", []),
-                weaknesses=data.get("weaknesses", []),
-                unique_offers=data.get("unique_offers", []),
-                recommendations=data.get("recommendations", []),
-                summary=data.get("summary", "")
+            result = await self._parse_or_repair(
+                "text", self.model, CompetitorAnalysis, TEXT_SYSTEM_PROMPT, content, TEXT_MAX_TOKENS
             )
             
             logger.info(f"  Результат: AIDA={result.aida_score}/10, {len(result.strengths)} сильных, {len(result.weaknesses)} слабых сторон")
             logger.info("=" * 50)
             
+            if cache_key:
+                await self.text_cache.set(cache_key, result.model_dump())
+            
             return result
             
         except Exception as e:
@@ -138,85 +711,54 @@ class OpenAIService:
             logger.error("=" * 50)
             raise
     
-    async def analyze_image(self, image_base64: str, mime_type: str = "image/jpeg") -> ImageAnalysis:
+    async def analyze_image(
+        self,
+        image_base64: str,
+        mime_type: str = "image/jpeg",
+        use_cache: bool = True,
+        detail: str = "auto"
+    ) -> ImageAnalysis:
         """Анализ изображения (баннер, сайт, упаковка)"""
         logger.info("=" * 50)
         logger.info("🖼️ АНАЛИЗ ИЗОБРАЖЕНИЯ")
         logger.info(f"  Размер base64: {len(image_base64)} символов")
-        logger.info(f"  MIME тип: {mime_type}")
+        logger.info(f"  MIME тип: {mime_type}, detail: {detail}")
         logger.info(f"  Модель: {self.vision_model}")
         
-        system_prompt = """Ты — эксперт по визуальному маркетингу и дизайну. Проанализируй изображение конкурента (баннер, сайт, упаковка товара и т.д.) и верни структурированный JSON-ответ.
-
-Формат ответа (строго JSON):
-{
-    "description": "Детальное описание того, что изображено",
-    "marketing_insights": ["инсайт 1", "инсайт 2", ...],
-    "visual_style_score": 7,
-    "visual_style_analysis": "Анализ визуального стиля конкурента",
-    "animation_potential": 6,
-    "animation_potential_analysis": "Краткое пояснение: какие элементы подходят для анимации и почему (не более 3 предложений)",
-    "recommendations": ["рекомендация 1", "рекомендация 2", ...]
-}
-
-Важно:
-- visual_style_score от 0 до 10 — оценка визуального стиля
-- animation_potential от 0 до 10 — потенциал изображения для анимации (насколько легко/эффектно можно анимировать элементы, есть ли динамика, движение глаз, возможности для motion design)
-- animation_potential_analysis — пояснение оценки потенциала анимации, не более 3 предложений
-- Каждый массив должен содержать 3-5 пунктов
-- Пиши на русском языке
-- Оценивай: цветовую палитру, типографику, композицию, UX/UI элементы"""
-
+        cache_scope = f"{self.vision_model}|{IMAGE_PROMPT_VERSION}"
+        phash, cached = await self._lookup_image_cache(self.image_cache, cache_scope, image_base64, use_cache)
+        if cached is not None:
+            logger.info("=" * 50)
+            return ImageAnalysis(**cached)
+        
         start_time = time.time()
         logger.info("  Отправка запроса к Vision API...")
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.vision_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Проанализируй это изображение конкурента с точки зрения маркетинга и дизайна:"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{mime_type};base64,{image_base64}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=2000
+            content = await self._complete(
+                "vision",
+                self.vision_model,
+                self._image_messages(image_base64, mime_type, detail),
+                VISION_TEMPERATURE,
+                IMAGE_MAX_TOKENS,
+                self.response_formats[ImageAnalysis]
             )
             
             elapsed = time.time() - start_time
             logger.info(f"  ✓ Ответ получен за {elapsed:.2f} сек")
+            image_service.record_vision_latency(elapsed, decoded_size(image_base64))
             
-            content = response.choices[0].message.content
-            logger.info(f"  Длина ответа: {len(content)} символов")
-            
-            data = self._parse_json_response(content)
-            
-            result = ImageAnalysis(
-                description=data.get("description", ""),
-                marketing_insights=data.get("marketing_insights", []),
-                visual_style_score=data.get("visual_style_score", 5),
-                visual_style_analysis=data.get("visual_style_analysis", ""),
-                animation_potential=data.get("animation_potential", 5),
-                animation_potential_analysis=data.get("animation_potential_analysis", ""),
-                recommendations=data.get("recommendations", [])
+            result = await self._parse_or_repair(
+                "vision", self.vision_model, ImageAnalysis, IMAGE_SYSTEM_PROMPT, content, IMAGE_MAX_TOKENS
             )
             
             logger.info(f"  Результат: стиль {result.visual_style_score}/10, анимация {result.animation_potential}/10")
             logger.info(f"  Инсайтов: {len(result.marketing_insights)}, рекомендаций: {len(result.recommendations)}")
             logger.info("=" * 50)
             
+            if phash is not None:
+                await self.image_cache.set(cache_scope, phash, result.model_dump())
+            
             return result
             
         except Exception as e:
@@ -229,7 +771,9 @@ class OpenAIService:
         self, 
         title: Optional[str], 
         h1: Optional[str], 
-        paragraph: Optional[str]
+        paragraph: Optional[str],
+        use_cache: bool = True,
+        details: Optional[PageDetails] = None
     ) -> CompetitorAnalysis:
         """Анализ распарсенного контента сайта"""
         logger.info("📄 Анализ распарсенного контента")
@@ -237,15 +781,7 @@ class OpenAIService:
         logger.info(f"  H1: {h1[:50] if h1 else 'N/A'}...")
         logger.info(f"  Абзац: {paragraph[:50] if paragraph else 'N/A'}...")
         
-        content_parts = []
-        if title:
-            content_parts.append(f"Заголовок страницы (title): {title}")
-        if h1:
-            content_parts.append(f"Главный заголовок (H1): {h1}")
-        if paragraph:
-            content_parts.append(f"Первый абзац: {paragraph}")
-        
-        combined_text = "\n\n".join(content_parts)
+        combined_text = self._parsed_content_text(title, h1, paragraph, details)
         
         if not combined_text.strip():
             logger.warning("  ⚠ Контент пустой, возвращаем пустой анализ")
@@ -253,7 +789,7 @@ class OpenAIService:
                 summary="Не удалось извлечь контент для анализа"
             )
         
-        return await self.analyze_text(combined_text)
+        return await self.analyze_text(combined_text, use_cache=use_cache)
     
     async def analyze_website_screenshot(
         self,
@@ -261,7 +797,11 @@ class OpenAIService:
         url: str,
         title: Optional[str] = None,
         h1: Optional[str] = None,
-        first_paragraph: Optional[str] = None
+        first_paragraph: Optional[str] = None,
+        use_cache: bool = True,
+        mime_type: str = "image/jpeg",
+        detail: str = "auto",
+        details: Optional[PageDetails] = None
     ) -> CompetitorAnalysis:
         """Комплексный анализ сайта конкурента по скриншоту"""
         logger.info("=" * 50)
@@ -273,90 +813,35 @@ class OpenAIService:
         logger.info(f"  Модель: {self.vision_model}")
         
         # Формируем контекст из извлечённых данных
-        context_parts = [f"URL сайта: {url}"]
-        if title:
-            context_parts.append(f"Title страницы: {title}")
-        if h1:
-            context_parts.append(f"Главный заголовок (H1): {h1}")
-        if first_paragraph:
-            context_parts.append(f"Текст на странице: {first_paragraph[:300]}")
-        
-        context = "\n".join(context_parts)
+        context = self._screenshot_context(url, title, h1, first_paragraph, details)
         logger.debug(f"  Контекст:\n{context}")
         
-        system_prompt = """Ты — эксперт по конкурентному анализу и UX/UI дизайну. Проанализируй скриншот сайта конкурента и верни структурированный JSON-ответ.
-
-Оцени контент страницы по модели AIDA (Attention — привлечение внимания, Interest — интерес, Desire — желание, Action — призыв к действию). Дай общую оценку 0-10 и краткий анализ.
-
-Формат ответа (строго JSON):
-{
-    "aida_score": 7,
-    "aida_analysis": "Краткий анализ: насколько страница соответствует AIDA",
-    "strengths": ["сильная сторона 1", "сильная сторона 2", ...],
-    "weaknesses": ["слабая сторона 1", "слабая сторона 2", ...],
-    "unique_offers": ["уникальное предложение/фича 1", "уникальное предложение/фича 2", ...],
-    "recommendations": ["рекомендация 1", "рекомендация 2", ...],
-    "summary": "Комплексное резюме анализа сайта конкурента"
-}
-
-При анализе обращай внимание на:
-- Дизайн и визуальный стиль (цвета, шрифты, композиция)
-- UX/UI: навигация, расположение элементов, CTA кнопки
-- Контент: заголовки, тексты, призывы к действию
-- Уникальные торговые предложения (УТП)
-- Целевая аудитория (на кого ориентирован сайт)
-- Технологичность и современность дизайна
-
-Важно:
-- Каждый массив должен содержать 4-6 конкретных пунктов
-- Пиши на русском языке
-- Будь конкретен и практичен
-- Давай actionable рекомендации"""
-
+        # Визуально близкий скриншот с тем же текстовым контекстом — берём из кэша
+        cache_scope = make_cache_key(self.vision_model, SCREENSHOT_PROMPT_VERSION, normalize_text(context))
+        phash, cached = await self._lookup_image_cache(self.screenshot_cache, cache_scope, screenshot_base64, use_cache)
+        if cached is not None:
+            logger.info("=" * 50)
+            return CompetitorAnalysis(**cached)
+        
         start_time = time.time()
         logger.info("  Отправка скриншота в Vision API...")
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.vision_model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": f"Проведи комплексный конкурентный анализ этого сайта:\n\n{context}"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{screenshot_base64}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=3000
+            content = await self._complete(
+                "vision",
+                self.vision_model,
+                self._screenshot_messages(screenshot_base64, context, mime_type, detail),
+                VISION_TEMPERATURE,
+                SCREENSHOT_MAX_TOKENS,
+                self.response_formats[CompetitorAnalysis]
             )
             
             elapsed = time.time() - start_time
             logger.info(f"  ✓ Ответ получен за {elapsed:.2f} сек")
+            image_service.record_vision_latency(elapsed, decoded_size(screenshot_base64))
             
-            content = response.choices[0].message.content
-            logger.info(f"  Длина ответа: {len(content)} символов")
-            
-            data = self._parse_json_response(content)
-            
-            result = CompetitorAnalysis(
-                aida_score=data.get("aida_score", 0),
-                aida_analysis=data.get("aida_analysis", ""),
-                strengths=data.get("strengths", []),
-                weaknesses=data.get("weaknesses", []),
-                unique_offers=data.get("unique_offers", []),
-                recommendations=data.get("recommendations", []),
-                summary=data.get("summary", "")
+            result = await self._parse_or_repair(
+                "vision", self.vision_model, CompetitorAnalysis, SCREENSHOT_SYSTEM_PROMPT, content, SCREENSHOT_MAX_TOKENS
             )
             
             logger.info(f"  Результат:")
@@ -368,6 +853,9 @@ class OpenAIService:
             logger.info(f"  Резюме: {result.summary[:100]}...")
             logger.info("=" * 50)
             
+            if phash is not None:
+                await self.screenshot_cache.set(cache_scope, phash, result.model_dump())
+            
             return result
             
         except Exception as e:
@@ -375,6 +863,165 @@ class OpenAIService:
             logger.error(f"  ✗ Ошибка Vision API за {elapsed:.2f} сек: {e}")
             logger.error("=" * 50)
             raise
+    
+    # === Потоковый анализ ===
+    
+    @staticmethod
+    def _stream_event(event: tuple) -> dict:
+        """Преобразовать событие парсера в сообщение для клиента"""
+        if event[0] == "item":
+            _, field, index, value = event
+            return {"type": "item", "field": field, "index": index, "value": value}
+        _, field, value = event
+        return {"type": "field", "field": field, "value": value}
+    
+    def _replay_cached(self, result: dict) -> List[dict]:
+        """События для результата из кэша: все поля сразу"""
+        events = [{"type": "field", "field": key, "value": value} for key, value in result.items()]
+        events.append({"type": "result", "analysis": result, "cached": True})
+        return events
+    
+    async def _stream_analysis(
+        self,
+        budget: str,
+        model: str,
+        messages: List[dict],
+        temperature: float,
+        max_tokens: int,
+        model_cls: Type[BaseModel],
+        store: Callable[[dict], Awaitable[None]]
+    ) -> AsyncIterator[dict]:
+        """Потоковый запрос: отдаёт поля ответа по мере готовности, в конце — итоговую модель"""
+        parser = IncrementalJSONParser()
+        start_time = time.time()
+        first_event_at = None
+        chunks = []
+        
+        async for delta in self._stream_completion(
+            budget, model, messages, temperature, max_tokens, self.response_formats[model_cls]
+        ):
+            chunks.append(delta)
+            for event in parser.feed(delta):
+                if first_event_at is None:
+                    first_event_at = time.time() - start_time
+                    logger.info(f"  ⚡ Первое поле получено за {first_event_at:.2f} сек")
+                yield self._stream_event(event)
+        
+        for event in parser.close():
+            yield self._stream_event(event)
+        
+        elapsed = time.time() - start_time
+        logger.info(f"  ✓ Потоковый ответ завершён за {elapsed:.2f} сек, полей: {len(parser.data)}")
+        
+        # Итог валидируем по полному тексту ответа, битый ответ исправляем
+        system_prompt = messages[0]["content"]
+        result = (await self._parse_or_repair(
+            budget, model, model_cls, system_prompt, "".join(chunks), max_tokens
+        )).model_dump()
+        await store(result)
+        yield {"type": "result", "analysis": result, "cached": False}
+    
+    async def stream_text(self, text: str, use_cache: bool = True) -> AsyncIterator[dict]:
+        """Потоковый анализ текста конкурента"""
+        logger.info("📝 ПОТОКОВЫЙ АНАЛИЗ ТЕКСТА")
+        logger.info(f"  Длина текста: {len(text)} символов")
+        
+        cache_key, cached = await self._lookup_text_cache(text, use_cache)
+        if cached is not None:
+            for event in self._replay_cached(cached):
+                yield event
+            return
+        
+        async def store(result: dict):
+            if cache_key:
+                await self.text_cache.set(cache_key, result)
+        
+        async for event in self._stream_analysis(
+            "text", self.model, self._text_messages(text), TEXT_TEMPERATURE, TEXT_MAX_TOKENS,
+            CompetitorAnalysis, store
+        ):
+            yield event
+    
+    async def stream_parsed_content(
+        self,
+        title: Optional[str],
+        h1: Optional[str],
+        paragraph: Optional[str],
+        use_cache: bool = True,
+        details: Optional[PageDetails] = None
+    ) -> AsyncIterator[dict]:
+        """Потоковый анализ распарсенного контента сайта"""
+        combined_text = self._parsed_content_text(title, h1, paragraph, details)
+        if not combined_text.strip():
+            logger.warning("  ⚠ Контент пустой, возвращаем пустой анализ")
+            result = CompetitorAnalysis(summary="Не удалось извлечь контент для анализа").model_dump()
+            yield {"type": "result", "analysis": result, "cached": False}
+            return
+        
+        async for event in self.stream_text(combined_text, use_cache=use_cache):
+            yield event
+    
+    async def stream_image(
+        self,
+        image_base64: str,
+        mime_type: str = "image/jpeg",
+        use_cache: bool = True,
+        detail: str = "auto"
+    ) -> AsyncIterator[dict]:
+        """Потоковый анализ изображения"""
+        logger.info("🖼️ ПОТОКОВЫЙ АНАЛИЗ ИЗОБРАЖЕНИЯ")
+        logger.info(f"  Размер base64: {len(image_base64)} символов")
+        
+        cache_scope = f"{self.vision_model}|{IMAGE_PROMPT_VERSION}"
+        phash, cached = await self._lookup_image_cache(self.image_cache, cache_scope, image_base64, use_cache)
+        if cached is not None:
+            for event in self._replay_cached(cached):
+                yield event
+            return
+        
+        async def store(result: dict):
+            if phash is not None:
+                await self.image_cache.set(cache_scope, phash, result)
+        
+        async for event in self._stream_analysis(
+            "vision", self.vision_model, self._image_messages(image_base64, mime_type, detail), VISION_TEMPERATURE, IMAGE_MAX_TOKENS,
+            ImageAnalysis, store
+        ):
+            yield event
+    
+    async def stream_website_screenshot(
+        self,
+        screenshot_base64: str,
+        url: str,
+        title: Optional[str] = None,
+        h1: Optional[str] = None,
+        first_paragraph: Optional[str] = None,
+        use_cache: bool = True,
+        mime_type: str = "image/jpeg",
+        detail: str = "auto",
+        details: Optional[PageDetails] = None
+    ) -> AsyncIterator[dict]:
+        """Потоковый комплексный анализ сайта по скриншоту"""
+        logger.info("🌐 ПОТОКОВЫЙ АНАЛИЗ САЙТА")
+        logger.info(f"  URL: {url}")
+        
+        context = self._screenshot_context(url, title, h1, first_paragraph, details)
+        cache_scope = make_cache_key(self.vision_model, SCREENSHOT_PROMPT_VERSION, normalize_text(context))
+        phash, cached = await self._lookup_image_cache(self.screenshot_cache, cache_scope, screenshot_base64, use_cache)
+        if cached is not None:
+            for event in self._replay_cached(cached):
+                yield event
+            return
+        
+        async def store(result: dict):
+            if phash is not None:
+                await self.screenshot_cache.set(cache_scope, phash, result)
+        
+        async for event in self._stream_analysis(
+            "vision", self.vision_model, self._screenshot_messages(screenshot_base64, context, mime_type, detail), VISION_TEMPERATURE, SCREENSHOT_MAX_TOKENS,
+            CompetitorAnalysis, store
+        ):
+            yield event
 
 
 # Глобальный экземпляр
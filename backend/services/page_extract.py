@@ -0,0 +1,220 @@
+"""
+Извлечение данных страницы за один вызов execute_script
+
+Скрипт выполняется в браузере и возвращает всё сразу: title, заголовки,
+первые абзацы, кнопки призыва к действию, meta description, OpenGraph теги
+и фрагменты с ценами — вместо сотен отдельных запросов к WebDriver.
+Для страниц без JavaScript тот же набор данных извлекается из HTML через lxml.
+"""
+import re
+import logging
+from typing import Optional
+
+import lxml.html
+
+from backend.models.schemas import PageDetails
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.extract")
+
+# Минимальная длина абзаца, который считаем содержательным
+MIN_PARAGRAPH_LENGTH = 50
+MAX_HEADINGS = 30
+MAX_PARAGRAPHS = 5
+MAX_CTAS = 15
+MAX_PRICES = 10
+
+EXTRACT_SCRIPT = """
+const limits = arguments[0];
+const clean = (s) => (s || '').replace(/\\s+/g, ' ').trim();
+const visible = (el) => !!(el.offsetWidth || el.offsetHeight || el.getClientRects().length);
+const meta = (selector) => {
+    const el = document.querySelector(selector);
+    return el ? clean(el.getAttribute('content')) : null;
+};
+
+const headings = [];
+for (const el of document.querySelectorAll('h1, h2, h3, h4, h5, h6')) {
+    const text = clean(el.innerText);
+    if (text && visible(el)) headings.push({level: +el.tagName[1], text: text.slice(0, 200)});
+    if (headings.length >= limits.headings) break;
+}
+
+const paragraphs = [];
+for (const el of document.getElementsByTagName('p')) {
+    const text = clean(el.innerText);
+    if (text.length > limits.minParagraph) paragraphs.push(text.slice(0, 500));
+    if (paragraphs.length >= limits.paragraphs) break;
+}
+
+const ctas = [];
+const seen = new Set();
+const ctaSelector = 'button, input[type=submit], input[type=button], a[role=button], ' +
+    'a[class*=btn], a[class*=button], a[class*=cta], [class*=cta] a';
+for (const el of document.querySelectorAll(ctaSelector)) {
+    const text = clean(el.innerText || el.value || el.getAttribute('aria-label'));
+    if (!text || text.length < 2 || text.length > 60 || seen.has(text) || !visible(el)) continue;
+    seen.add(text);
+    ctas.push({text: text, href: el.getAttribute('href')});
+    if (ctas.length >= limits.ctas) break;
+}
+
+const og = {};
+for (const el of document.querySelectorAll('meta[property^="og:"]')) {
+    const key = el.getAttribute('property').slice(3);
+    if (key && !(key in og)) og[key] = clean(el.getAttribute('content')).slice(0, 300);
+}
+
+const prices = [];
+const body = (document.body ? document.body.innerText : '').slice(0, 200000);
+const num = String.raw`\\d{1,3}(?:[ \\u00a0.,]\\d{3})*(?:[.,]\\d{1,2})?`;
+const currency = String.raw`(?:₽|руб(?:лей|ля|ль|\\.)?|р\\.|USD|EUR|RUB|\\$|€|£)(?![\\p{L}])`;
+const priceRe = new RegExp(String.raw`[$€£₽][ \\u00a0]?` + num + '|' + num + String.raw`[ \\u00a0]?` + currency, 'gu');
+for (const match of body.matchAll(priceRe)) {
+    const text = clean(match[0]);
+    if (!prices.includes(text)) prices.push(text);
+    if (prices.length >= limits.prices) break;
+}
+
+const h1 = headings.find((h) => h.level === 1);
+return {
+    title: document.title,
+    h1: h1 ? h1.text : null,
+    meta_description: meta('meta[name="description"]'),
+    headings: headings,
+    paragraphs: paragraphs,
+    ctas: ctas,
+    og_tags: og,
+    price_samples: prices
+};
+"""
+
+EXTRACT_LIMITS = {
+    "headings": MAX_HEADINGS,
+    "paragraphs": MAX_PARAGRAPHS,
+    "ctas": MAX_CTAS,
+    "prices": MAX_PRICES,
+    "minParagraph": MIN_PARAGRAPH_LENGTH
+}
+
+
+def extract_in_browser(driver) -> dict:
+    """Выполнить скрипт извлечения и вернуть payload (один запрос к WebDriver)"""
+    return driver.execute_script(EXTRACT_SCRIPT, EXTRACT_LIMITS) or {}
+
+
+def details_from_payload(payload: dict) -> Optional[PageDetails]:
+    """Расширенные данные страницы из payload скрипта (None, если ничего не нашлось)"""
+    details = PageDetails(
+        meta_description=payload.get("meta_description") or None,
+        headings=payload.get("headings") or [],
+        paragraphs=payload.get("paragraphs") or [],
+        ctas=payload.get("ctas") or [],
+        og_tags=payload.get("og_tags") or {},
+        price_samples=payload.get("price_samples") or []
+    )
+    if not details.model_dump(exclude_defaults=True):
+        return None
+    return details
+
+
+# === Извлечение из HTML без браузера ===
+
+_NUM = r"\d{1,3}(?:[  .,]\d{3})*(?:[.,]\d{1,2})?"
+_PRICE_RE = re.compile(
+    rf"[$€£₽][  ]?{_NUM}|{_NUM}[  ]?(?:₽|руб(?:лей|ля|ль|\.)?|р\.|USD|EUR|RUB|\$|€|£)(?![^\W\d_])"
+)
+_CTA_XPATH = (
+    "//button | //input[@type='submit' or @type='button'] | //a[@role='button']"
+    " | //a[contains(@class, 'btn') or contains(@class, 'button') or contains(@class, 'cta')]"
+    " | //*[contains(@class, 'cta')]//a"
+)
+_DROP_XPATH = (
+    "//script | //style | //noscript | //template"
+    " | //*[@hidden or contains(translate(@style, ' ', ''), 'display:none')]"
+)
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.IGNORECASE)
+
+
+def _clean(text: Optional[str]) -> str:
+    return " ".join((text or "").split())
+
+
+def extract_from_html(html: bytes, encoding: Optional[str] = None) -> dict:
+    """Тот же payload, что и EXTRACT_SCRIPT, но из статического HTML (lxml)
+
+    encoding — кодировка из заголовка Content-Type; если её нет, берётся
+    из <meta charset>, иначе UTF-8.
+    """
+    if not encoding:
+        match = _META_CHARSET_RE.search(html[:4096])
+        encoding = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        parser = lxml.html.HTMLParser(encoding=encoding)
+    except LookupError:
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+    document = lxml.html.document_fromstring(html, parser=parser)
+    for element in document.xpath(_DROP_XPATH):
+        element.drop_tree()
+
+    title_element = document.find(".//title")
+    title = _clean(title_element.text_content()) if title_element is not None else ""
+
+    def meta(xpath: str) -> Optional[str]:
+        values = document.xpath(xpath)
+        return _clean(values[0]) if values else None
+
+    headings = []
+    for element in document.xpath("//h1 | //h2 | //h3 | //h4 | //h5 | //h6"):
+        text = _clean(element.text_content())
+        if text:
+            headings.append({"level": int(element.tag[1]), "text": text[:200]})
+        if len(headings) >= MAX_HEADINGS:
+            break
+
+    paragraphs = []
+    for element in document.iter("p"):
+        text = _clean(element.text_content())
+        if len(text) > MIN_PARAGRAPH_LENGTH:
+            paragraphs.append(text[:500])
+        if len(paragraphs) >= MAX_PARAGRAPHS:
+            break
+
+    ctas, seen = [], set()
+    for element in document.xpath(_CTA_XPATH):
+        text = _clean(element.text_content() or element.get("value") or element.get("aria-label"))
+        if len(text) < 2 or len(text) > 60 or text in seen:
+            continue
+        seen.add(text)
+        ctas.append({"text": text, "href": element.get("href")})
+        if len(ctas) >= MAX_CTAS:
+            break
+
+    og_tags = {}
+    for element in document.xpath("//meta[starts-with(@property, 'og:')]"):
+        key = element.get("property")[3:]
+        if key and key not in og_tags:
+            og_tags[key] = _clean(element.get("content"))[:300]
+
+    body = document.find("body")
+    body_text = _clean(body.text_content()) if body is not None else ""
+    prices = []
+    for match in _PRICE_RE.finditer(body_text[:200000]):
+        text = _clean(match.group(0))
+        if text not in prices:
+            prices.append(text)
+        if len(prices) >= MAX_PRICES:
+            break
+
+    h1 = next((h["text"] for h in headings if h["level"] == 1), None)
+    return {
+        "title": title,
+        "h1": h1,
+        "meta_description": meta("//meta[@name='description']/@content"),
+        "headings": headings,
+        "paragraphs": paragraphs,
+        "ctas": ctas,
+        "og_tags": og_tags,
+        "price_samples": prices,
+        "text_length": len(body_text)
+    }
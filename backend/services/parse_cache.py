@@ -0,0 +1,347 @@
+"""
+Кэш результатов парсинга страниц и хранилище скриншотов
+
+Результат parse_url (title, h1, абзацы, детали страницы, тайминги) хранится
+по каноническому URL с TTL: в памяти — LRU, ограниченный суммарным размером
+в байтах (вместе со скриншотами), на диске — JSON через AnalysisCache.
+Скриншоты лежат отдельно в хранилище, адресуемом по содержимому (SHA-256):
+одинаковый скриншот хранится один раз и пережимается без потерь.
+Повторный парсинг в пределах max_age не обращается ни к HTTP, ни к браузеру.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from PIL import Image
+
+from backend.config import settings
+from backend.models.schemas import PageDetails
+from backend.services.browser_worker import ParseResult
+from backend.services.cache_service import AnalysisCache, make_cache_key
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.parse_cache")
+
+
+def optimize_png(data: bytes) -> bytes:
+    """Пережать PNG без потерь; если не стало меньше — вернуть исходный"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            output = io.BytesIO()
+            image.save(output, format="PNG", optimize=True)
+    except Exception as e:
+        logger.debug(f"  Скриншот не пережат: {e}")
+        return data
+    optimized = output.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+
+class BlobStore:
+    """Файлы по SHA-256 содержимого с вытеснением давно не читавшихся"""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.writes = 0
+        self.deduplicated = 0
+        self.bytes_original = 0
+        self.bytes_stored = 0
+        self.evictions = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.glob("*/*.png"):
+            try:
+                size = path.stat().st_size
+            except OSError:
+                continue
+            self._index[path.stem] = size
+            self._bytes += size
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / f"{digest}.png"
+
+    def put(self, data: bytes) -> str:
+        """Сохранить содержимое и вернуть его адрес (повторная запись не выполняется)"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            known = digest in self._index
+        if known:
+            self.deduplicated += 1
+            try:
+                os.utime(self._path(digest))
+            except OSError:
+                pass
+            return digest
+
+        stored = optimize_png(data)
+        path = self._path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(stored)
+        os.replace(tmp, path)
+        with self._lock:
+            self._bytes += len(stored) - self._index.get(digest, 0)
+            self._index[digest] = len(stored)
+            self.writes += 1
+            self.bytes_original += len(data)
+            self.bytes_stored += len(stored)
+        self._evict()
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        path = self._path(digest)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._bytes -= self._index.pop(digest, 0)
+            return None
+        return data
+
+    def _delete(self, digest: str):
+        try:
+            self._path(digest).unlink()
+        except OSError:
+            pass
+        with self._lock:
+            self._bytes -= self._index.pop(digest, 0)
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        entries = []
+        for digest in list(self._index):
+            try:
+                entries.append((self._path(digest).stat().st_mtime, digest))
+            except OSError:
+                self._delete(digest)
+        entries.sort()
+        for _, digest in entries:
+            if self._bytes <= self.max_bytes:
+                break
+            self._delete(digest)
+            self.evictions += 1
+
+    def clear(self):
+        for digest in list(self._index):
+            self._delete(digest)
+
+    def stats(self) -> dict:
+        return {
+            "blobs": len(self._index),
+            "bytes": self._bytes,
+            "writes": self.writes,
+            "deduplicated": self.deduplicated,
+            "compression_ratio": round(self.bytes_stored / self.bytes_original, 3) if self.bytes_original else None,
+            "evictions": self.evictions
+        }
+
+
+def _result_to_record(result: ParseResult, screenshot_digest: Optional[str]) -> dict:
+    return {
+        "title": result.title,
+        "h1": result.h1,
+        "first_paragraph": result.first_paragraph,
+        "details": result.details.model_dump() if result.details else None,
+        "timings": result.timings,
+        "engine": result.engine,
+        "resources": result.resources,
+        "screenshot": screenshot_digest
+    }
+
+
+def _result_from_record(record: dict, screenshot: Optional[bytes], age: float) -> ParseResult:
+    return ParseResult(
+        title=record.get("title"),
+        h1=record.get("h1"),
+        first_paragraph=record.get("first_paragraph"),
+        details=PageDetails.model_validate(record["details"]) if record.get("details") else None,
+        screenshot=screenshot,
+        timings=dict(record.get("timings") or {}),
+        engine=record.get("engine") or "chrome",
+        resources=record.get("resources"),
+        cache_age=round(age, 1)
+    )
+
+
+class ParseCache:
+    """Результаты парсинга по каноническому URL: TTL, LRU по байтам, скриншоты в BlobStore"""
+
+    def __init__(self):
+        logger.info("=" * 50)
+        logger.info("Инициализация кэша парсинга")
+
+        self.enabled = settings.parse_cache_enabled
+        self.ttl = settings.parse_cache_ttl
+        self.memory_max_bytes = settings.parse_cache_memory_mb * 1024 * 1024
+        # Память: ключ -> (created, record, screenshot, размер)
+        self._memory: "OrderedDict[str, Tuple[float, dict, Optional[bytes], int]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._pending: Set[asyncio.Task] = set()
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+        if self.enabled:
+            self.records = AnalysisCache(
+                "parses",
+                memory_items=0,
+                disk_max_bytes=settings.parse_cache_disk_mb * 1024 * 1024,
+                ttl_seconds=self.ttl
+            )
+            self.blobs = BlobStore(Path(settings.cache_dir) / "screenshots", settings.screenshot_store_max_mb * 1024 * 1024)
+            logger.info(f"  TTL: {self.ttl} сек, память: {settings.parse_cache_memory_mb} МБ")
+            logger.info(f"  Скриншотов на диске: {len(self.blobs._index)} ({self.blobs._bytes / 1024 / 1024:.1f} МБ)")
+        else:
+            logger.info("  Кэш парсинга выключен")
+
+        logger.info("Кэш парсинга инициализирован ✓")
+        logger.info("=" * 50)
+
+    @staticmethod
+    def _key(canonical_url: str, screenshot: bool) -> str:
+        return make_cache_key("parse", canonical_url, "visual" if screenshot else "text")
+
+    def _remember(self, key: str, created: float, record: dict, screenshot: Optional[bytes]):
+        size = len(screenshot or b"") + len(str(record))
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous:
+                self._memory_bytes -= previous[3]
+            self._memory[key] = (created, record, screenshot, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_max_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted[3]
+                self.evictions += 1
+
+    def _get_memory(self, key: str, max_age: float) -> Optional[ParseResult]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            created, record, screenshot, _ = entry
+            age = time.time() - created
+            if age > max_age:
+                return None
+            self._memory.move_to_end(key)
+        self.hits_memory += 1
+        return _result_from_record(record, screenshot, age)
+
+    async def _get_disk(self, key: str, max_age: float) -> Optional[ParseResult]:
+        stored = await self.records.get(key)
+        if stored is None:
+            return None
+        age = time.time() - stored["created"]
+        if age > max_age:
+            return None
+        record = stored["record"]
+        screenshot = None
+        if record.get("screenshot"):
+            screenshot = await asyncio.to_thread(self.blobs.get, record["screenshot"])
+            if screenshot is None:
+                # Скриншот вытеснен из хранилища — запись бесполезна
+                return None
+        self.hits_disk += 1
+        self._remember(key, stored["created"], record, screenshot)
+        return _result_from_record(record, screenshot, age)
+
+    async def get(self, canonical_url: str, screenshot: bool, max_age: Optional[float] = None) -> Optional[ParseResult]:
+        """
+        Закэшированный результат не старше max_age сек (None — PARSE_CACHE_TTL)
+
+        Для парсинга без скриншота подходит и результат со скриншотом.
+        """
+        if not self.enabled:
+            return None
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        if max_age <= 0:
+            self.bypassed += 1
+            return None
+
+        keys = [self._key(canonical_url, True)] if screenshot else [
+            self._key(canonical_url, False), self._key(canonical_url, True)
+        ]
+        for key in keys:
+            result = self._get_memory(key, max_age)
+            if result is None:
+                result = await self._get_disk(key, max_age)
+            if result is not None:
+                if not screenshot:
+                    result.screenshot = None
+                return result
+        self.misses += 1
+        return None
+
+    def _write(self, result: ParseResult) -> dict:
+        digest = self.blobs.put(result.screenshot) if result.screenshot else None
+        return _result_to_record(result, digest)
+
+    async def _store(self, key: str, created: float, result: ParseResult):
+        try:
+            record = await asyncio.to_thread(self._write, result)
+            await self.records.set(key, {"created": created, "record": record})
+        except OSError as e:
+            logger.warning(f"  ⚠ Результат парсинга не сохранён на диск: {e}")
+
+    def put(self, canonical_url: str, screenshot: bool, result: ParseResult):
+        """Запомнить успешный результат; запись на диск идёт в фоне"""
+        if not self.enabled or result.error:
+            return
+        key = self._key(canonical_url, screenshot)
+        created = time.time()
+        self._remember(key, created, _result_to_record(result, None), result.screenshot)
+        task = asyncio.get_running_loop().create_task(self._store(key, created, result))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def clear(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        self.records.clear()
+        self.blobs.clear()
+        logger.info("Кэш парсинга очищен")
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        hits = self.hits_memory + self.hits_disk
+        total = hits + self.misses
+        return {
+            "enabled": True,
+            "ttl": self.ttl,
+            "hits": hits,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "evictions": self.evictions,
+            "disk_items": len(self.records._disk_index),
+            "screenshots": self.blobs.stats()
+        }
+
+
+# Глобальный экземпляр
+parse_cache = ParseCache()
@@ -1,27 +1,105 @@
 """
 Сервис для парсинга веб-страниц через Selenium Chrome
 """
-import base64
 import asyncio
+import base64
+import json
+import os
+import threading
 import time
 import logging
-from typing import Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor
-
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, WebDriverException
-from webdriver_manager.chrome import ChromeDriverManager
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 from backend.config import settings
+from backend.services.browser_supervisor import browser_supervisor
+from backend.services.browser_worker import ParseResult, result_from_payload, log_result
+from backend.services.deadline import DeadlineExceeded
+from backend.services.http_fetcher import http_fetcher
+from backend.services.parse_cache import parse_cache
+from backend.services.singleflight import singleflight
 
 # Логгер для сервиса
 logger = logging.getLogger("competitor_monitor.parser")
 
+# Параметры запроса, не влияющие на содержимое страницы
+_TRACKING_PARAMS = ("utm_", "yclid", "gclid", "fbclid", "_openstat")
+
+
+def normalize_url(url: str) -> str:
+    """Добавить протокол, если его нет"""
+    url = url.strip()
+    if not url.startswith(('http://', 'https://')):
+        url = 'https://' + url
+    return url
+
+
+def canonicalize_url(url: str) -> str:
+    """Канонический вид URL для сравнения: регистр хоста, порт, фрагмент, метки"""
+    parts = urlsplit(normalize_url(url))
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/") or ""
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith(_TRACKING_PARAMS)
+    ))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+class EngineMemory:
+    """Запоминает для домена, нужен ли браузер (сохраняется между перезапусками)"""
+
+    def __init__(self):
+        self.path = Path(settings.cache_dir) / "parser_engines.json"
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._engines: Dict[str, dict] = json.load(f)
+        except (OSError, ValueError):
+            self._engines = {}
+
+    def needs_browser(self, domain: str) -> bool:
+        entry = self._engines.get(domain)
+        if not entry or entry["engine"] != "chrome":
+            return False
+        # Время от времени пробуем снова HTTP — сайт мог перейти на серверный рендеринг
+        return time.time() - entry["updated"] < settings.parser_engine_memory_ttl
+
+    async def remember(self, domain: str, engine: str, reason: Optional[str] = None):
+        with self._lock:
+            previous = self._engines.get(domain, {}).get("engine")
+            self._engines[domain] = {"engine": engine, "reason": reason, "updated": time.time()}
+        # Файл переписывается только при смене движка, а не на каждом парсинге;
+        # свежесть записи в памяти при этом обновляется всегда
+        if previous == engine:
+            return
+        logger.info(f"  🧭 Домен {domain}: движок {engine}" + (f" ({reason})" if reason else ""))
+        await asyncio.to_thread(self._save)
+
+    def _save(self):
+        # Под _save_lock каждый поток пишет текущее состояние целиком,
+        # поэтому последняя запись на диске не может оказаться старее предыдущей
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self._engines, ensure_ascii=False)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning(f"  ⚠ Не удалось сохранить выбор движка: {e}")
+
+    def stats(self) -> dict:
+        engines = [entry["engine"] for entry in self._engines.values()]
+        return {"domains": len(engines), "http": engines.count("http"), "chrome": engines.count("chrome")}
+
 
 class ParserService:
     """Парсинг веб-страниц через Chrome с созданием скриншота"""
@@ -33,167 +111,68 @@ class ParserService:
         logger.info(f"  User-Agent: {settings.parser_user_agent[:50]}...")
         
         self.timeout = settings.parser_timeout
-        self._executor = ThreadPoolExecutor(max_workers=2)
+        self.engines = EngineMemory()
         
         logger.info("Parser сервис инициализирован ✓")
         logger.info("=" * 50)
     
-    def _create_driver(self) -> webdriver.Chrome:
-        """Создать новый экземпляр Chrome драйвера"""
-        logger.info("  🌐 Создание Chrome драйвера...")
-        start_time = time.time()
-        
-        options = Options()
-        options.add_argument('--headless=new')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--disable-gpu')
-        options.add_argument('--window-size=1920,1080')
-        options.add_argument(f'--user-agent={settings.parser_user_agent}')
-        options.add_argument('--disable-blink-features=AutomationControlled')
-        options.add_experimental_option('excludeSwitches', ['enable-automation'])
-        options.add_experimental_option('useAutomationExtension', False)
-        
-        logger.debug("  Опции Chrome настроены")
-        logger.info("  📥 Загрузка ChromeDriver...")
-        
-        # Автоматическая установка ChromeDriver
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=options)
-        
-        elapsed = time.time() - start_time
-        logger.info(f"  ✓ Chrome драйвер создан за {elapsed:.2f} сек")
-        
-        return driver
+    async def cached(self, url: str, screenshot: bool = True, max_age: Optional[float] = None) -> Optional[ParseResult]:
+        """Результат парсинга из кэша не старше max_age сек (None — если его нет)"""
+        return await parse_cache.get(canonicalize_url(url), screenshot, max_age)
     
-    def _parse_sync(self, url: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[bytes], Optional[str]]:
+    async def parse_url(self, url: str, screenshot: bool = True, max_age: Optional[float] = None) -> ParseResult:
         """
-        Синхронный парсинг URL (выполняется в отдельном потоке)
-        """
-        logger.info("=" * 50)
-        logger.info(f"🔍 ПАРСИНГ САЙТА: {url}")
+        Асинхронный парсинг URL: кэш, быстрый HTTP путь, при необходимости — Chrome
         
-        driver = None
-        total_start = time.time()
-        
-        try:
-            driver = self._create_driver()
-            driver.set_page_load_timeout(self.timeout)
-            
-            # Переходим на страницу
-            logger.info(f"  📄 Загрузка страницы...")
-            page_start = time.time()
-            driver.get(url)
-            page_elapsed = time.time() - page_start
-            logger.info(f"  ✓ Страница загружена за {page_elapsed:.2f} сек")
-            
-            # Ждём загрузки body
-            logger.info("  ⏳ Ожидание body элемента...")
-            WebDriverWait(driver, self.timeout).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
-            logger.info("  ✓ Body элемент найден")
-            
-            # Даём странице время на загрузку динамического контента
-            logger.info("  ⏳ Ожидание динамического контента (2 сек)...")
-            time.sleep(2)
-            
-            # Извлекаем title
-            title = driver.title
-            logger.info(f"  📌 Title: {title[:60] if title else 'N/A'}...")
-            
-            # Извлекаем h1
-            h1 = None
-            try:
-                h1_element = driver.find_element(By.TAG_NAME, 'h1')
-                h1 = h1_element.text.strip() if h1_element.text else None
-                logger.info(f"  📌 H1: {h1[:60] if h1 else 'N/A'}...")
-            except Exception as e:
-                logger.debug(f"  H1 не найден: {e}")
-            
-            # Извлекаем первый абзац
-            first_paragraph = None
-            try:
-                paragraphs = driver.find_elements(By.TAG_NAME, 'p')
-                logger.debug(f"  Найдено абзацев: {len(paragraphs)}")
-                for i, p in enumerate(paragraphs):
-                    text = p.text.strip() if p.text else ""
-                    if len(text) > 50:
-                        first_paragraph = text[:500]
-                        logger.info(f"  📌 Первый абзац (p[{i}]): {first_paragraph[:60]}...")
-                        break
-            except Exception as e:
-                logger.debug(f"  Абзацы не найдены: {e}")
-            
-            # Делаем скриншот
-            logger.info("  📸 Создание скриншота...")
-            screenshot_start = time.time()
-            screenshot_bytes = driver.get_screenshot_as_png()
-            screenshot_elapsed = time.time() - screenshot_start
-            screenshot_size_kb = len(screenshot_bytes) / 1024
-            logger.info(f"  ✓ Скриншот создан за {screenshot_elapsed:.2f} сек ({screenshot_size_kb:.1f} KB)")
-            
-            total_elapsed = time.time() - total_start
-            logger.info(f"  ✅ ПАРСИНГ ЗАВЕРШЁН за {total_elapsed:.2f} сек")
-            logger.info("=" * 50)
-            
-            return title, h1, first_paragraph, screenshot_bytes, None
-            
-        except TimeoutException:
-            total_elapsed = time.time() - total_start
-            logger.error(f"  ✗ TIMEOUT за {total_elapsed:.2f} сек")
-            logger.error("=" * 50)
-            return None, None, None, None, "Превышено время ожидания загрузки страницы"
-            
-        except WebDriverException as e:
-            total_elapsed = time.time() - total_start
-            error_msg = str(e)
-            logger.error(f"  ✗ WebDriver ошибка за {total_elapsed:.2f} сек")
-            logger.error(f"  Детали: {error_msg[:200]}")
-            logger.error("=" * 50)
-            
-            if 'net::ERR_NAME_NOT_RESOLVED' in error_msg:
-                return None, None, None, None, "Не удалось найти сайт по указанному адресу"
-            elif 'net::ERR_CONNECTION_REFUSED' in error_msg:
-                return None, None, None, None, "Соединение отклонено сервером"
-            elif 'net::ERR_CONNECTION_TIMED_OUT' in error_msg:
-                return None, None, None, None, "Превышено время ожидания соединения"
-            else:
-                return None, None, None, None, f"Ошибка браузера: {error_msg[:200]}"
-                
-        except Exception as e:
-            total_elapsed = time.time() - total_start
-            logger.error(f"  ✗ Неизвестная ошибка за {total_elapsed:.2f} сек: {e}")
-            logger.error("=" * 50)
-            return None, None, None, None, f"Ошибка при загрузке страницы: {str(e)[:200]}"
-            
-        finally:
-            if driver:
-                try:
-                    logger.debug("  Закрытие драйвера...")
-                    driver.quit()
-                    logger.debug("  ✓ Драйвер закрыт")
-                except Exception as e:
-                    logger.warning(f"  Ошибка при закрытии драйвера: {e}")
-    
-    async def parse_url(self, url: str) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[bytes], Optional[str]]:
-        """
-        Асинхронный парсинг URL через Chrome
+        screenshot=True всегда открывает страницу в браузере (скриншот без него не сделать).
+        max_age — допустимый возраст результата из кэша, сек (None — PARSE_CACHE_TTL, 0 — без кэша).
         """
         # Добавляем протокол если его нет
         original_url = url
-        if not url.startswith(('http://', 'https://')):
-            url = 'https://' + url
+        url = normalize_url(url)
+        if url != original_url:
             logger.info(f"  URL дополнен протоколом: {original_url} -> {url}")
+        canonical = canonicalize_url(url)
+        
+        cached = await parse_cache.get(canonical, screenshot, max_age)
+        if cached is not None:
+            logger.info(f"⚡ Результат парсинга из кэша ({cached.cache_age:.0f} сек назад): {url}")
+            return cached
+        
+        result = await self._load(url, canonical, screenshot)
+        parse_cache.put(canonical, screenshot, result)
+        return result
+    
+    async def _load(self, url: str, canonical: str, screenshot: bool) -> ParseResult:
+        """Загрузить страницу по HTTP или в Chrome"""
+        domain = urlsplit(canonical).hostname or ""
+        
+        if not screenshot and settings.http_fetch_enabled and not self.engines.needs_browser(domain):
+            logger.info(f"🚀 Загрузка по HTTP: {url}")
+            try:
+                fetched = await singleflight.do("http", canonical, lambda: http_fetcher.fetch(url, canonical))
+            except DeadlineExceeded as e:
+                return ParseResult(error=str(e))
+            if fetched.needs_browser is None:
+                await self.engines.remember(domain, "http")
+                result = result_from_payload(
+                    fetched.payload,
+                    timings=dict(fetched.timings),
+                    engine="http",
+                    not_modified=fetched.not_modified
+                )
+                log_result(result)
+                return result
+            await self.engines.remember(domain, "chrome", fetched.needs_browser)
         
         logger.info(f"🚀 Запуск асинхронного парсинга: {url}")
         
-        # Запускаем синхронный парсинг в отдельном потоке
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            self._executor,
-            self._parse_sync,
-            url
+        # Браузер работает в отдельном процессе-исполнителе;
+        # одновременные запросы одного и того же URL используют один браузер
+        result = await singleflight.do(
+            "browser" if screenshot else "browser_text",
+            canonical,
+            lambda: browser_supervisor.parse(url, screenshot)
         )
         
         return result
@@ -204,10 +183,15 @@ class ParserService:
         logger.debug(f"Скриншот конвертирован в base64: {len(base64_str)} символов")
         return base64_str
     
+    async def warmup(self):
+        """Заранее запустить процессы-исполнители с браузерами"""
+        await browser_supervisor.start()
+    
     async def close(self):
-        """Закрыть executor"""
+        """Закрыть HTTP клиент и процессы-исполнители (вместе с их браузерами)"""
         logger.info("Закрытие Parser сервиса...")
-        self._executor.shutdown(wait=False)
+        await http_fetcher.close()
+        await browser_supervisor.close()
         logger.info("Parser сервис закрыт ✓")
 
 
@@ -0,0 +1,242 @@
+"""
+Конвейер «парсинг страницы → AI анализ» для сайтов конкурентов
+
+Если у запроса есть бюджет времени (deadline), парсинг получает остаток
+за вычетом ожидаемой длительности текстового анализа, а vision анализ
+запускается, только когда после него останется время на текстовый.
+Vision, не уложившийся в бюджет, заменяется анализом текста страницы
+(analysis_path="text_fallback").
+"""
+import time
+import logging
+from typing import Optional
+from urllib.parse import urlparse
+
+from backend.config import settings
+from backend.models.schemas import ChangeReport, CompetitorAnalysis, ParsedContent
+from backend.services.change_detector import change_detector
+from backend.services.deadline import DeadlineExceeded, deadline_scope, remaining, with_deadline
+from backend.services.openai_service import openai_service
+from backend.services.image_service import image_service
+from backend.services.parser_service import parser_service, canonicalize_url, ParseResult
+from backend.services.singleflight import singleflight
+from backend.services.usage_ledger import set_competitor, usage_ledger
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.pipeline")
+
+
+class ParseError(Exception):
+    """Страницу не удалось загрузить или распарсить"""
+
+
+class PipelineService:
+    """Полный цикл обработки URL конкурента"""
+
+    def __init__(self):
+        # Каким путём получен анализ
+        self.paths = {"vision": 0, "text": 0, "text_fallback": 0, "reused": 0}
+        # Почему vision заменён текстом: budget — не хватало времени, timeout — не успел
+        self.fallbacks = {"budget": 0, "timeout": 0}
+        self.deadline_exceeded = 0
+
+    async def parse_and_analyze(
+        self,
+        url: str,
+        use_cache: bool = True,
+        screenshot: Optional[bool] = None,
+        max_age: Optional[float] = None
+    ) -> ParsedContent:
+        """Распарсить страницу и проанализировать её (одновременные запросы URL объединяются)"""
+        if screenshot is None:
+            screenshot = settings.parser_screenshot
+        key = f"{canonicalize_url(url)}|cache={use_cache}|screenshot={screenshot}|max_age={max_age}"
+        try:
+            # Общий результат может считаться дольше бюджета этого запроса — ждём не дольше него
+            return await with_deadline(
+                singleflight.do("parse", key, lambda: self._run(url, use_cache, screenshot, max_age)),
+                "парсинг и анализ"
+            )
+        except DeadlineExceeded:
+            self.deadline_exceeded += 1
+            raise
+
+    async def _run(self, url: str, use_cache: bool, screenshot: bool, max_age: Optional[float]) -> ParsedContent:
+        total_start = time.time()
+        # Вызовы API этой задачи учитываются по конкуренту
+        set_competitor(urlparse(canonicalize_url(url)).hostname)
+
+        parse_start = time.time()
+        with deadline_scope(self.parse_budget()):
+            parsed = await self.parse(url, screenshot, max_age)
+        parse_elapsed = time.time() - parse_start
+
+        ai_start = time.time()
+        result = await self.analyze(url, parsed, use_cache, screenshot)
+        ai_elapsed = time.time() - ai_start
+
+        total_elapsed = time.time() - total_start
+        logger.info(f"  ✅ Парсинг и анализ завершён за {total_elapsed:.2f} сек")
+        logger.info(f"    - Парсинг: {parse_elapsed:.2f} сек")
+        logger.info(f"    - AI анализ: {ai_elapsed:.2f} сек")
+        return result
+
+    async def parse(self, url: str, screenshot: bool, max_age: Optional[float] = None) -> ParseResult:
+        """Этап 1: загрузить страницу (из кэша парсинга, по HTTP или в Chrome со скриншотом)"""
+        logger.info("  🔍 Запуск парсинга...")
+        parse_start = time.time()
+        parsed = await parser_service.parse_url(url, screenshot=screenshot, max_age=max_age)
+        logger.info(f"  ✓ Парсинг завершён за {time.time() - parse_start:.2f} сек")
+
+        if parsed.error:
+            logger.error(f"  ❌ Ошибка парсинга: {parsed.error}")
+            raise ParseError(parsed.error)
+
+        logger.info(f"  📌 Title: {parsed.title[:50] if parsed.title else 'N/A'}...")
+        logger.info(f"  📌 H1: {parsed.h1[:50] if parsed.h1 else 'N/A'}...")
+        logger.info(f"  📌 Screenshot: {len(parsed.screenshot) / 1024:.1f} KB" if parsed.screenshot else "  📌 Screenshot: N/A")
+        return parsed
+
+    async def analyze(self, url: str, parsed: ParseResult, use_cache: bool, screenshot: bool) -> ParsedContent:
+        """Этап 2: AI анализ распарсенной страницы (скриншот + контекст или только текст)"""
+        title, h1, first_paragraph, screenshot_bytes = parsed.title, parsed.h1, parsed.first_paragraph, parsed.screenshot
+
+        # Если страница почти не изменилась с прошлого анализа — анализ не повторяем
+        change = fingerprint = None
+        if change_detector.enabled:
+            canonical = canonicalize_url(url)
+            fingerprint = await change_detector.fingerprint(parsed)
+            change, previous_analysis = await change_detector.compare(canonical, screenshot, fingerprint)
+            if change.status != "new":
+                logger.info(
+                    f"  🔎 Страница: {change.status}, изменено: {', '.join(change.changed_fields) or 'ничего'} "
+                    f"(текст {change.text_change:.1%}, скриншот {change.visual_distance})"
+                )
+            if previous_analysis is not None and use_cache:
+                logger.info("  ♻️ Используется прошлый анализ")
+                usage_ledger.record_cache_hit(
+                    settings.openai_vision_model if screenshot_bytes else settings.openai_model, status="unchanged"
+                )
+                self.paths["reused"] += 1
+                return self._content(url, parsed, previous_analysis, change, "reused")
+            change.analysis_reused = False
+
+        path = self.choose_path(bool(screenshot_bytes))
+        # Уменьшаем и перекодируем скриншот (PNG 1920x1080 -> JPEG/WebP)
+        prepared = await image_service.prepare_async(screenshot_bytes, "image/png") if path == "vision" else None
+
+        # Анализируем сайт через Vision API (скриншот + контекст)
+        logger.info("  🤖 Запуск AI анализа...")
+        ai_start = time.time()
+
+        if prepared:
+            try:
+                # Vision получает остаток бюджета за вычетом запаса на текстовый анализ
+                with deadline_scope(self._budget_after("text")):
+                    analysis = await openai_service.analyze_website_screenshot(
+                        screenshot_base64=prepared.base64,
+                        url=url,
+                        title=title,
+                        h1=h1,
+                        first_paragraph=first_paragraph,
+                        use_cache=use_cache,
+                        mime_type=prepared.mime_type,
+                        detail=prepared.detail,
+                        details=parsed.details
+                    )
+            except DeadlineExceeded:
+                logger.warning(f"  ⏱️ Vision анализ не уложился в бюджет запроса за {time.time() - ai_start:.2f} сек, текстовый анализ")
+                self.fallbacks["timeout"] += 1
+                path = "text_fallback"
+        else:
+            path = "text" if path == "vision" else path
+            if screenshot and path == "text":
+                logger.warning("  ⚠ Скриншот недоступен, fallback на текстовый анализ")
+
+        if path != "vision":
+            analysis = await openai_service.analyze_parsed_content(
+                title=title,
+                h1=h1,
+                paragraph=first_paragraph,
+                use_cache=use_cache,
+                details=parsed.details
+            )
+
+        logger.info(f"  ✓ AI анализ завершён за {time.time() - ai_start:.2f} сек ({path})")
+        self.paths[path] += 1
+
+        # Упрощённый анализ не запоминаем: следующий запрос с запасом времени сделает полный
+        if fingerprint is not None and path != "text_fallback":
+            await change_detector.remember(canonical, screenshot, fingerprint, analysis)
+        return self._content(url, parsed, analysis, change, path)
+
+    # === Бюджет времени ===
+
+    @staticmethod
+    def _budget_after(budget: str) -> Optional[float]:
+        """Остаток бюджета запроса за вычетом ожидаемой длительности анализа (None — без дедлайна)"""
+        left = remaining()
+        if left is None:
+            return None
+        return max(0.0, left - openai_service.expected_latency(budget))
+
+    def parse_budget(self) -> Optional[float]:
+        """Бюджет этапа парсинга: остаток без запаса на текстовый анализ, но не меньше половины остатка"""
+        left = remaining()
+        if left is None:
+            return None
+        return max(self._budget_after("text"), left / 2)
+
+    def choose_path(self, has_screenshot: bool) -> str:
+        """
+        Путь анализа: vision, text или text_fallback
+
+        Vision выбирается, только если до дедлайна хватает времени и на него,
+        и на текстовый анализ, если vision всё же не успеет.
+        """
+        if not has_screenshot:
+            return "text"
+        left = remaining()
+        if left is None:
+            return "vision"
+        needed = openai_service.expected_latency("vision") + openai_service.expected_latency("text")
+        if left >= needed:
+            return "vision"
+        logger.warning(f"  ⏱️ До дедлайна {left:.1f} сек, vision и запасной текстовый анализ ~{needed:.1f} сек — текстовый анализ")
+        self.fallbacks["budget"] += 1
+        return "text_fallback"
+
+    def stats(self) -> dict:
+        return {
+            "paths": dict(self.paths),
+            "fallbacks": dict(self.fallbacks),
+            "deadline_exceeded": self.deadline_exceeded,
+            "expected_latency": openai_service.latency_stats()
+        }
+
+    @staticmethod
+    def _content(
+        url: str,
+        parsed: ParseResult,
+        analysis: CompetitorAnalysis,
+        change: Optional[ChangeReport],
+        analysis_path: Optional[str] = None
+    ) -> ParsedContent:
+        return ParsedContent(
+            url=url,
+            title=parsed.title,
+            h1=parsed.h1,
+            first_paragraph=parsed.first_paragraph,
+            details=parsed.details,
+            analysis=analysis,
+            engine=parsed.engine,
+            timings=parsed.timings,
+            resources=parsed.resources,
+            cache_age=parsed.cache_age,
+            change=change,
+            analysis_path=analysis_path
+        )
+
+
+# Глобальный экземпляр
+pipeline_service = PipelineService()
@@ -0,0 +1,274 @@
+"""
+Ограничение нагрузки на ProxyAPI: token bucket, адаптивная параллельность (AIMD)
+и повторы с экспоненциальной задержкой, учитывающей Retry-After
+"""
+import asyncio
+import random
+import time
+import logging
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from backend.config import settings
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.upstream")
+
+
+class TokenBucket:
+    """Ведро токенов, пополняемое равномерно с заданной скоростью в минуту"""
+
+    def __init__(self, per_minute: int, capacity: Optional[int] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(capacity or per_minute)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> float:
+        """Забрать токены, при нехватке — подождать. Возвращает время ожидания"""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+    def adjust(self, delta: float):
+        """Поправить баланс после того, как стал известен реальный расход"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def available(self) -> int:
+        self._refill()
+        return int(self.tokens)
+
+
+class AdaptiveLimiter:
+    """Лимит параллельных запросов по схеме AIMD
+
+    Успешный ответ увеличивает лимит на 1 за «окно» (1/limit на запрос),
+    перегрузка (429, 5xx, таймаут) уменьшает его мультипликативно.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / max(self.limit, 1.0))
+
+    def on_overload(self):
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class UpstreamBudget:
+    """Бюджет одной группы моделей: RPM, TPM и параллельность"""
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.limiter = AdaptiveLimiter(
+            settings.upstream_concurrency_initial,
+            settings.upstream_concurrency_min,
+            settings.upstream_concurrency_max
+        )
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.wait_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "throttled_429": self.throttled,
+            "server_errors": self.server_errors,
+            "wait_seconds": round(self.wait_seconds, 2),
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+            "rpm_available": self.rpm.available(),
+            "tpm_available": self.tpm.available()
+        }
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Задержка из заголовков Retry-After / retry-after-ms, если сервер её указал"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class UpstreamGovernor:
+    """Общий регулятор запросов к API с раздельными бюджетами text/vision"""
+
+    def __init__(self):
+        self.budgets: Dict[str, UpstreamBudget] = {
+            "text": UpstreamBudget("text", settings.text_rpm, settings.text_tpm),
+            "vision": UpstreamBudget("vision", settings.vision_rpm, settings.vision_tpm)
+        }
+        self.max_retries = settings.upstream_max_retries
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Задержка перед повтором: Retry-After или экспонента с полным джиттером"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, settings.upstream_backoff_max)
+        ceiling = min(settings.upstream_backoff_max, settings.upstream_backoff_base * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def _record_failure(self, budget: UpstreamBudget, error: Exception):
+        if isinstance(error, APIStatusError):
+            if error.status_code == 429:
+                budget.throttled += 1
+            elif error.status_code >= 500:
+                budget.server_errors += 1
+        budget.limiter.on_overload()
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        budget_name: str,
+        fn: Callable[[], Awaitable[Any]],
+        estimated_tokens: int,
+        call_info: Optional[dict] = None
+    ) -> AsyncIterator[Any]:
+        """Выполнить fn() с повторами и удерживать слот параллельности до выхода из блока
+
+        Нужен для потоковых ответов: слот занят, пока поток читается.
+        В call_info (если передан) записываются число повторов и задержка
+        последней попытки.
+        """
+        budget = self.budgets[budget_name]
+        attempt = 0
+        if call_info is None:
+            call_info = {}
+        while True:
+            call_info["retries"] = attempt
+            budget.requests += 1
+            budget.wait_seconds += await budget.rpm.acquire(1)
+            budget.wait_seconds += await budget.tpm.acquire(estimated_tokens)
+            wait_start = time.monotonic()
+            await budget.limiter.acquire()
+            budget.wait_seconds += time.monotonic() - wait_start
+            try:
+                attempt_start = time.monotonic()
+                try:
+                    result = await fn()
+                except Exception as e:
+                    call_info["latency"] = time.monotonic() - attempt_start
+                    if not _is_retryable(e):
+                        budget.failures += 1
+                        raise
+                    self._record_failure(budget, e)
+                    if attempt >= self.max_retries:
+                        budget.failures += 1
+                        logger.error(f"  ✗ [{budget_name}] Повторы исчерпаны ({attempt + 1} попыток): {e}")
+                        raise
+                    delay = self._backoff(attempt, e)
+                    attempt += 1
+                    budget.retries += 1
+                    logger.warning(
+                        f"  ⚠ [{budget_name}] {type(e).__name__}, повтор {attempt}/{self.max_retries} "
+                        f"через {delay:.2f} сек (лимит параллельности {budget.limiter.limit:.1f})"
+                    )
+                else:
+                    call_info["latency"] = time.monotonic() - attempt_start
+                    usage = getattr(result, "usage", None)
+                    if usage is not None and getattr(usage, "total_tokens", None):
+                        budget.tpm.adjust(usage.total_tokens - estimated_tokens)
+                    try:
+                        yield result
+                    except Exception as e:
+                        # Ошибка при чтении потока: повторить уже нельзя, но сбой
+                        # учитывается так же, как отказ самого запроса
+                        budget.failures += 1
+                        if _is_retryable(e):
+                            self._record_failure(budget, e)
+                        raise
+                    budget.successes += 1
+                    budget.limiter.on_success()
+                    return
+            finally:
+                await budget.limiter.release()
+            await asyncio.sleep(delay)
+
+    async def call(
+        self,
+        budget_name: str,
+        fn: Callable[[], Awaitable[Any]],
+        estimated_tokens: int,
+        call_info: Optional[dict] = None
+    ) -> Any:
+        """Выполнить запрос к API с учётом лимитов и повторов"""
+        async with self.slot(budget_name, fn, estimated_tokens, call_info) as result:
+            return result
+
+    def stats(self) -> dict:
+        return {name: budget.stats() for name, budget in self.budgets.items()}
+
+
+# Глобальный экземпляр
+upstream_governor = UpstreamGovernor()
@@ -0,0 +1,238 @@
+"""
+Определение готовности страницы вместо фиксированной паузы
+
+Ожидание идёт по набору сигналов: document.readyState, появление первого
+h1/абзаца, затишье DOM (нет мутаций) и затишье сети (нет новых загрузок).
+Для каждого домена запоминается профиль: типичное время готовности и сигналы,
+которые на этом сайте не срабатывают, — по нему подбирается лимит ожидания.
+Профили общие для всех процессов-исполнителей: каждое наблюдение
+записывается поверх свежей версии файла под файловой блокировкой.
+"""
+import json
+import os
+import random
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from backend.config import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: без блокировки файла, слияние профилей остаётся
+    fcntl = None
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.readiness")
+
+SIGNALS = ("ready_state", "content", "dom_quiet", "network_idle")
+# Сигналы затишья могут сброситься, если активность возобновилась
+_QUIESCENCE = ("dom_quiet", "network_idle")
+
+# Наблюдатель мутаций ставится один раз на страницу, дальше только опрос
+_PROBE_SCRIPT = """
+const quietMs = arguments[0], idleMs = arguments[1];
+if (!window.__cmReady) {
+    window.__cmReady = {lastMutation: performance.now()};
+    try {
+        new MutationObserver(() => { window.__cmReady.lastMutation = performance.now(); })
+            .observe(document.documentElement, {childList: true, subtree: true, attributes: true, characterData: true});
+    } catch (e) {}
+}
+const now = performance.now();
+const resources = performance.getEntriesByType('resource');
+let lastNetwork = 0;
+for (const entry of resources) {
+    lastNetwork = Math.max(lastNetwork, entry.responseEnd || entry.startTime);
+}
+let content = !!document.querySelector('h1');
+if (!content) {
+    for (const p of document.getElementsByTagName('p')) {
+        if ((p.innerText || '').trim().length > 50) { content = true; break; }
+    }
+}
+return {
+    ready_state: document.readyState === 'complete',
+    content: content,
+    dom_quiet: now - window.__cmReady.lastMutation >= quietMs,
+    network_idle: now - lastNetwork >= idleMs
+};
+"""
+
+
+def _domain(url: str) -> str:
+    return (urlsplit(url).hostname or "").lower()
+
+
+class DomainProfile:
+    """Выученный профиль ожидания для домена"""
+
+    def __init__(self, data: Optional[dict] = None):
+        data = data or {}
+        self.samples: int = data.get("samples", 0)
+        self.avg_ready: float = data.get("avg_ready", 0.0)
+        # Сколько раз подряд сигнал не сработал до лимита
+        self.misses: Dict[str, int] = data.get("misses", {})
+
+    def to_dict(self) -> dict:
+        return {"samples": self.samples, "avg_ready": round(self.avg_ready, 3), "misses": self.misses}
+
+
+class ReadinessEngine:
+    """Ожидание готовности страницы по сигналам с выученными профилями доменов"""
+
+    def __init__(self):
+        self.signals = [s.strip() for s in settings.readiness_signals.split(",") if s.strip() in SIGNALS]
+        self.profiles_file = Path(settings.cache_dir) / "readiness_profiles.json"
+        self.lock_file = self.profiles_file.with_suffix(".lock")
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, DomainProfile] = self._load()
+        logger.info(f"Сигналы готовности: {', '.join(self.signals) or 'нет'}, лимит {settings.readiness_max_wait} сек")
+
+    def _load(self) -> Dict[str, DomainProfile]:
+        try:
+            with open(self.profiles_file, "r", encoding="utf-8") as f:
+                return {domain: DomainProfile(data) for domain, data in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"  ⚠ Профили готовности не загружены: {e}")
+            return {}
+
+    @contextmanager
+    def _file_lock(self):
+        """Блокировка файла профилей между процессами-исполнителями"""
+        self.profiles_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            # Блокировка снимается при закрытии файла
+            yield
+
+    def _save(self):
+        try:
+            # Временный файл — свой у каждого процесса
+            tmp_path = self.profiles_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({d: p.to_dict() for d, p in self._profiles.items()}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.profiles_file)
+        except OSError as e:
+            logger.warning(f"  ⚠ Профили готовности не сохранены: {e}")
+
+    def _plan(self, domain: str) -> Tuple[List[str], float, List[str]]:
+        """Сигналы, лимит ожидания и повторно проверяемые сигналы для домена"""
+        max_wait = settings.readiness_max_wait
+        with self._lock:
+            profile = self._profiles.get(domain)
+        if profile is None or profile.samples < settings.readiness_min_samples:
+            return list(self.signals), max_wait, []
+
+        # Сигналы, которые на этом сайте стабильно не срабатывают, не ждём.
+        # Но изредка проверяем их снова: сайт мог измениться, а сработавший
+        # сигнал сбросит счётчик промахов в _update
+        dropped = [s for s in self.signals if profile.misses.get(s, 0) >= settings.readiness_min_samples]
+        reprobed = dropped if dropped and random.random() < settings.readiness_reprobe_rate else []
+        signals = [s for s in self.signals if s not in dropped or s in reprobed]
+        # Запас вдвое от типичного времени, но не больше общего лимита
+        return signals, min(max_wait, max(1.0, profile.avg_ready * 2)), reprobed
+
+    def _update(self, domain: str, elapsed: float, waited: List[str], missed: List[str]):
+        profile = self._profiles.setdefault(domain, DomainProfile())
+        profile.samples += 1
+        alpha = 0.3 if profile.samples > 1 else 1.0
+        profile.avg_ready = profile.avg_ready * (1 - alpha) + elapsed * alpha
+        for signal in waited:
+            profile.misses[signal] = profile.misses.get(signal, 0) + 1 if signal in missed else 0
+
+    def _learn(self, domain: str, elapsed: float, waited: List[str], missed: List[str]):
+        with self._lock:
+            learned = False
+            try:
+                with self._file_lock():
+                    # Сначала профили, записанные другими исполнителями, иначе
+                    # последний записавший процесс затёр бы чужие наблюдения
+                    self._profiles.update(self._load())
+                    self._update(domain, elapsed, waited, missed)
+                    learned = True
+                    self._save()
+            except OSError as e:
+                logger.warning(f"  ⚠ Файл профилей готовности недоступен: {e}")
+                if not learned:
+                    self._update(domain, elapsed, waited, missed)
+
+    def wait(
+        self,
+        driver,
+        url: str,
+        cancelled: Optional[Callable[[], bool]] = None,
+        limit: Optional[float] = None
+    ) -> Dict[str, float]:
+        """
+        Дождаться готовности страницы. Возвращает время срабатывания каждого сигнала, сек
+
+        cancelled() == True прерывает ожидание (задание отменено); профиль домена при этом не обучается.
+        limit — остаток бюджета запроса, сек: ожидание не дольше него, и если
+        он оборвал ожидание, профиль домена тоже не обучается.
+        """
+        domain = _domain(url)
+        signals, max_wait, reprobed = self._plan(domain)
+        truncated = limit is not None and limit < max_wait
+        if truncated:
+            max_wait = max(0.0, limit)
+        timings: Dict[str, float] = {}
+        start = time.time()
+
+        while signals:
+            elapsed = time.time() - start
+            try:
+                state = driver.execute_script(
+                    _PROBE_SCRIPT, settings.readiness_quiet_ms, settings.readiness_network_idle_ms
+                ) or {}
+            except Exception as e:
+                logger.debug(f"  Проверка готовности не удалась: {e}")
+                state = {}
+            for signal in signals:
+                if state.get(signal):
+                    timings.setdefault(signal, round(elapsed, 3))
+                elif signal in _QUIESCENCE:
+                    timings.pop(signal, None)
+            if all(signal in timings for signal in signals) or elapsed >= max_wait:
+                break
+            if cancelled is not None and cancelled():
+                timings["ready_total"] = round(time.time() - start, 3)
+                return timings
+            time.sleep(settings.readiness_poll_interval)
+
+        total = round(time.time() - start, 3)
+        missed = [s for s in signals if s not in timings]
+        if missed:
+            logger.info(f"  ⏳ Лимит ожидания {max_wait:.1f} сек, не сработали: {', '.join(missed)}")
+        else:
+            logger.info(f"  ✓ Страница готова за {total:.2f} сек")
+        if not (truncated and missed):
+            ready = total
+            if missed and set(missed) <= set(reprobed):
+                # Не сработали только повторно проверяемые сигналы: страница была
+                # готова по остальным, лишнее ожидание не портит среднее время
+                ready = max((timings[s] for s in signals if s in timings), default=total)
+            self._learn(domain, ready, signals, missed)
+
+        timings["ready_total"] = total
+        return timings
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "signals": self.signals,
+                "max_wait": settings.readiness_max_wait,
+                "profiles": {domain: profile.to_dict() for domain, profile in self._profiles.items()}
+            }
+
+
+# Глобальный экземпляр
+readiness_engine = ReadinessEngine()
@@ -0,0 +1,202 @@
+"""
+Блокировка лишних ресурсов при парсинге через CDP
+
+Трекеры, реклама, видео, а в текстовом профиле ещё изображения и шрифты
+не загружаются: Network.setBlockedURLs задаёт шаблоны URL перед переходом
+на страницу, а изображения, шрифты и медиа дополнительно блокируются по типу
+ресурса через Fetch — даже если URL без расширения (CDN, /image?id=...).
+Статистика (заблокировано запросов, загружено и сэкономлено байт)
+собирается из performance-лога Chrome.
+"""
+import json
+import threading
+import logging
+from typing import Dict, List
+
+from backend.config import settings
+from backend.services.browser_tabs import PageSession
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.blocker")
+
+# Шаблоны URL по категориям (синтаксис Network.setBlockedURLs: * — любая подстрока)
+CATEGORIES: Dict[str, List[str]] = {
+    "trackers": [
+        "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+        "*googlesyndication.com*", "*googleadservices.com*", "*adservice.google.*",
+        "*mc.yandex.ru*", "*an.yandex.ru*", "*yandex.ru/ads*", "*top-fwz1.mail.ru*",
+        "*connect.facebook.net*", "*facebook.com/tr*", "*vk.com/rtrg*", "*hotjar.com*",
+        "*clarity.ms*", "*criteo.*", "*taboola.com*", "*outbrain.com*", "*segment.io*",
+        "*mixpanel.com*", "*amplitude.com*", "*tiktok.com/i18n/pixel*", "*jivosite.com*",
+        "*jivo.ru*", "*carrotquest.io*", "*bitrix24.ru/b*", "*roistat.com*", "*calltouch.ru*"
+    ],
+    "media": [
+        "*.mp4", "*.mp4?*", "*.webm", "*.webm?*", "*.mov", "*.m3u8*", "*.mp3", "*.mp3?*",
+        "*.ogg", "*.wav", "*youtube.com/embed*", "*player.vimeo.com*", "*rutube.ru/play/embed*"
+    ],
+    "images": [
+        "*.png", "*.png?*", "*.jpg", "*.jpg?*", "*.jpeg", "*.jpeg?*", "*.gif", "*.gif?*",
+        "*.webp", "*.webp?*", "*.avif", "*.avif?*", "*.svg", "*.svg?*", "*.ico", "*.bmp"
+    ],
+    "fonts": [
+        "*.woff", "*.woff?*", "*.woff2", "*.woff2?*", "*.ttf", "*.ttf?*", "*.otf", "*.otf?*",
+        "*.eot", "*.eot?*", "*fonts.googleapis.com*", "*fonts.gstatic.com*"
+    ]
+}
+
+# Типы ресурсов CDP по категориям (блокировка через Fetch независимо от URL)
+RESOURCE_TYPES: Dict[str, List[str]] = {
+    "media": ["Media"],
+    "images": ["Image"],
+    "fonts": ["Font"]
+}
+
+# Средний размер ресурса по типу, байт — пока нет собственной статистики
+_DEFAULT_SIZES = {
+    "Image": 40_000, "Font": 30_000, "Media": 500_000,
+    "Script": 60_000, "Stylesheet": 20_000, "Other": 10_000
+}
+
+
+def _parse_list(value: str) -> List[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+class ResourceBlocker:
+    """Профили блокировки ресурсов и статистика сэкономленного трафика"""
+
+    def __init__(self):
+        self.enabled = settings.browser_block_enabled
+        self.profiles: Dict[str, List[str]] = {
+            "text": _parse_list(settings.browser_block_text_profile),
+            "visual": _parse_list(settings.browser_block_visual_profile)
+        }
+        self.extra_patterns = _parse_list(settings.browser_block_extra_patterns)
+        self._lock = threading.Lock()
+        # Наблюдаемый средний размер загруженных ресурсов по типу (для оценки экономии)
+        self._sizes: Dict[str, List[int]] = {}
+        # CDP-сессии к вкладкам драйверов WebDriver (режим pool), по id драйвера
+        self._sessions: Dict[int, PageSession] = {}
+        self.type_blocking_failures = 0
+        self.totals = {"parses": 0, "requests": 0, "blocked": 0, "bytes_loaded": 0, "bytes_saved_estimate": 0}
+
+        logger.info(
+            f"Блокировка ресурсов: {'включена' if self.enabled else 'выключена'}, "
+            f"text={self.profiles['text']}, visual={self.profiles['visual']}"
+        )
+
+    def patterns(self, profile: str) -> List[str]:
+        patterns = []
+        for category in self.profiles.get(profile, []):
+            patterns.extend(CATEGORIES.get(category, []))
+        return patterns + self.extra_patterns
+
+    def resource_types(self, profile: str) -> List[str]:
+        types = []
+        for category in self.profiles.get(profile, []):
+            types.extend(RESOURCE_TYPES.get(category, []))
+        return types
+
+    def _page_session(self, driver) -> PageSession:
+        # Закрытые сессии (драйвер перезапущен пулом) не копятся
+        for key in [key for key, session in self._sessions.items() if session.closed]:
+            del self._sessions[key]
+        session = self._sessions.get(id(driver))
+        if session is None:
+            session = self._sessions[id(driver)] = PageSession(driver)
+        return session
+
+    def _block_types(self, driver, types: List[str]):
+        """Блокировка по типу ресурса: у вкладки CdpTab — своя, у WebDriver — через отдельную CDP-сессию"""
+        if hasattr(driver, "block_resource_types"):
+            driver.block_resource_types(types)
+            return
+        if not types and id(driver) not in self._sessions:
+            return
+        try:
+            self._page_session(driver).blocker.set_types(types)
+        except Exception as e:
+            # Остаётся блокировка по шаблонам URL
+            session = self._sessions.pop(id(driver), None)
+            if session is not None:
+                session.close()
+            with self._lock:
+                self.type_blocking_failures += 1
+            logger.warning(f"  ⚠ Блокировка по типу ресурса недоступна: {str(e)[:100]}")
+
+    def apply(self, driver, profile: str):
+        """Включить блокировку для профиля перед загрузкой страницы"""
+        # Сбрасываем накопленный лог, чтобы статистика относилась только к этой странице
+        self._drain(driver)
+        patterns = self.patterns(profile) if self.enabled else []
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+        self._block_types(driver, self.resource_types(profile) if self.enabled else [])
+
+    @staticmethod
+    def _drain(driver) -> list:
+        try:
+            return driver.get_log("performance")
+        except Exception:
+            return []
+
+    def _average_size(self, resource_type: str) -> int:
+        sizes = self._sizes.get(resource_type)
+        if sizes and sizes[0]:
+            return sizes[1] // sizes[0]
+        return _DEFAULT_SIZES.get(resource_type, _DEFAULT_SIZES["Other"])
+
+    def collect(self, driver) -> dict:
+        """Статистика запросов страницы из performance-лога"""
+        types: Dict[str, str] = {}
+        loaded: Dict[str, int] = {}
+        blocked: Dict[str, int] = {}
+        for entry in self._drain(driver):
+            try:
+                message = json.loads(entry["message"])["message"]
+            except (KeyError, ValueError, TypeError):
+                continue
+            method = message.get("method")
+            params = message.get("params", {})
+            request_id = params.get("requestId")
+            if method == "Network.requestWillBeSent":
+                types[request_id] = params.get("type") or "Other"
+            elif method == "Network.loadingFinished":
+                loaded[request_id] = int(params.get("encodedDataLength") or 0)
+            elif method == "Network.loadingFailed" and (
+                params.get("blockedReason") or params.get("errorText") == "net::ERR_BLOCKED_BY_CLIENT"
+            ):
+                resource_type = params.get("type") or types.get(request_id) or "Other"
+                blocked[resource_type] = blocked.get(resource_type, 0) + 1
+
+        with self._lock:
+            for request_id, size in loaded.items():
+                resource_type = types.get(request_id, "Other")
+                count_bytes = self._sizes.setdefault(resource_type, [0, 0])
+                count_bytes[0] += 1
+                count_bytes[1] += size
+            bytes_saved = sum(self._average_size(t) * n for t, n in blocked.items())
+            stats = {
+                "requests": len(types),
+                "blocked": sum(blocked.values()),
+                "blocked_by_type": blocked,
+                "bytes_loaded": sum(loaded.values()),
+                "bytes_saved_estimate": bytes_saved
+            }
+            self.totals["parses"] += 1
+            for key in ("requests", "blocked", "bytes_loaded", "bytes_saved_estimate"):
+                self.totals[key] += stats[key]
+        return stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "profiles": self.profiles,
+                "type_blocking_failures": self.type_blocking_failures,
+                **self.totals
+            }
+
+
+# Глобальный экземпляр
+resource_blocker = ResourceBlocker()
@@ -0,0 +1,395 @@
+"""
+Планировщик периодического мониторинга конкурентов
+
+Расписание задаётся для каждого URL интервалом или cron-выражением
+(5 полей: минута, час, день месяца, месяц, день недели), к сроку
+добавляется случайный разброс (jitter). Состояние хранится в JSON файле,
+поэтому после перезапуска пропущенные запуски не выполняются разом:
+по правилу catch_up они пропускаются или выполняются один раз,
+равномерно распределённые по окну SCHEDULER_STARTUP_SPREAD.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+import logging
+from dataclasses import asdict, dataclass, field, fields
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlsplit
+
+from backend.config import settings
+from backend.models.schemas import ScheduleInfo
+from backend.services.browser_supervisor import browser_supervisor
+from backend.services.parser_service import canonicalize_url
+from backend.services.pipeline_service import pipeline_service
+from backend.services.usage_ledger import usage_scope
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.scheduler")
+
+CATCH_UP_RULES = ("once", "skip")
+
+
+class CronExpression:
+    """Cron-выражение из 5 полей: *, списки, диапазоны и шаги (*/15, 1-5, 0,30)"""
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError("cron-выражение должно содержать 5 полей: минута час день месяц день_недели")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high, weekday=index == 4)
+            for index, (part, (low, high)) in enumerate(zip(parts, self._RANGES))
+        )
+        # Как в cron: если заданы и день месяца, и день недели — подходит любой из них
+        self._days_any = parts[2] == "*"
+        self._weekdays_any = parts[4] == "*"
+
+    @staticmethod
+    def _parse(part: str, low: int, high: int, weekday: bool = False) -> Set[int]:
+        values: Set[int] = set()
+        for item in part.split(","):
+            body, _, step = item.partition("/")
+            if body == "*":
+                start, end = low, high
+            elif "-" in body:
+                start, end = (int(v) for v in body.split("-", 1))
+            else:
+                start = end = int(body)
+                if step:
+                    end = high
+            step_value = int(step) if step else 1
+            if weekday and end == 7:
+                # 7 — тоже воскресенье
+                values.add(0)
+                end = 6
+                if start == 7:
+                    continue
+            if start < low or end > high or start > end or step_value < 1:
+                raise ValueError(f"Недопустимое значение в cron-поле: {item}")
+            values.update(range(start, end + 1, step_value))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        if self._days_any or self._weekdays_any:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, after: float) -> float:
+        """Ближайший момент срабатывания строго после after (локальное время)"""
+        moment = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+                continue
+            if moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+                continue
+            return moment.timestamp()
+        raise ValueError(f"cron-выражение никогда не срабатывает: {self.expression}")
+
+
+@dataclass
+class Schedule:
+    """Расписание проверки одного URL и статистика его запусков"""
+    id: str
+    url: str
+    interval_seconds: Optional[int] = None
+    cron: Optional[str] = None
+    screenshot: Optional[bool] = None
+    jitter_seconds: int = 0
+    catch_up: str = "once"
+    paused: bool = False
+    created_at: float = field(default_factory=time.time)
+    next_run: Optional[float] = None
+    last_run: Optional[float] = None
+    last_duration: Optional[float] = None
+    last_status: Optional[str] = None
+    last_error: Optional[str] = None
+    last_change: Optional[str] = None
+    runs: int = 0
+    failures: int = 0
+
+    def next_after(self, after: float) -> float:
+        """Следующий срок запуска после after, с разбросом"""
+        if self.cron:
+            base = CronExpression(self.cron).next_after(after)
+        else:
+            base = after + self.interval_seconds
+        return base + random.uniform(0, self.jitter_seconds)
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp).isoformat(timespec="seconds") if timestamp else None
+
+
+def schedule_info(schedule: Schedule, running: bool = False) -> ScheduleInfo:
+    """Расписание в формате ответа API"""
+    data = asdict(schedule)
+    for key in ("created_at", "next_run", "last_run"):
+        data[key] = _iso(data[key])
+    return ScheduleInfo(**data, running=running)
+
+
+class SchedulerService:
+    """Периодический парсинг и анализ по расписаниям с ограниченным пулом исполнителей"""
+
+    def __init__(self):
+        logger.info("=" * 50)
+        logger.info("Инициализация планировщика")
+
+        self.enabled = settings.scheduler_enabled
+        self.state_file = Path(settings.scheduler_file)
+        # Один браузер пула всегда остаётся интерактивным запросам
+        self.workers = max(1, min(settings.scheduler_workers, browser_supervisor.capacity - 1))
+        self.schedules: Dict[str, Schedule] = self._load()
+        self._running: Set[str] = set()
+        # Очередь и событие создаются в start(): на Python 3.9 объекты asyncio,
+        # созданные при импорте, привязываются к другому event loop
+        self._queue: Optional["asyncio.Queue[str]"] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+        logger.info(f"  Файл состояния: {self.state_file}")
+        logger.info(f"  Расписаний: {len(self.schedules)}, исполнителей: {self.workers}")
+        logger.info("Планировщик инициализирован ✓")
+        logger.info("=" * 50)
+
+    # === Состояние ===
+
+    def _load(self) -> Dict[str, Schedule]:
+        try:
+            raw = json.loads(self.state_file.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"  ⚠ Состояние планировщика не загружено: {e}")
+            return {}
+        known = {f.name for f in fields(Schedule)}
+        return {item["id"]: Schedule(**{k: v for k, v in item.items() if k in known}) for item in raw}
+
+    def _save(self):
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.state_file.with_suffix(".tmp")
+            tmp_path.write_text(
+                json.dumps([asdict(s) for s in self.schedules.values()], ensure_ascii=False, indent=2),
+                encoding="utf-8"
+            )
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logger.warning(f"  ⚠ Состояние планировщика не сохранено: {e}")
+
+    def _catch_up(self):
+        """Разобрать запуски, пропущенные пока сервер не работал"""
+        now = time.time()
+        overdue = 0
+        for schedule in self.schedules.values():
+            if schedule.next_run is None or schedule.next_run > now:
+                continue
+            overdue += 1
+            if schedule.catch_up == "skip":
+                schedule.next_run = schedule.next_after(now)
+            else:
+                # Один догоняющий запуск, разнесённый по окну, чтобы не было лавины
+                schedule.next_run = now + random.uniform(0, settings.scheduler_startup_spread)
+        if overdue:
+            logger.info(f"  ⏰ Пропущенных запусков: {overdue}")
+            self._save()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # === Управление расписаниями ===
+
+    def add(
+        self,
+        url: str,
+        interval_seconds: Optional[int] = None,
+        cron: Optional[str] = None,
+        screenshot: Optional[bool] = None,
+        jitter_seconds: Optional[int] = None,
+        catch_up: str = "once",
+        paused: bool = False
+    ) -> Schedule:
+        """Добавить расписание; ValueError при некорректных параметрах"""
+        if (interval_seconds is None) == (cron is None):
+            raise ValueError("Укажите либо interval_seconds, либо cron")
+        if interval_seconds is not None and interval_seconds < settings.scheduler_min_interval:
+            raise ValueError(f"Интервал не меньше {settings.scheduler_min_interval} сек")
+        if cron is not None:
+            CronExpression(cron)
+        if catch_up not in CATCH_UP_RULES:
+            raise ValueError(f"catch_up: {', '.join(CATCH_UP_RULES)}")
+
+        schedule = Schedule(
+            id=uuid.uuid4().hex[:12],
+            url=url.strip(),
+            interval_seconds=interval_seconds,
+            cron=cron,
+            screenshot=screenshot,
+            jitter_seconds=settings.scheduler_default_jitter if jitter_seconds is None else jitter_seconds,
+            catch_up=catch_up,
+            paused=paused
+        )
+        schedule.next_run = schedule.next_after(time.time())
+        self.schedules[schedule.id] = schedule
+        self._save()
+        self._wake()
+        logger.info(f"📅 Расписание {schedule.id}: {schedule.url} ({cron or f'каждые {interval_seconds} сек'})")
+        return schedule
+
+    def get(self, schedule_id: str) -> Optional[Schedule]:
+        return self.schedules.get(schedule_id)
+
+    def set_paused(self, schedule_id: str, paused: bool) -> Optional[Schedule]:
+        schedule = self.schedules.get(schedule_id)
+        if schedule is None:
+            return None
+        schedule.paused = paused
+        if not paused and (schedule.next_run is None or schedule.next_run < time.time()):
+            schedule.next_run = schedule.next_after(time.time())
+        self._save()
+        self._wake()
+        return schedule
+
+    def delete(self, schedule_id: str) -> bool:
+        if self.schedules.pop(schedule_id, None) is None:
+            return False
+        self._save()
+        return True
+
+    def trigger(self, schedule_id: str) -> Optional[Schedule]:
+        """Запустить проверку вне расписания (срок следующего запуска не меняется)"""
+        schedule = self.schedules.get(schedule_id)
+        if schedule is None:
+            return None
+        # Планировщик не запущен — исполнителей нет, ставить в очередь некуда
+        if self._queue is not None and schedule.id not in self._running:
+            self._running.add(schedule.id)
+            self._queue.put_nowait(schedule.id)
+        return schedule
+
+    def seed(self, urls: List[str], interval_seconds: int):
+        """Создать расписания для URL, у которых их ещё нет"""
+        existing = {canonicalize_url(s.url) for s in self.schedules.values()}
+        for url in urls:
+            if canonicalize_url(url) not in existing:
+                self.add(url, interval_seconds=interval_seconds)
+
+    # === Выполнение ===
+
+    async def _dispatch(self):
+        """Ставить в очередь расписания, у которых подошёл срок"""
+        while True:
+            now = time.time()
+            next_wakeup = now + settings.scheduler_tick_max
+            queued = False
+            for schedule in list(self.schedules.values()):
+                if schedule.paused or schedule.next_run is None:
+                    continue
+                if schedule.next_run <= now and schedule.id not in self._running:
+                    self._running.add(schedule.id)
+                    schedule.next_run = schedule.next_after(now)
+                    self._queue.put_nowait(schedule.id)
+                    queued = True
+                next_wakeup = min(next_wakeup, schedule.next_run)
+            if queued:
+                self._save()
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.1, next_wakeup - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            schedule_id = await self._queue.get()
+            try:
+                schedule = self.schedules.get(schedule_id)
+                if schedule is not None:
+                    await self._run(schedule)
+            finally:
+                self._running.discard(schedule_id)
+
+    async def _run(self, schedule: Schedule):
+        logger.info(f"⏰ Плановая проверка {schedule.id}: {schedule.url}")
+        start = time.time()
+        schedule.last_run = start
+        try:
+            with usage_scope(endpoint="scheduler", competitor=urlsplit(canonicalize_url(schedule.url)).hostname):
+                # Плановая проверка ищет изменения — страница всегда загружается заново
+                result = await pipeline_service.parse_and_analyze(schedule.url, screenshot=schedule.screenshot, max_age=0)
+            schedule.last_status = "ok"
+            schedule.last_error = None
+            schedule.last_change = result.change.status if result.change else None
+        except Exception as e:
+            logger.error(f"  ❌ Плановая проверка {schedule.id} не удалась: {e}")
+            schedule.last_status = "error"
+            schedule.last_error = str(e)[:300]
+            schedule.failures += 1
+        schedule.runs += 1
+        schedule.last_duration = round(time.time() - start, 2)
+        self._save()
+
+    def start(self):
+        """Запустить диспетчер и исполнителей (в работающем event loop)"""
+        if not self.enabled or self._tasks:
+            return
+        if settings.scheduler_seed_interval and settings.competitor_urls:
+            self.seed(settings.competitor_urls, settings.scheduler_seed_interval)
+        self._catch_up()
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"📅 Планировщик запущен: {len(self.schedules)} расписаний, {self.workers} исполнителей")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._save()
+
+    def list_schedules(self) -> List[ScheduleInfo]:
+        return [
+            schedule_info(s, s.id in self._running)
+            for s in sorted(self.schedules.values(), key=lambda s: s.next_run or float("inf"))
+        ]
+
+    def info(self, schedule: Schedule) -> ScheduleInfo:
+        return schedule_info(schedule, schedule.id in self._running)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "schedules": len(self.schedules),
+            "paused": sum(1 for s in self.schedules.values() if s.paused),
+            "running": len(self._running),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "workers": self.workers
+        }
+
+
+# Глобальный экземпляр
+logger.info("Создание глобального экземпляра планировщика...")
+scheduler_service = SchedulerService()
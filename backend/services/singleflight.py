@@ -0,0 +1,74 @@
+"""
+Объединение одинаковых одновременных запросов (single-flight)
+
+Если запрос с тем же ключом уже выполняется, новый запрос не запускает
+работу заново, а дожидается результата уже идущего.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.singleflight")
+
+
+class _Call:
+    """Выполняющийся запрос и число ожидающих его клиентов"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Группы одновременных запросов, объединённые по (пространство, ключ)"""
+
+    def __init__(self):
+        self._calls: Dict[Tuple[str, str], _Call] = {}
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"leaders": 0, "coalesced": 0, "cancelled": 0})
+
+    async def do(self, namespace: str, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполнить factory() или присоединиться к уже выполняющемуся вызову"""
+        call_key = (namespace, key)
+        call = self._calls.get(call_key)
+
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = _Call(task)
+            self._calls[call_key] = call
+            self._stats[namespace]["leaders"] += 1
+            task.add_done_callback(lambda _: self._forget(call_key, call))
+        else:
+            self._stats[namespace]["coalesced"] += 1
+            logger.info(f"🔗 Запрос присоединён к выполняющемуся ({namespace}: {key[:60]})")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            # Отменяем общую работу, только если её больше никто не ждёт
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+                self._stats[namespace]["cancelled"] += 1
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, call_key: Tuple[str, str], call: _Call):
+        if self._calls.get(call_key) is call:
+            del self._calls[call_key]
+
+    def stats(self) -> dict:
+        """Счётчики: запущено, присоединено, сейчас в работе"""
+        in_flight: Dict[str, int] = defaultdict(int)
+        for namespace, _ in self._calls:
+            in_flight[namespace] += 1
+        return {
+            namespace: {**counters, "in_flight": in_flight.get(namespace, 0)}
+            for namespace, counters in self._stats.items()
+        }
+
+
+# Глобальный экземпляр
+singleflight = SingleFlight()
@@ -0,0 +1,304 @@
+"""
+Учёт токенов и задержек по каждому запросу к ProxyAPI (SQLite)
+
+Каждый вызов API и каждое попадание в кэш записывается с указанием
+эндпоинта, конкурента, модели, токенов, задержки, повторов и статуса кэша.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+import logging
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from backend.config import settings
+
+# Логгер для сервиса
+logger = logging.getLogger("competitor_monitor.usage")
+
+# Эндпоинт и конкурент текущего запроса (задаются middleware и конвейером)
+_endpoint: ContextVar[str] = ContextVar("usage_endpoint", default="internal")
+_competitor: ContextVar[Optional[str]] = ContextVar("usage_competitor", default=None)
+# Статус кэша для вызова API: miss — не нашли, bypass — no_cache, off — кэш выключен
+_cache_status: ContextVar[str] = ContextVar("usage_cache_status", default="off")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS upstream_calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    competitor TEXT,
+    model TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    cache_status TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL DEFAULT 0,
+    success INTEGER NOT NULL DEFAULT 1,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_upstream_calls_ts ON upstream_calls (ts);
+CREATE INDEX IF NOT EXISTS idx_upstream_calls_endpoint_ts ON upstream_calls (endpoint, ts);
+"""
+
+_COLUMNS = (
+    "ts", "endpoint", "competitor", "model", "kind", "cache_status",
+    "prompt_tokens", "completion_tokens", "cached_tokens", "latency_ms",
+    "retries", "success", "error"
+)
+
+# Группировки для агрегатов: имя -> SQL выражение
+GROUPINGS = {
+    "hour": "strftime('%Y-%m-%d %H:00', ts, 'unixepoch')",
+    "endpoint": "endpoint",
+    "competitor": "COALESCE(competitor, '')",
+    "model": "model",
+    "cache_status": "cache_status"
+}
+
+
+class TokenBudgetExceeded(Exception):
+    """Часовой бюджет токенов эндпоинта исчерпан"""
+
+
+@contextmanager
+def usage_scope(endpoint: Optional[str] = None, competitor: Optional[str] = None):
+    """Привязать вызовы API внутри блока к эндпоинту и/или конкуренту"""
+    tokens = []
+    if endpoint is not None:
+        tokens.append((_endpoint, _endpoint.set(endpoint)))
+    if competitor is not None:
+        tokens.append((_competitor, _competitor.set(competitor)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def set_competitor(competitor: Optional[str]):
+    """Указать конкурента для всех последующих вызовов в текущей задаче"""
+    _competitor.set(competitor)
+
+
+def set_cache_status(status: str):
+    """Запомнить результат поиска в кэше для следующего вызова API"""
+    _cache_status.set(status)
+
+
+class UsageLedger:
+    """Журнал вызовов API: буферизованная запись в SQLite и агрегаты"""
+
+    def __init__(self):
+        logger.info("=" * 50)
+        logger.info("Инициализация журнала использования API")
+
+        self.enabled = settings.usage_ledger_enabled
+        self.db_file = Path(settings.usage_db_file)
+        self.budgets: Dict[str, int] = settings.endpoint_token_budgets
+        self._pending: List[tuple] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._db_lock = threading.Lock()
+        # Расход токенов за последний час по эндпоинтам (для бюджетов)
+        self._recent: Dict[str, Deque[Tuple[float, int]]] = defaultdict(deque)
+        self._conn: Optional[sqlite3.Connection] = None
+
+        if self.enabled:
+            self._conn = self._connect()
+            self._load_recent()
+            logger.info(f"  Файл: {self.db_file}")
+            if self.budgets:
+                logger.info(f"  Бюджеты токенов в час: {self.budgets}")
+        else:
+            logger.info("  Журнал выключен")
+
+        logger.info("Журнал использования инициализирован ✓")
+        logger.info("=" * 50)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db_file.parent != Path("."):
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+
+        # Удаляем записи старше срока хранения
+        cutoff = time.time() - settings.usage_retention_days * 86400
+        deleted = conn.execute("DELETE FROM upstream_calls WHERE ts < ?", (cutoff,)).rowcount
+        conn.commit()
+        if deleted:
+            logger.info(f"  🗑️ Удалено старых записей: {deleted}")
+        return conn
+
+    def _load_recent(self):
+        """Восстановить часовой расход токенов после перезапуска"""
+        if not self.budgets:
+            return
+        rows = self._conn.execute(
+            "SELECT endpoint, ts, prompt_tokens + completion_tokens FROM upstream_calls "
+            "WHERE ts >= ? AND kind != 'cache' ORDER BY ts",
+            (time.time() - 3600,)
+        ).fetchall()
+        for endpoint, ts, tokens in rows:
+            if endpoint in self.budgets:
+                self._recent[endpoint].append((ts, tokens))
+
+    # === Бюджеты ===
+
+    def _used_last_hour(self, endpoint: str) -> int:
+        window = self._recent[endpoint]
+        cutoff = time.time() - 3600
+        while window and window[0][0] < cutoff:
+            window.popleft()
+        return sum(tokens for _, tokens in window)
+
+    def check_budget(self):
+        """Бросить TokenBudgetExceeded, если бюджет текущего эндпоинта исчерпан"""
+        endpoint = _endpoint.get()
+        limit = self.budgets.get(endpoint)
+        if limit is None:
+            return
+        used = self._used_last_hour(endpoint)
+        if used >= limit:
+            logger.warning(f"  ⛔ Бюджет токенов исчерпан: {endpoint} ({used}/{limit} за час)")
+            raise TokenBudgetExceeded(f"Бюджет токенов для {endpoint} исчерпан: {used}/{limit} за последний час")
+
+    def budget_stats(self) -> dict:
+        return {
+            endpoint: {"limit_per_hour": limit, "used_last_hour": self._used_last_hour(endpoint)}
+            for endpoint, limit in self.budgets.items()
+        }
+
+    # === Запись ===
+
+    def record_call(
+        self,
+        model: str,
+        kind: str,
+        usage: Optional[object],
+        latency: float,
+        retries: int = 0,
+        error: Optional[Exception] = None
+    ):
+        """Записать вызов API (usage — объект usage из ответа OpenAI или None)"""
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+
+        endpoint = _endpoint.get()
+        if endpoint in self.budgets and prompt_tokens + completion_tokens:
+            self._recent[endpoint].append((time.time(), prompt_tokens + completion_tokens))
+
+        self._append((
+            time.time(), endpoint, _competitor.get(), model, kind, _cache_status.get(),
+            prompt_tokens, completion_tokens, cached_tokens, round(latency * 1000, 1),
+            retries, 0 if error else 1, (str(error) or type(error).__name__)[:500] if error else None
+        ))
+
+    def record_cache_hit(self, model: str, status: str = "hit"):
+        """Записать ответ из кэша (без обращения к API); status=unchanged — повтор анализа неизменённой страницы"""
+        self._append((
+            time.time(), _endpoint.get(), _competitor.get(), model, "cache", status,
+            0, 0, 0, 0.0, 0, 1, None
+        ))
+
+    def _append(self, row: tuple):
+        if not self.enabled:
+            return
+        self._pending.append(row)
+        # Пишем пачками в фоне, чтобы не задерживать ответ
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+            except RuntimeError:
+                self._write(self._take_pending())
+
+    async def _flush_later(self):
+        await asyncio.sleep(0.5)
+        await self.flush()
+
+    def _take_pending(self) -> List[tuple]:
+        rows, self._pending = self._pending, []
+        return rows
+
+    def _write(self, rows: List[tuple]):
+        if not rows:
+            return
+        placeholders = ", ".join("?" for _ in _COLUMNS)
+        with self._db_lock:
+            self._conn.executemany(
+                f"INSERT INTO upstream_calls ({', '.join(_COLUMNS)}) VALUES ({placeholders})", rows
+            )
+            self._conn.commit()
+
+    async def flush(self):
+        """Записать накопленные записи в базу"""
+        rows = self._take_pending()
+        if rows:
+            await asyncio.to_thread(self._write, rows)
+
+    # === Чтение ===
+
+    def _query(self, sql: str, params: tuple) -> List[dict]:
+        with self._db_lock:
+            cursor = self._conn.execute(sql, params)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    async def summary(self, group_by: str = "endpoint", hours: float = 24) -> List[dict]:
+        """Агрегаты за последние hours часов, сгруппированные по group_by"""
+        if not self.enabled:
+            return []
+        if group_by not in GROUPINGS:
+            raise ValueError(f"Неизвестная группировка: {group_by}. Доступны: {', '.join(GROUPINGS)}")
+        await self.flush()
+        key = GROUPINGS[group_by]
+        sql = f"""
+            SELECT {key} AS key,
+                   COUNT(*) AS calls,
+                   SUM(kind != 'cache') AS upstream_calls,
+                   SUM(kind = 'cache') AS cache_hits,
+                   SUM(prompt_tokens) AS prompt_tokens,
+                   SUM(completion_tokens) AS completion_tokens,
+                   SUM(cached_tokens) AS cached_tokens,
+                   SUM(prompt_tokens + completion_tokens) AS total_tokens,
+                   ROUND(AVG(CASE WHEN kind != 'cache' THEN latency_ms END), 1) AS avg_latency_ms,
+                   MAX(latency_ms) AS max_latency_ms,
+                   ROUND(SUM(latency_ms) / 1000.0, 2) AS upstream_seconds,
+                   SUM(retries) AS retries,
+                   SUM(success = 0) AS failures
+            FROM upstream_calls
+            WHERE ts >= ?
+            GROUP BY key
+            ORDER BY {"key" if group_by == "hour" else "total_tokens DESC"}
+        """
+        return await asyncio.to_thread(self._query, sql, (time.time() - hours * 3600,))
+
+    async def recent(self, limit: int = 100) -> List[dict]:
+        """Последние записи журнала"""
+        if not self.enabled:
+            return []
+        await self.flush()
+        sql = f"SELECT id, {', '.join(_COLUMNS)} FROM upstream_calls ORDER BY id DESC LIMIT ?"
+        return await asyncio.to_thread(self._query, sql, (limit,))
+
+    async def close(self):
+        if self._conn is None:
+            return
+        await self.flush()
+        with self._db_lock:
+            self._conn.close()
+        self._conn = None
+
+
+# Глобальный экземпляр
+logger.info("Создание глобального экземпляра журнала использования...")
+usage_ledger = UsageLedger()
@@ -1,6 +1,7 @@
 """
 API клиент для связи с backend
 """
+import time
 import requests
 from typing import Optional, Dict, Any
 import base64
@@ -12,6 +13,8 @@ class APIClient:
     def __init__(self, base_url: str = "http://localhost:8000"):
         self.base_url = base_url
         self.timeout = 120  # 2 минуты для долгих операций
+        self.job_timeout = 600  # сколько ждать задание на сервере
+        self.poll_wait = 25  # long-poll: сервер отвечает при завершении или через столько сек
     
     def _request(self, method: str, endpoint: str, **kwargs) -> Dict[str, Any]:
         """Выполнить HTTP запрос"""
@@ -64,12 +67,34 @@ class APIClient:
         return self._request("POST", "/analyze_image", files=files)
     
     def parse_demo(self, url: str) -> Dict[str, Any]:
-        """Парсинг и анализ сайта"""
-        return self._request(
-            "POST",
-            "/parse_demo",
-            json={"url": url}
-        )
+        """Парсинг и анализ сайта через задание на сервере (без долгого HTTP запроса)"""
+        job = self._request("POST", "/jobs", json={"url": url}, timeout=30)
+        if "id" not in job:
+            # Сервер без очереди заданий — синхронный запрос
+            return self._request("POST", "/parse_demo", json={"url": url})
+        
+        deadline = time.time() + self.job_timeout
+        failures = 0
+        while time.time() < deadline:
+            status = self._request(
+                "GET",
+                f"/jobs/{job['id']}",
+                params={"wait": self.poll_wait},
+                timeout=self.poll_wait + 15
+            )
+            if "status" not in status:
+                # Кратковременный обрыв связи: задание продолжает выполняться на сервере
+                failures += 1
+                if failures >= 3:
+                    return status
+                time.sleep(2)
+                continue
+            failures = 0
+            if status["status"] == "done":
+                return {"success": True, "data": status["result"]}
+            if status["status"] == "failed":
+                return {"success": False, "error": status.get("error") or "Задание не выполнено"}
+        return {"success": False, "error": "Превышено время ожидания результата задания."}
     
     def get_competitor_urls(self) -> list:
         """Получить список URL конкурентов из конфигурации"""
@@ -0,0 +1,164 @@
+"""
+Нагрузочный тест OpenAI сервиса против локальной заглушки API
+
+Поднимает OpenAI-совместимую заглушку (/chat/completions с искусственной
+задержкой) и прогоняет через OpenAIService пачки параллельных запросов.
+При неблокирующем клиенте пропускная способность растёт вместе с
+параллельностью, а время одной пачки остаётся близким к задержке заглушки.
+
+Запуск:
+    python loadtest.py --delay 0.5 --levels 1,2,4,8,16
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+
+
+STUB_CONTENT = json.dumps({
+    "aida_score": 7,
+    "aida_analysis": "Заглушка",
+    "strengths": ["a", "b", "c"],
+    "weaknesses": ["a", "b", "c"],
+    "unique_offers": ["a", "b", "c"],
+    "recommendations": ["a", "b", "c"],
+    "summary": "Ответ локальной заглушки"
+}, ensure_ascii=False)
+
+
+def make_stub_app(delay: float):
+    """ASGI приложение, имитирующее /chat/completions с задержкой"""
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        # Дочитываем тело запроса
+        more_body = True
+        while more_body:
+            message = await receive()
+            more_body = message.get("more_body", False)
+
+        await asyncio.sleep(delay)
+
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "stub",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": STUB_CONTENT},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
+        }).encode("utf-8")
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def start_stub(delay: float) -> int:
+    """Запустить заглушку в отдельном потоке, вернуть порт"""
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    config = uvicorn.Config(make_stub_app(delay), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+    return port
+
+
+async def run_level(service, concurrency: int, rounds: int) -> dict:
+    """Выполнить concurrency * rounds запросов с заданной параллельностью"""
+    text = "Тестовый текст конкурента для нагрузочного теста сервиса анализа."
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            # Без кэша: иначе все запросы после первого — попадания в LRU, а не вызовы API
+            await service.analyze_text(text, use_cache=False)
+
+    total = concurrency * rounds
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "elapsed": elapsed,
+        "rps": total / elapsed
+    }
+
+
+async def main_async(args):
+    port = start_stub(args.delay)
+
+    # Настройки читаются при импорте backend — подменяем окружение заранее
+    os.environ["PROXY_API_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    os.environ.setdefault("PROXY_API_KEY", "loadtest")
+    os.environ["OPENAI_MAX_CONNECTIONS"] = str(max(args.levels))
+    os.environ["OPENAI_MAX_KEEPALIVE_CONNECTIONS"] = str(max(args.levels))
+    # Лимиты губернатора апстрима не должны срезать верхние уровни нагрузки:
+    # измеряется пул соединений, а не стартовое окно AIMD и бюджет RPM
+    os.environ["UPSTREAM_CONCURRENCY_INITIAL"] = str(max(args.levels))
+    os.environ["UPSTREAM_CONCURRENCY_MAX"] = str(max(args.levels))
+    os.environ["TEXT_RPM"] = "1000000"
+    os.environ["TEXT_TPM"] = "1000000000"
+
+    import logging
+    from backend.services.openai_service import OpenAIService
+
+    logging.getLogger("competitor_monitor").setLevel(logging.WARNING)
+    service = OpenAIService()
+    await service.warmup()
+
+    print()
+    print(f"Задержка заглушки: {args.delay:.2f} сек, раундов на уровень: {args.rounds}")
+    print(f"{'параллельность':>15} {'запросов':>10} {'время, сек':>12} {'req/s':>10} {'ускорение':>10}")
+
+    base_rps = None
+    try:
+        for level in args.levels:
+            result = await run_level(service, level, args.rounds)
+            base_rps = base_rps or result["rps"]
+            print(
+                f"{result['concurrency']:>15} {result['requests']:>10} "
+                f"{result['elapsed']:>12.2f} {result['rps']:>10.2f} {result['rps'] / base_rps:>9.1f}x"
+            )
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест OpenAIService")
+    parser.add_argument("--delay", type=float, default=0.5, help="Задержка ответа заглушки, сек")
+    parser.add_argument("--rounds", type=int, default=3, help="Пачек запросов на уровень")
+    parser.add_argument(
+        "--levels",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1, 2, 4, 8, 16],
+        help="Уровни параллельности через запятую"
+    )
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()